@@ -1,3 +1,5 @@
 from .run import *
-from .circuit import CircuitChart
+from .circuit import CircuitChart, shared_circuit
+from .stream import iter_lap_frames, iter_laps, stream_lap_summaries
+from .metrics import METRICS, register_metric
 from .utils import *
\ No newline at end of file
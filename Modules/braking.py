@@ -1,40 +1,109 @@
+import numpy as np
 import pandas as pd
 
+BRAKING_THRESHOLD = 0.2
+TURN_METRICS = ['mean_velocity', 'exit_velocity', 'distance_before_braking', 'entry_velocity', 'min_velocity', 'peak_bpe']
 
-def get_braking_stats(turns_json: list, laps: list, run_df: pd.DataFrame, lap_map: list, drivers: list, lap_idxs: list = [], groupby: bool = False) -> tuple[list]:
-    if lap_idxs:
-        laps = [laps[i] for i in lap_idxs]
-        lap_map = [lap_map[i] for i in lap_idxs]
-        drivers = [drivers[i] for i in lap_idxs]
+
+def turn_metrics(turns_json: list, laps: list, run_df: pd.DataFrame, drivers: list) -> pd.DataFrame:
+    """
+    Metrics of every (lap, turn) with samples, computed in a single grouped pass over run_df.
+
+    Rows are assigned to the turns whose microsector range contains them (a row can belong to several
+    turns if they overlap) and grouped by (turn, lap). For each group it computes the mean, entry (first row),
+    exit (last row) and minimum velocity, the peak brake pressure and the distance covered, in TimeStamp
+    order, before the first sample with a BPE >= BRAKING_THRESHOLD.
+
+    input:
+        turns_json: the turns of the circuit, as in its turns.json
+        laps: the lap numbers (values of the laps column of run_df) to compute
+        run_df: the run telemetry
+        drivers: the driver of each lap in laps
+
+    output:
+        a dataframe indexed by (lap, turn) with the driver, the turn_id (chart axis of the turn), the
+        turn_position (position of the turn in turns_json) and the TURN_METRICS columns, sorted by lap and turn_position
+    """
+    lap_numbers, first = np.unique(np.asarray(laps, dtype=np.int64), return_index=True)
+    lap_drivers = np.asarray(drivers, dtype=object)[first]
+    if not len(turns_json) or not len(lap_numbers) or not len(run_df):
+        return _metrics_table()
+
+    # Rows of the selected laps and the turns they belong to
+    run_laps = run_df['laps'].values
+    microsectors = run_df['microsector'].values.astype(np.int64)
+    selected = np.flatnonzero(np.isin(run_laps, lap_numbers))
+    table_size = max(int(microsectors.max(initial=0)), max(turn['last_ms'] for turn in turns_json)) + 1
+    microsector_turns = np.zeros((table_size, len(turns_json)), dtype=bool)
+    for turn_position, turn in enumerate(turns_json):
+        microsector_turns[max(turn['first_ms'], 0):turn['last_ms'] + 1, turn_position] = True
+    turn_idxs, selected_idxs = np.nonzero(microsector_turns[microsectors[selected]].T)
+    if not len(turn_idxs):
+        return _metrics_table()
+    rows = selected[selected_idxs]
+
+    # Groups by (turn, lap), keeping the run order inside each group
+    keys = turn_idxs * len(lap_numbers) + np.searchsorted(lap_numbers, run_laps[rows])
+    order = np.argsort(keys, kind='stable')
+    rows, keys = rows[order], keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    ends = np.append(starts[1:], len(keys))
+
+    velocity = run_df['Velocity'].values[rows]
+    metrics = {
+        'mean_velocity': np.add.reduceat(velocity.astype(np.float64), starts) / (ends - starts),
+        'exit_velocity': velocity[ends - 1],
+        'entry_velocity': velocity[starts],
+        'min_velocity': np.minimum.reduceat(velocity, starts),
+        'peak_bpe': np.maximum.reduceat(run_df['BPE'].values[rows], starts),
+    }
+
+    # Distance before braking, in TimeStamp order inside each group
+    time_order = np.lexsort((run_df['TimeStamp'].values[rows], keys))
+    timed_rows = rows[time_order]
+    braked = np.cumsum(run_df['BPE'].values[timed_rows] >= BRAKING_THRESHOLD)
+    braked_before_group = np.repeat(np.concatenate([[0], braked[ends[:-1] - 1]]), ends - starts)
+    distance = np.where(braked - braked_before_group == 0, run_df['dist1'].values[timed_rows], 0)
+    metrics['distance_before_braking'] = np.add.reduceat(distance, starts)
+
+    group_turns = keys[starts] // len(lap_numbers)
+    group_laps = keys[starts] % len(lap_numbers)
+    turn_names = np.array([turn['name'] for turn in turns_json], dtype=object)
+    table = _metrics_table(
+        lap=lap_numbers[group_laps],
+        turn=turn_names[group_turns],
+        driver=lap_drivers[group_laps],
+        turn_id=np.array([int(name.split(' ')[1]) - 1 for name in turn_names[group_turns]]),
+        turn_position=group_turns,
+        **metrics,
+    )
+    return table.sort_values(by=['lap', 'turn_position'], kind='stable')
+
+def _metrics_table(**columns: np.ndarray) -> pd.DataFrame:
+    # turn_metrics table with the given columns, empty if none is given
+    dtypes = {'lap': np.int64, 'turn': object, 'driver': object, 'turn_id': np.int64, 'turn_position': np.int64, **{metric: np.float64 for metric in TURN_METRICS}}
+    table = pd.DataFrame({column: np.asarray(columns.get(column, []), dtype=dtype) for column, dtype in dtypes.items()})
+    return table.set_index(['lap', 'turn'])
+
+def select_braking_stats(table: pd.DataFrame, laps: list, drivers: list, groupby: bool = False) -> tuple[list]:
+    """
+    Braking stats of the given laps, sliced from a turn_metrics table, as the columns used by the braking charts.
+    Rows are ordered by turn (as in turns_json) and then as laps.
+
+    If groupby is True the stats are averaged per driver and turn, and the line of each driver is the position
+    of its last lap in laps.
+    """
     drivers_map = {driver: i for i, driver in enumerate(drivers)}
-    axis_names = []
-    axis_idxs = []
-    lines = []
-    drivers_names = []
-    mean_v = []
-    out_v = []
-    distance_before_braking = []
-
-    for turn in turns_json:
-        for lap_number, lap_diff, lap_driver in zip(laps, lap_map, drivers):
-            df = run_df.loc[(turn['first_ms'] <= run_df['microsector']) & (run_df['microsector'] <= turn['last_ms']) & (run_df['laps'] == lap_number - lap_diff)]
-
-            pre_break_dist = 0
-            if len((first_braking := df[['BPE', 'TimeStamp']].sort_values(by = 'TimeStamp', ascending = True).values)) > 0:
-                has_breaked = first_braking[0][0] >= 0.2
-                for bpe, dist, _ in df[['BPE', 'dist1', 'TimeStamp']].sort_values(by = 'TimeStamp', ascending = True).values:
-                    if not has_breaked and bpe < 0.2:
-                        pre_break_dist += dist
-                    else:
-                        has_breaked = True
-
-                axis_names.append(turn['name'])
-                axis_idxs.append(int(turn['name'].split(' ')[1]) - 1)
-                drivers_names.append(lap_driver)
-                lines.append(lap_number)
-                mean_v.append(df['Velocity'].mean())
-                out_v.append(df['Velocity'].values[-1])
-                distance_before_braking.append(pre_break_dist)
+    requested = pd.DataFrame({'lap': np.asarray(laps, dtype=np.int64), 'request_order': np.arange(len(laps))})
+    rows = table.reset_index().merge(requested, on='lap').sort_values(by=['turn_position', 'request_order'], kind='stable')
+
+    axis_names = rows['turn'].tolist()
+    axis_idxs = rows['turn_id'].tolist()
+    lines = rows['lap'].tolist()
+    drivers_names = rows['driver'].tolist()
+    mean_v = rows['mean_velocity'].tolist()
+    out_v = rows['exit_velocity'].tolist()
+    distance_before_braking = rows['distance_before_braking'].tolist()
 
     if groupby:
         # build a dataframe with the data, get the average mean_v, out_v and distance_before_braking of each driver and return the columns splited
@@ -49,3 +118,9 @@ def get_braking_stats(turns_json: list, laps: list, run_df: pd.DataFrame, lap_ma
         distance_before_braking = df['distance_before_braking'].values.tolist()
 
     return axis_names, axis_idxs, lines, drivers_names, mean_v, out_v, distance_before_braking
+
+def get_braking_stats(turns_json: list, laps: list, run_df: pd.DataFrame, drivers: list, lap_idxs: list = [], groupby: bool = False) -> tuple[list]:
+    if lap_idxs:
+        laps = [laps[i] for i in lap_idxs]
+        drivers = [drivers[i] for i in lap_idxs]
+    return select_braking_stats(turn_metrics(turns_json, laps, run_df, drivers), laps, drivers, groupby=groupby)
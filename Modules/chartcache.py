@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+def chart_key(name: str, circuit: Hashable, lap_a: int | None = None, lap_b: int | None = None, selection: Hashable = None, drivers: bool = False, **params) -> tuple:
+    """
+    Key of a chart in a ChartCache: the chart, the circuit (run) it shows, the selected laps, the sector or
+    microsectors selection and the drivers flag. Any other argument of the chart goes in params.
+    """
+    return (circuit, name, lap_a, lap_b, selection, drivers, tuple(sorted(params.items())))
+
+
+class ChartCache:
+    def __init__(self, max_entries: int = 256) -> None:
+        """
+        Bounded cache of chart specifications (e.g. Altair charts with their data), so reruns of the app only
+        rebuild the charts whose selection changed. Keys are built with chart_key.
+
+        Every circuit has a version, e.g. the data version of its run and the signature of its turns.json.
+        When a chart is requested with a different version than the cached charts of its circuit, all of them
+        are invalidated. When there are more than max_entries charts the least recently used ones are evicted.
+
+        Hits, misses, evictions and invalidations are counted, see stats.
+        """
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1')
+        self.max_entries = max_entries
+
+        self._charts = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: tuple, build: Callable[[], Any], version: Hashable = None) -> Any:
+        """
+        The chart of key, built with build() if it is not cached or if version is not the current version of its circuit.
+        """
+        circuit = key[0]
+        with self._lock:
+            if circuit in self._versions and self._versions[circuit] != version:
+                self._invalidate(circuit)
+            self._versions[circuit] = version
+            if key in self._charts:
+                self.hits += 1
+                self._charts.move_to_end(key)
+                return self._charts[key]
+            self.misses += 1
+
+        chart = build()
+
+        with self._lock:
+            # The circuit may have been invalidated while building
+            if self._versions.get(circuit) == version:
+                self._charts[key] = chart
+                self._evict()
+        return chart
+
+    def _evict(self) -> None:
+        while len(self._charts) > self.max_entries:
+            self._charts.popitem(last=False)
+            self.evictions += 1
+
+    def _invalidate(self, circuit: Hashable) -> None:
+        for key in [key for key in self._charts if key[0] == circuit]:
+            del self._charts[key]
+            self.invalidations += 1
+        self._versions.pop(circuit, None)
+
+    def invalidate(self, circuit: Hashable | None = None) -> None:
+        """
+        Drops the cached charts of a circuit, or all of them if circuit is None.
+        """
+        with self._lock:
+            for cached_circuit in list(self._versions) if circuit is None else [circuit]:
+                self._invalidate(cached_circuit)
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self._charts),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._charts
+
+    def __len__(self) -> int:
+        return len(self._charts)
+
+    def __repr__(self) -> str:
+        return f"ChartCache({len(self._charts)}/{self.max_entries} charts, {self.hits} hits, {self.misses} misses)"
@@ -1,9 +1,24 @@
+import os
+import pickle
+import inspect
+import hashlib
+import warnings
+import functools
+from importlib import metadata
+from os.path import dirname, abspath, join, isfile
+
 import numpy as np
 import pandas as pd
 import altair as alt
 
 from tilke import Circuit, Spline
 
+from .registry import RunRegistry
+from .utils import POINT_BUDGET, CACHE_DIRNAME, downsample, file_digest, shared_dataset, layer_rows
+
+GEOMETRY_CACHE_VERSION = 1
+GEOMETRY_CACHE_DIR = join(dirname(dirname(abspath(__file__))), CACHE_DIRNAME, 'circuits')
+
 
 def spline_chart_df(spline: Spline | np.ndarray, info: list = ['None'], precision: int = 1000, showcones: bool = True, curve_name: str = "N/D") -> tuple[pd.DataFrame]:
         """Plots a given spline with it's highlighted points and true cones
@@ -27,45 +42,150 @@ def spline_chart_df(spline: Spline | np.ndarray, info: list = ['None'], precisio
         lines_df = pd.DataFrame(gamma, columns=["x", "y"])
         lines_df['index'] = lines_df.index
         lines_df['curve'] = curve_name
-        sectors = []
-        sector_idx = []
-        for i, sector in enumerate(info):
-            sectors += [sector] * (len(lines_df) // len(info))
-            sector_idx += [i] * (len(lines_df) // len(info))
-        sectors += [info[-1]] * (len(lines_df) - len(sectors))
-        sector_idx += [i] * (len(lines_df) - len(sector_idx))
-        lines_df['sector'] = sectors
-        lines_df['sector_idx'] = sector_idx
+        lines_df['sector_idx'] = sector_labels(len(lines_df), len(info))
+        lines_df['sector'] = np.asarray(info, dtype=object)[lines_df['sector_idx'].values]
         
         return lines_df
 
-def sector_spline(spline: Spline, sector: int, microsectors: bool, precision: int = None) -> np.ndarray:
-    if sector is None:
-        return spline
-    
-    if microsectors:
-        sector_start = spline.t[-1] * sector[0] / CircuitChart.N_MICROSECTORS
-        sector_end = spline.t[-1] * (sector[-1]+1) / CircuitChart.N_MICROSECTORS
-    else:
-        sector_start = spline.t[-1] * sector / CircuitChart.N_SECTORS
-        sector_end = spline.t[-1] * (sector+1) / CircuitChart.N_SECTORS
-    if precision is None:
-        precision = int(np.ceil(1000 * (sector_end - sector_start) / spline.t[-1]))
-    
-    sector = np.linspace(sector_start, sector_end, precision)
-    gamma = spline(sector)
-    return gamma
+def sector_labels(n: int, n_sectors: int) -> np.ndarray:
+    """
+    Sector of each of n consecutive points split evenly in n_sectors, the remainder going to the last one.
+    """
+    if n < n_sectors:
+        return np.full(n, n_sectors - 1)
+    return np.minimum(np.arange(n) // (n // n_sectors), n_sectors - 1)
+
+@functools.lru_cache(maxsize=1)
+def tilke_version() -> str:
+    """
+    Version of the tilke library that generates the circuits: its package version, if installed, and the digest
+    of the source files of Circuit and Spline, so circuits cached by a different checkout are not reused.
+    """
+    try:
+        version = metadata.version('tilke')
+    except metadata.PackageNotFoundError:
+        version = 'unknown'
+    sha = hashlib.sha256(version.encode())
+    for path in sorted({inspect.getsourcefile(Circuit), inspect.getsourcefile(Spline)}):
+        sha.update(file_digest(path).encode())
+    return sha.hexdigest()
+
+def geometry_key() -> dict:
+    return {'version': GEOMETRY_CACHE_VERSION, 'tilke': tilke_version()}
+
+def geometry_path(seed: int, random_orientation: bool = False, cache_dir: str | None = None) -> str:
+    """
+    Path of the cached geometry of the TILK-E circuit of seed, in GEOMETRY_CACHE_DIR by default.
+    """
+    name = f"tilke-{seed}{'-random' if random_orientation else ''}.pkl"
+    return join(cache_dir if cache_dir is not None else GEOMETRY_CACHE_DIR, name)
 
 
 class CircuitChart(Circuit):
     N_SECTORS = 3
     N_MICROSECTORS = 10 * N_SECTORS
+    # Points sampled along each microsector of the curves, about 1000 per lap
+    MICROSECTOR_SAMPLES = 34
+
+    # Attributes computed by set_sectors, which are not cached with the geometry of the circuit
+    _DERIVED = ('samples', 'sector_doors', 'microsector_doors')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.set_sectors()
 
-    def chart(self, middle_curve_df: pd.DataFrame = None, important_points: pd.DataFrame = None, sector: int | tuple = None, info: list = ['None']) -> alt.Chart:
+    @classmethod
+    def load(cls, seed: int, random_orientation: bool = False, cache_dir: str | None = None, use_cache: bool = True) -> 'CircuitChart':
+        """
+        The circuit of a TILK-E seed, loaded from its cached geometry (see geometry_path) when it was generated
+        before by the same version of tilke. Otherwise the circuit is generated and its geometry, i.e. the state
+        of the Circuit with its curves, is cached.
+
+        input:
+            seed: the seed of the circuit
+            random_orientation: passed to Circuit
+            cache_dir: folder where the geometry is cached, GEOMETRY_CACHE_DIR if None
+            use_cache: if False the circuit is always generated and the cache is left untouched
+
+        output:
+            the circuit
+        """
+        if not use_cache:
+            return cls(seed=seed, random_orientation=random_orientation)
+
+        path = geometry_path(seed, random_orientation, cache_dir)
+        if isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    cached = pickle.load(f)
+                if cached['key'] == geometry_key():
+                    circuit = cls.__new__(cls)
+                    circuit.__dict__.update(cached['state'])
+                    circuit.set_sectors()
+                    return circuit
+            except (OSError, EOFError, KeyError, TypeError, AttributeError, pickle.UnpicklingError):
+                pass
+
+        circuit = cls(seed=seed, random_orientation=random_orientation)
+        try:
+            circuit.save(path)
+        except (OSError, pickle.PicklingError) as e:
+            warnings.warn(f"Could not write the geometry cache of circuit {seed}: {e}")
+        return circuit
+
+    def save(self, path: str) -> None:
+        """
+        Writes the geometry of the circuit to path, through a temporary file so readers never see a partial one.
+        """
+        state = {name: value for name, value in self.__dict__.items() if name not in self._DERIVED}
+        os.makedirs(dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'key': geometry_key(), 'state': state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def _step(self, microsectors: bool) -> int:
+        """
+        Number of samples between two consecutive doors of the sectors (or microsectors).
+        """
+        return self.MICROSECTOR_SAMPLES * (1 if microsectors else self.N_MICROSECTORS // self.N_SECTORS)
+
+    def _doors(self, microsectors: bool) -> np.ndarray:
+        """
+        Positions in the samples of the doors at the end of each sector (or microsector).
+        """
+        n_sectors = self.N_MICROSECTORS if microsectors else self.N_SECTORS
+        return np.arange(1, n_sectors + 1) * self._step(microsectors)
+
+    def _sector_samples(self, curve: str, sector: int | list | None, microsectors: bool) -> np.ndarray:
+        """
+        Samples of curve from the start of the first sector (or microsector) in sector to the end of the last
+        one, or the whole curve if sector is None.
+        """
+        if sector is None:
+            return self.samples[curve]
+        first, last = (sector[0], sector[-1]) if microsectors else (sector, sector)
+        step = self._step(microsectors)
+        return self.samples[curve][first * step:(last + 1) * step + 1]
+
+    def _sectors_df(self, microsectors: bool) -> pd.DataFrame:
+        """
+        Samples of the middle curve split in sectors (or microsectors), each one from its start door to its end
+        door, indexed within its sector.
+        """
+        step = self._step(microsectors)
+        n_sectors = self.N_MICROSECTORS if microsectors else self.N_SECTORS
+        rows = (np.arange(n_sectors)[:, None] * step + np.arange(step + 1)).ravel()
+        gamma = self.samples["middle"][rows]
+        return pd.DataFrame({
+            "x": gamma[:, 0],
+            "y": gamma[:, 1],
+            "sector": np.repeat(np.arange(1, n_sectors + 1), step + 1),
+            "index": np.tile(np.arange(step + 1), n_sectors),
+            "curve": "middle",
+        })
+
+    def chart(self, middle_curve_df: pd.DataFrame = None, important_points: pd.DataFrame = None, sector: int | tuple = None, info: list = ['None'], budget: int = POINT_BUDGET) -> alt.Chart:
         """Charts the circuit layout
 
         Arguments:
@@ -74,6 +194,7 @@ class CircuitChart(Circuit):
             important_points (pd.DataFrame) : the dataframe containing the important points
             sector (int | tuple) : the sector or microsectors to be plotted
             info (list) : the list of the color info to be displayed
+            budget (int) : the maximum number of points of the racing lines in middle_curve_df
         Returns:
             chart (alt.Chart) : the chart of the circuit layout
         """
@@ -83,27 +204,15 @@ class CircuitChart(Circuit):
             microsectors = True
             sector = list(range(sector[0], sector[-1] + 1))
 
-        curve_options = {
-            "interior": sector_spline(self.interior_curve, sector=sector, microsectors=microsectors),
-            "exterior": sector_spline(self.exterior_curve, sector=sector, microsectors=microsectors),
-        }
+        curve_options = {name: self._sector_samples(name, sector, microsectors) for name in ("interior", "exterior")}
         if middle_curve_df is None:
-            curve_options["middle"] = sector_spline(self.middle_curve, sector=sector, microsectors=microsectors)
+            curve_options["middle"] = self._sector_samples("middle", sector, microsectors)
 
-        lines_df = pd.DataFrame(columns=["x", "y", "curve", "index", "sector"]) if middle_curve_df is None else middle_curve_df
+        lines_df = pd.DataFrame(columns=["x", "y", "curve", "index", "sector"]) if middle_curve_df is None else downsample(middle_curve_df, "x", "y", budget=budget, by="curve").copy()
         if info != ['None'] and middle_curve_df is not None:
-            sectors = []
-            sector_idx = []
-            for i, sect in enumerate(info):
-                sectors += [sect] * (len(lines_df) // len(info))
-                sector_idx += [i] * (len(lines_df) // len(info))
-            sectors += [info[-1]] * (len(lines_df) - len(sectors))
-            sector_idx += [i] * (len(lines_df) - len(sector_idx))
-            lines_df['sector'] = sectors
-            lines_df['sector_idx'] = sector_idx
-        for curve_name, curve in curve_options.items():
-            if curve is not None:
-                lines_df = pd.concat([lines_df, spline_chart_df(curve, info=info, curve_name=curve_name)])
+            lines_df['sector_idx'] = sector_labels(len(lines_df), len(info))
+            lines_df['sector'] = np.asarray(info, dtype=object)[lines_df['sector_idx'].values]
+        lines_df = pd.concat([lines_df] + [spline_chart_df(curve, info=info, curve_name=curve_name) for curve_name, curve in curve_options.items()])
 
         chart_title = "Circuit Layout" if middle_curve_df is None else "Racing Line and Track Limits"
 
@@ -121,7 +230,7 @@ class CircuitChart(Circuit):
                         alt.value("black")
                     )
 
-        chart = alt.Chart(lines_df).mark_line().encode(
+        lines = layer_rows("lines").mark_line().encode(
             x=alt.X("x:Q", axis=None),
             y=alt.Y("y:Q", axis=None),
             color=color,
@@ -136,48 +245,50 @@ class CircuitChart(Circuit):
                 alt.value(1)),
             detail=alt.Detail(["curve:N", "sector_idx:N"]),
             tooltip=alt.value(None),
-        ).properties(
-            title=chart_title,
         )
 
+        # The racing lines, track limits and sector rulers are a single dataset shared by the layers
+        layers, data = [lines], {"lines": lines_df}
         if isinstance(sector, list) and 10 >= len(sector) > 1:
-            if not microsectors and sector is None:
-                sector = [0, 1, 2]
-            return chart + self._sector_rulers_in_circuit(sector, microsectors)
-        return chart
-
-    def _sector_rulers_in_circuit(self, sector: list, microsectors: bool) -> alt.Chart:
-        doors_json = []
-        for track_name, track in {"interior": self.interior_curve, "exterior": self.exterior_curve}.items():
-            doors = [track(track.t[-1] * (i+1)/(self.N_MICROSECTORS if microsectors else self.N_SECTORS)) for i in sector]
-            doors_json += [{
-                "x": door[0],
-                "y": door[1],
-                "sector": i + 1,
-            } for i, door in zip(sector, doors)]
-        doors_df = pd.DataFrame(doors_json)
-
-        text_df = pd.DataFrame([{
-            "x": doors_json[0]["x"],
-            "y": doors_json[0]["y"] + 1,
-            "sector": doors_json[0]["sector"],
-        }])
-
-
-        return alt.Chart(doors_df).mark_line(strokeDash=[5, 5], strokeOpacity=0.5).encode(
-            x=alt.X("x", axis=None),
-            y=alt.Y("y", axis=None),
-            detail="sector:N",
-            color=alt.value("black"),
-            tooltip=alt.value(None),
-        ) + alt.Chart(text_df).mark_text().encode(
-            x=alt.X("x", axis=None),
-            y=alt.Y("y", axis=None),
-            text="sector:N",
-            color=alt.value("black"),
-            tooltip=alt.value(None),
+            doors_df, label_df = self._sector_rulers_df(sector, microsectors)
+            layers += self._sector_rulers_in_circuit()
+            data.update(doors=doors_df, door_labels=label_df)
+
+        return alt.layer(*layers, data=shared_dataset(**data)).properties(
+            title=chart_title,
         )
 
+    def _sector_rulers_df(self, sector: list, microsectors: bool) -> tuple[pd.DataFrame]:
+        """
+        Ends of the doors of the given sectors (or microsectors) on the track limits, and the position of the
+        label of the first one.
+        """
+        sectors = np.asarray(sector)
+        doors = self._doors(microsectors)[sectors]
+        doors_df = pd.concat([
+            pd.DataFrame({"x": self.samples[track][doors, 0], "y": self.samples[track][doors, 1], "sector": sectors + 1})
+            for track in ("interior", "exterior")
+        ], ignore_index=True)
+        label_df = doors_df.iloc[:1].assign(y=doors_df["y"].iloc[0] + 1)
+        return doors_df, label_df
+
+    def _sector_rulers_in_circuit(self) -> list[alt.Chart]:
+        return [
+            layer_rows("doors").mark_line(strokeDash=[5, 5], strokeOpacity=0.5).encode(
+                x=alt.X("x:Q", axis=None),
+                y=alt.Y("y:Q", axis=None),
+                detail="sector:N",
+                color=alt.value("black"),
+                tooltip=alt.value(None),
+            ),
+            layer_rows("door_labels").mark_text().encode(
+                x=alt.X("x:Q", axis=None),
+                y=alt.Y("y:Q", axis=None),
+                text="sector:N",
+                color=alt.value("black"),
+                tooltip=alt.value(None),
+            ),
+        ]
     
     def track_chart(self, microsectors: bool = False) -> alt.Chart:
         """Charts the circuit layout with the sectors and microsectors
@@ -189,37 +300,12 @@ class CircuitChart(Circuit):
             chart (alt.Chart) : the chart of the circuit layout with the sectors and microsectors
         """
 
-        df = pd.DataFrame(columns=["x", "y", "sector", "index", "curve"])
-        doors_json = []
-
-        for track_name, track in {"middle": self.middle_curve}.items():
-            start = track.t[0]
-            end = track.t[-1]
-            precision = 1000
-            sectors = self.N_MICROSECTORS if microsectors else self.N_SECTORS
-            curve_df = pd.DataFrame(columns=["x", "y", "sector", "index"])
-
-            for i in range(sectors):
-                sector_start = start if i == 0 else end * i/sectors
-                sector_end = end * (i+1)/sectors
-                sector = np.linspace(sector_start, sector_end, num=precision//sectors)
-                gamma = track(sector)
-                sector_df = pd.DataFrame(gamma, columns=["x", "y"])
-                sector_df["index"] = sector_df.index
-                sector_df["sector"] = i + 1
-                curve_df = pd.concat([curve_df, sector_df])
-
-            curve_df["curve"] = track_name
-            df = pd.concat([df, curve_df])
-
-        for track_name, track in {"interior": self.interior_curve, "exterior": self.exterior_curve}.items():
-            doors = [track(track.t[-1] * (i+1)/(self.N_MICROSECTORS if microsectors else self.N_SECTORS)) for i in range((self.N_MICROSECTORS if microsectors else self.N_SECTORS))]
-            doors_json += [{
-                "x": door[0],
-                "y": door[1],
-                "sector": i + 1,
-            } for i, door in enumerate(doors)]
-        doors_df = pd.DataFrame(doors_json)
+        df = self._sectors_df(microsectors)
+        doors = self._doors(microsectors)
+        doors_df = pd.concat([
+            pd.DataFrame({"x": self.samples[track][doors, 0], "y": self.samples[track][doors, 1], "sector": np.arange(1, len(doors) + 1)})
+            for track in ("interior", "exterior")
+        ], ignore_index=True)
 
         return alt.Chart(df).mark_line().encode(
             x=alt.X("x", axis=None),
@@ -241,9 +327,18 @@ class CircuitChart(Circuit):
         )
     
     def set_sectors(self):
-        """Sets the sectors of the circuit"""
-        self.sector_doors = [self.middle_curve(self.middle_curve.t[-1] * (i+1)/self.N_SECTORS) for i in range(self.N_SECTORS)]
-        self.microsector_doors = [self.middle_curve(self.middle_curve.t[-1] * (i+1)/self.N_MICROSECTORS) for i in range(self.N_MICROSECTORS)]
+        """Samples the curves of the circuit and sets its sectors
+
+        Every curve is evaluated once, at MICROSECTOR_SAMPLES points per microsector with the doors of the
+        sectors and microsectors among them, and the charts select and relabel these samples.
+        """
+        fractions = np.linspace(0, 1, self.N_MICROSECTORS * self.MICROSECTOR_SAMPLES + 1)
+        self.samples = {
+            name: np.asarray(curve(curve.t[-1] * fractions))
+            for name, curve in {"middle": self.middle_curve, "interior": self.interior_curve, "exterior": self.exterior_curve}.items()
+        }
+        self.sector_doors = list(self.samples["middle"][self._doors(False)])
+        self.microsector_doors = list(self.samples["middle"][self._doors(True)])
 
     def colored_sectors_chart(self, info: list, microsectors: bool = False, laps: list = []) -> alt.Chart:
         """Charts the circuit layout with the sectors colored depending on the time performance
@@ -259,34 +354,8 @@ class CircuitChart(Circuit):
         if (not microsectors and len(info) != self.N_SECTORS) or (microsectors and len(info) != self.N_MICROSECTORS):
             raise ValueError(f"The number of {'microsectors' if microsectors else 'sectors'} info must be equal to the number {'microsectors' if microsectors else 'sectors'} of the circuit")
         
-        curve_options = {
-            "middle": self.middle_curve,
-            # "interior": self.interior_curve,
-            # "exterior": self.exterior_curve,
-        }
-
-        df = pd.DataFrame(columns=["x", "y", "sector", "index", "curve", "delta"])
-
-        for track_name, track in curve_options.items():
-            start = track.t[0]
-            end = track.t[-1]
-            precision = 1000
-            sectors = self.N_MICROSECTORS if microsectors else self.N_SECTORS
-            curve_df = pd.DataFrame(columns=["x", "y", "sector", "index"])
-
-            for i in range(sectors):
-                sector_start = start if i == 0 else end * i/sectors
-                sector_end = end * (i+1)/sectors
-                sector = np.linspace(sector_start, sector_end, num=precision//sectors)
-                gamma = track(sector)
-                sector_df = pd.DataFrame(gamma, columns=["x", "y"])
-                sector_df["index"] = sector_df.index
-                sector_df["sector"] = i + 1
-                sector_df["delta"] = info[i]
-                curve_df = pd.concat([curve_df, sector_df])
-
-            curve_df["curve"] = track_name
-            df = pd.concat([df, curve_df])
+        df = self._sectors_df(microsectors)
+        df["delta"] = np.asarray(info, dtype=object)[df["sector"].values - 1]
 
         if 'Best overall' in df["delta"].unique().tolist() or 'Personal best' in df["delta"].unique().tolist() or 'Other times' in df["delta"].unique().tolist():
             color=alt.Color(
@@ -336,39 +405,16 @@ class CircuitChart(Circuit):
         Returns:
             chart (alt.Chart) : the chart of the circuit layout with the turns
         """
-        track_name = "middle"
-        track = self.middle_curve
+        if not turns_json:
+            raise ValueError("There has to be at least one turn in the turns_json list")
         legend_values = [turn["name"] for turn in turns_json]
-        turns_json_queue = turns_json.copy()
 
-        df = pd.DataFrame(columns=["x", "y", "turn", "sector", "index", "curve"])
+        turns = np.full(self.N_MICROSECTORS, None, dtype=object)
+        for turn in turns_json:
+            turns[turn["first_ms"] - 1:turn["last_ms"]] = turn["name"]
 
-        start = track.t[0]
-        end = track.t[-1]
-        precision = 1000
-        curve_df = pd.DataFrame(columns=["x", "y", "turn", "sector", "index"])
-        if not turns_json_queue:
-            raise ValueError("There has to be at least one turn in the turns_json list")
-        current_turn = turns_json_queue.pop(0)
-
-        for i in range(self.N_MICROSECTORS):
-            sector_start = start if i == 0 else end * i/self.N_MICROSECTORS
-            sector_end = end * (i+1)/self.N_MICROSECTORS
-            sector = np.linspace(sector_start, sector_end, num=precision//self.N_MICROSECTORS)
-            gamma = track(sector)
-            sector_df = pd.DataFrame(gamma, columns=["x", "y"])
-            sector_df["index"] = sector_df.index
-            sector_df["sector"] = i + 1
-            if i + 1 >= current_turn["first_ms"] and i + 1 <= current_turn["last_ms"]:
-                sector_df["turn"] = current_turn["name"]
-            else:
-                sector_df["turn"] = None
-            if i + 1 == current_turn["last_ms"] and turns_json_queue:
-                    current_turn = turns_json_queue.pop(0)
-            curve_df = pd.concat([curve_df, sector_df])
-
-        curve_df["curve"] = track_name
-        df = pd.concat([df, curve_df])
+        df = self._sectors_df(microsectors=True)
+        df["turn"] = turns[df["sector"].values - 1]
 
         return alt.Chart(df).mark_line().encode(
             x=alt.X("x", axis=None),
@@ -385,4 +431,14 @@ class CircuitChart(Circuit):
             strokeOpacity=alt.value(0.5), 
         ).properties(
             title="Turns chart"
-        )
\ No newline at end of file
+        )
+
+
+# Circuits of the process, each one loaded once and shared by every caller (see shared_circuit)
+CIRCUITS = RunRegistry(lambda key: CircuitChart.load(*key), sizeof=lambda circuit: 0)
+
+def shared_circuit(seed: int, random_orientation: bool = False) -> CircuitChart:
+    """
+    The circuit of a TILK-E seed, shared within the process and loaded through the geometry cache (see CircuitChart.load).
+    """
+    return CIRCUITS.get((seed, random_orientation))
@@ -0,0 +1,104 @@
+import copy
+import numpy as np
+import pandas as pd
+
+from .lap import Lap
+
+
+class IdealLap:
+    def __init__(self, driver: str | None = None) -> None:
+        """
+        Theoretical best lap of a run, of a driver or overall if driver is None: the fastest time of every
+        microsector among the laps of the run, and a synthetic lap that stitches the telemetry of those microsectors.
+
+        Laps are taken into account incrementally with update, so when laps are added to the run only the
+        new ones are compared with the current bests.
+        """
+        self.driver = driver
+        self.microsector_times = np.array([], dtype=np.float64)
+        self.microsector_laps = np.array([], dtype=np.int64)
+        self.laps_done = 0
+        self.lap = None
+
+    @property
+    def laptime(self) -> float:
+        return float(np.nansum(self.microsector_times))
+
+    def update(self, laps: list[Lap]) -> bool:
+        """
+        Takes into account the laps of the run added since the last update, i.e. laps[self.laps_done:], where laps
+        are all the laps of the run indexed by their number.
+
+        output:
+            True if any microsector best changed, in which case the synthetic lap is rebuilt
+        """
+        new_laps = [lap for lap in laps[self.laps_done:] if self.driver is None or lap.driver == self.driver]
+        self.laps_done = len(laps)
+        if not new_laps:
+            return False
+
+        # The current bests are the first row, so they are kept on ties
+        times = [self.microsector_times] + [lap.microsector_times for lap in new_laps]
+        numbers = [self.microsector_laps] + [np.full(len(lap_times), lap.number) for lap, lap_times in zip(new_laps, times[1:])]
+        length = max(len(lap_times) for lap_times in times)
+        times_matrix = np.full((len(times), length), np.nan)
+        numbers_matrix = np.full((len(times), length), -1, dtype=np.int64)
+        for row, (lap_times, lap_numbers) in enumerate(zip(times, numbers)):
+            times_matrix[row, :len(lap_times)] = lap_times
+            numbers_matrix[row, :len(lap_numbers)] = lap_numbers
+
+        best = np.argmin(np.where(np.isnan(times_matrix), np.inf, times_matrix), axis=0)
+        columns = np.arange(length)
+        microsector_laps = numbers_matrix[best, columns]
+        if len(microsector_laps) == len(self.microsector_laps) and np.array_equal(microsector_laps, self.microsector_laps):
+            return False
+
+        self.microsector_times = times_matrix[best, columns]
+        self.microsector_laps = microsector_laps
+        self.lap = self._stitch(laps)
+        return True
+
+    def _stitch(self, laps: list[Lap]) -> Lap | None:
+        # Telemetry of every microsector taken from its best lap, the laps column keeps the lap each sample comes from
+        parts = []
+        for microsector, number in enumerate(self.microsector_laps, start=1):
+            if number >= 0:
+                lap_df = laps[number].df
+                parts.append(lap_df[lap_df['microsector'].values == microsector])
+        if not parts:
+            return None
+
+        df = pd.concat(parts, ignore_index=True)
+        # The microsectors come from different laps, so time runs on from the deltas of the stitched samples (as in
+        # Lap.cumulative_time), in seconds, for the harshness and the time axis of the synthetic lap
+        df['TimeStamp'] = np.concatenate([[0], np.cumsum(df['delta'].values[:-1], dtype=np.float64)]).astype(df['TimeStamp'].dtype)
+        lap = Lap(df, number=-1, filename='Theoretical best')
+        lap.driver = self.driver if self.driver is not None else 'All drivers'
+        lap.laptime = self.laptime
+        return lap
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory of the microsector bests and of the synthetic lap, whose telemetry is a copy of the best microsectors.
+        """
+        nbytes = self.microsector_times.nbytes + self.microsector_laps.nbytes
+        if self.lap is not None:
+            nbytes += int(self.lap.df.memory_usage(index=True, deep=True).sum()) + self.lap.nbytes
+        return nbytes
+
+    def copy(self) -> 'IdealLap':
+        return copy.copy(self)
+
+    def composition(self) -> pd.DataFrame:
+        """
+        Lap and time of every microsector of the theoretical best lap.
+        """
+        return pd.DataFrame({
+            'microsector': np.arange(1, len(self.microsector_laps) + 1),
+            'lap': self.microsector_laps,
+            'time': self.microsector_times,
+        })
+
+    def __repr__(self) -> str:
+        return f"[Theoretical best lap] -> {self.driver if self.driver is not None else 'All drivers'}: {self.laptime:.3f}s"
@@ -1,11 +1,50 @@
+import copy
 import numpy as np
 import pandas as pd
 import altair as alt
 import warnings
+from sklearn.neighbors import KDTree
 
+from .schema import cast_telemetry
+from .utils import POINT_BUDGET, SCATTER_BUDGET, downsample
 from .steering import Steering
 from .throttle import Throttle
 
+def lap_offsets(laps: np.ndarray) -> np.ndarray:
+    """
+    Returns the [start, end) offsets of the laps of a telemetry frame as an array of length n_laps + 1,
+    a lap being a run of consecutive rows with the same value in the laps column.
+    """
+    laps = np.asarray(laps)
+    if laps.size == 0:
+        return np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate([[True], laps[1:] != laps[:-1]]))
+    return np.append(starts, laps.size).astype(np.int64)
+
+def telemetry_frame(df: pd.DataFrame, columns: list[str], first_lap: int = 0) -> tuple[pd.DataFrame, np.ndarray]:
+    """
+    Builds the frame where a run stores its telemetry: a single copy of the given columns, with the rows of
+    each lap contiguous, the laps numbered consecutively from first_lap and TimeStamp and dist1 starting at 0 in every lap.
+    Columns are stored with the compact dtypes of the telemetry schema (see cast_telemetry).
+
+    output:
+        the telemetry frame
+        the [start, end) offsets of its laps
+    """
+    if not df['laps'].is_monotonic_increasing:
+        df = df.sort_values(by='laps', kind='stable')
+
+    offsets = lap_offsets(df['laps'].values)
+    starts, lengths = offsets[:-1], np.diff(offsets)
+
+    data = {column: df[column].values for column in columns}
+    data['laps'] = np.repeat(np.arange(first_lap, first_lap + len(lengths)), lengths)
+    if len(lengths):
+        for column in ['TimeStamp', 'dist1']:
+            data[column] = data[column] - np.repeat(np.minimum.reduceat(data[column], starts), lengths)
+
+    return pd.DataFrame(cast_telemetry(data), columns=columns), offsets
+
 class Lap:
 
     class Section:
@@ -20,27 +59,115 @@ class Lap:
             pass
 
     def __init__(self, df: pd.DataFrame, **kwargs) -> None:
+        """
+        A lap of a run. df holds the telemetry of the lap, usually a view of the telemetry frame of its run
+        (see telemetry_frame), and it is never modified.
+
+        The steering and throttle keyword arguments, if given, are passed to the Steering and Throttle of the lap.
+        """
         self.number = kwargs.get('number', -1)
         run_info = kwargs.get('info', {})
         self.filename = kwargs.get('filename', 'Unknown')
-        self.driver = run_info[self.filename].get('driver', 'Unknown')
+        file_info = run_info.get(self.filename, {})
+        self.driver = file_info.get('driver', 'Unknown')
 
         self.df = df
+        self._cumulative_time = None
+        self._position_trees = {}
 
         # Times
-        df['TimeStamp'] -= df['TimeStamp'].min()
-        self.laptime = run_info[self.filename]['laps'][str(self.number)]['laptime'] if self.number != -1 else None
+        # Laps of files not in info.json (e.g. streamed or live ones) are timed with their own deltas
+        lap_info = file_info.get('laps', {}).get(str(self.number))
+        self.laptime = None if self.number == -1 else lap_info['laptime'] if lap_info is not None else float(df['delta'].sum())
+        self._microsector_times = None if lap_info is None else lap_info.get('microsectors')
 
         # Controls
-        self.steering = Steering(df)
-        self.throttle = Throttle(df)
-
-        # Vector Nav
-        df['dist1'] -= df['dist1'].min()
+        self.steering = Steering(df, **kwargs.get('steering', {}))
+        self.throttle = Throttle(df, **kwargs.get('throttle', {}))
 
         # Lap sections
         self.set_lap_sections()
 
+    def rebased(self, df: pd.DataFrame, number: int) -> 'Lap':
+        """
+        Returns a copy of the lap with a new number that reads its telemetry from df, which must hold the same
+        samples (e.g. the same lap in the telemetry frame of a concatenated run). This lap is not modified.
+        """
+        lap = copy.copy(self)
+        lap.number = number
+        lap.df = df
+        lap.steering = self.steering.rebased(df)
+        lap.throttle = self.throttle.rebased(df)
+        return lap
+
+    @property
+    def cumulative_time(self) -> np.ndarray:
+        """
+        Time elapsed from the start of the lap to each sample, i.e. the sum of the deltas of the previous samples.
+        """
+        if self._cumulative_time is None:
+            self._cumulative_time = np.concatenate([[0], np.cumsum(self.df['delta'].values[:-1], dtype=np.float64)])
+        return self._cumulative_time
+
+    @property
+    def microsector_times(self) -> np.ndarray:
+        """
+        Time spent in each microsector, from info.json or, for laps not in it, from the deltas of the telemetry
+        (NaN for microsectors without samples).
+        """
+        if self._microsector_times is None:
+            microsectors = self.df['microsector'].values.astype(np.int64)
+            length = int(microsectors.max(initial=0)) + 1
+            times = np.bincount(microsectors, weights=self.df['delta'].values, minlength=length)[1:]
+            samples = np.bincount(microsectors, minlength=length)[1:]
+            self._microsector_times = np.where(samples > 0, times, np.nan)
+        return np.asarray(self._microsector_times, dtype=np.float64)
+
+    def position_tree(self, column: str | None = None, values: tuple = ()) -> tuple[KDTree, np.ndarray]:
+        """
+        Spatial index of the (xPosition, yPosition) samples of the lap, built the first time it is requested.
+
+        input:
+            column: if given, only the samples whose column value is in values are indexed (e.g. 'sector', (2,))
+            values: the values of column to index
+
+        output:
+            the KDTree of the samples
+            the positions in the lap of the indexed samples, to map the tree indices back to the lap
+        """
+        key = (column, tuple(values))
+        if key not in self._position_trees:
+            rows = np.arange(len(self.df)) if column is None else np.flatnonzero(np.isin(self.df[column].values, values))
+            self._position_trees[key] = (KDTree(self.df[['xPosition', 'yPosition']].values[rows]), rows)
+        return self._position_trees[key]
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory of the structures the lap builds from its telemetry (smoothed signals, cumulative time, spatial
+        indexes, ...), not of the telemetry itself, which is usually a view of the telemetry of its run.
+        """
+        arrays = [self._cumulative_time, self._microsector_times] + [rows for _, rows in self._position_trees.values()]
+        trees = [array for tree, _ in self._position_trees.values() for array in tree.get_arrays()]
+        return self.steering.nbytes + self.throttle.nbytes + sum(array.nbytes for array in arrays + trees if isinstance(array, np.ndarray))
+
+    def summary(self) -> dict:
+        """
+        Per-lap summary metrics.
+        """
+        return {
+            'lap': self.number,
+            'driver': self.driver,
+            'filename': self.filename,
+            'laptime': self.laptime,
+            'steering_harshness': self.steering.harshness,
+            'throttle_harshness': self.throttle.harshness,
+            'distance': float(self.df['dist1'].sum()),
+            'mean_velocity': float(self.df['Velocity'].mean()),
+            'max_velocity': float(self.df['Velocity'].max()),
+            'samples': len(self.df),
+        }
+
     def set_lap_sections(self) -> None:
         # Sectors
         self.sector_changing_points = self.decide_changing_points()
@@ -67,23 +194,25 @@ class Lap:
 
         for i, (_, row) in enumerate(self.df[column].items()):
             if previous is None or row != previous:
-                changing_points.append({'time': self.df['TimeStamp'][i], column: row})
+                changing_points.append({'time': self.df['TimeStamp'].iloc[i], column: row})
                 previous = row
 
         return pd.DataFrame(changing_points)
     
     # CHARTS
     
-    def gg_diagram(self, sector: int | tuple = None) -> alt.Chart:
+    def gg_diagram(self, sector: int | tuple = None, budget: int = SCATTER_BUDGET) -> alt.Chart:
         domain = np.max(np.abs(self.df[['VN_ax', 'VN_ay']].quantile([0.05, 0.95]).values.tolist()))
         microsectors = False
         if isinstance(sector, tuple):
             microsectors = True
             sector = list(range(sector[0], sector[-1] + 1))
         if sector is None:
-            chart = alt.Chart(self.df[::25])
+            df = self.df
         else:
-            chart = alt.Chart(self.df[self.df['sector'] == sector][::25]) if not microsectors else alt.Chart(self.df[self.df['microsector'].isin(sector)][::25])
+            df = self.df[self.df['sector'] == sector] if not microsectors else self.df[self.df['microsector'].isin(sector)]
+        # Only the columns of the chart are sent, and the extremes of both accelerations are kept, they are the edges of the diagram
+        chart = alt.Chart(downsample(df[['VN_ax', 'VN_ay', 'laps']], None, ['VN_ax', 'VN_ay'], budget=budget, method='minmax'))
 
         sector_title = f"- Microsector{f's {sector[0]} to {sector[-1]}' if len(sector)>1 else f' {sector[0]}'}" if microsectors else f'- Sector {sector}'
 
@@ -98,7 +227,10 @@ class Lap:
             # title=f"GG Diagram - Circuit: {self.filename.split('_')[0]} {sector_title if sector is not None else ''}"
         )
     
-    def racing_line_df(self, curve_name: str = 'middle', sector: int | tuple = None) -> pd.DataFrame:
+    def racing_line_df(self, curve_name: str = 'middle', sector: int | tuple = None, budget: int = POINT_BUDGET) -> pd.DataFrame:
+        """
+        Positions of the lap (or of a sector or microsectors range) to chart as a line, downsampled to budget points.
+        """
         microsectors = False
         if isinstance(sector, tuple):
             microsectors = True
@@ -120,8 +252,8 @@ class Lap:
             })
 
         df['curve'] = curve_name
-        df['index'] = df.index
-        return df
+        df['index'] = df.index - self.df.index[0]
+        return downsample(df, 'x', 'y', budget=budget)
 
     def __repr__(self) -> str:
         return f"[Lap {self.number}] -> {self.driver}"
\ No newline at end of file
@@ -0,0 +1,105 @@
+import io
+import os
+import time
+import threading
+import pandas as pd
+from os.path import basename, isfile
+from typing import Iterator
+
+from .lap import Lap
+from .run import Run
+
+
+class TelemetryTail:
+    def __init__(self, path: str, run: Run = None, info: dict = None, turns_json: list[dict] = None) -> None:
+        """
+        Follows a telemetry csv that is still being written (e.g. during a test day) and appends its new rows
+        to a Run with Run.append_rows.
+
+        Only complete lines are read, a partially written line is kept until it is finished. Every time a lap
+        is closed the per-lap metrics of the run (lap_summaries and, if turns_json is given, turn_metrics) are
+        extended with it.
+
+        input:
+            path: the csv file, it does not need to exist yet
+            run: the run the rows are appended to, a new empty one if None
+            info: the info of the run, used if run is None
+            turns_json: the turns of the circuit
+        """
+        self.path = path
+        self.run = Run(info=info, filename=basename(path)) if run is None else run
+        self.turns_json = turns_json
+
+        self._offset = 0
+        self._header = None
+        self._remainder = b''
+
+    def poll(self) -> list[Lap]:
+        """
+        Appends the rows written since the last poll to the run.
+
+        output:
+            the laps closed by the new rows
+        """
+        if not isfile(self.path):
+            return []
+        size = os.path.getsize(self.path)
+        if size < self._offset:
+            raise RuntimeError(f'{self.path} was truncated while it was being followed')
+        if size == self._offset:
+            return []
+
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = self._remainder + f.read(size - self._offset)
+        self._offset = size
+
+        lines_end = data.rfind(b'\n') + 1
+        lines, self._remainder = data[:lines_end], data[lines_end:]
+        if self._header is None:
+            if not lines:
+                return []
+            header_end = lines.index(b'\n') + 1
+            self._header, lines = lines[:header_end], lines[header_end:]
+        if not lines:
+            return []
+
+        closed = self.run.append_rows(pd.read_csv(io.BytesIO(self._header + lines)))
+        if closed:
+            self._update_metrics()
+        return closed
+
+    def finish(self) -> Lap | None:
+        """
+        Closes the lap in course, once the file is not going to be written anymore.
+        """
+        lap = self.run.close_lap()
+        if lap is not None:
+            self._update_metrics()
+        return lap
+
+    def follow(self, poll_interval: float = 0.5, idle_timeout: float | None = None, stop: threading.Event = None) -> Iterator[Lap]:
+        """
+        Polls the file every poll_interval seconds and yields the laps as they are closed.
+
+        It stops, closing the lap in course, when the file has not grown for idle_timeout seconds or when
+        the stop event is set. If neither is given it follows the file forever.
+        """
+        last_growth = time.monotonic()
+        while stop is None or not stop.is_set():
+            offset = self._offset
+            yield from self.poll()
+            if self._offset != offset:
+                last_growth = time.monotonic()
+            elif idle_timeout is not None and time.monotonic() - last_growth > idle_timeout:
+                break
+            time.sleep(poll_interval)
+
+        lap = self.finish()
+        if lap is not None:
+            yield lap
+
+    def _update_metrics(self) -> None:
+        self.run.lap_summaries()
+        if self.turns_json is not None:
+            self.run.turn_metrics(self.turns_json)
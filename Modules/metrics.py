@@ -0,0 +1,286 @@
+import sys
+import json
+import numpy as np
+import pandas as pd
+from typing import Callable
+
+from .utils import smooth_segments, segment_trapz
+from .spectral import sample_rate, segment_length, resample_uniform, welch_segments, band_power
+
+# Registered driver-input metrics, by name (see register_metric)
+METRICS = {}
+
+
+class Metric:
+    def __init__(self, name: str, columns: list[str], compute: Callable, title: str, params: dict) -> None:
+        """
+        A per-lap metric. compute(context, **params) returns the value of every lap of a MetricContext,
+        reading only the given telemetry columns. params are the default parameters.
+        """
+        self.name = name
+        self.columns = columns
+        self.compute = compute
+        self.title = title
+        self.params = params
+
+    def resolve(self, params: dict | None = None) -> dict:
+        """
+        The default parameters updated with params.
+        """
+        params = {} if params is None else params
+        unknown = set(params) - set(self.params)
+        if unknown:
+            raise ValueError(f"Unknown parameters for metric {self.name}: {sorted(unknown)}")
+        return {**self.params, **params}
+
+    def __repr__(self) -> str:
+        return f"Metric({self.name}, {self.columns}, {self.params})"
+
+
+def register_metric(name: str, columns: list[str], title: str | None = None, **params) -> Callable:
+    """
+    Decorator that registers a function compute(context, **params) -> np.ndarray as the metric name.
+    The keyword arguments are the default parameters of the metric.
+    """
+    def decorator(compute: Callable) -> Callable:
+        METRICS[name] = Metric(name, columns, compute, name.replace('_', ' ').capitalize() if title is None else title, params)
+        return compute
+    return decorator
+
+
+class MetricContext:
+    def __init__(self, arrays: dict[str, np.ndarray], offsets: np.ndarray, fs: float | None = None) -> None:
+        """
+        Telemetry of several laps, as contiguous column arrays and the [start, end) offsets of each lap, shared
+        by all the metrics evaluated together. Derived signals (e.g. smoothed ones) are computed once and reused.
+
+        fs is the sample rate the laps are resampled at for their spectra, usually the one of the whole run, so
+        the spectral metrics of a lap do not depend on the laps it is evaluated with. If None it is the nominal
+        sample rate of these laps.
+        """
+        self.arrays = arrays
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.fs = fs
+        self.n_laps = len(self.offsets) - 1
+        self._derived = {}
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, lap_offsets: np.ndarray, laps: list[int], columns: list[str], fs: float | None = None) -> 'MetricContext':
+        """
+        Context of the given laps (positions in lap_offsets) of a telemetry frame. All the laps are read without copies.
+        """
+        lap_offsets = np.asarray(lap_offsets, dtype=np.int64)
+        laps = np.asarray(laps, dtype=np.int64)
+        if np.array_equal(laps, np.arange(len(lap_offsets) - 1)):
+            return cls({column: df[column].values for column in columns}, lap_offsets, fs)
+
+        starts, ends = lap_offsets[laps], lap_offsets[laps + 1]
+        rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)]) if len(laps) else np.array([], dtype=np.int64)
+        return cls({column: df[column].values[rows] for column in columns}, np.concatenate([[0], np.cumsum(ends - starts)]), fs)
+
+    def _cached(self, key: tuple, build: Callable) -> np.ndarray:
+        if key not in self._derived:
+            self._derived[key] = build()
+        return self._derived[key]
+
+    def column(self, name: str) -> np.ndarray:
+        return self._cached(('column', name), lambda: np.asarray(self.arrays[name], dtype=np.float64))
+
+    def smoothed(self, name: str, window_len: int = 201, window: str = 'hamming') -> np.ndarray:
+        return self._cached(('smoothed', name, window_len, window), lambda: smooth_segments(self.column(name), self.offsets, window_len=window_len, window=window))
+
+    @property
+    def inside_pairs(self) -> np.ndarray:
+        """
+        Mask of the pairs of consecutive samples (i, i+1) that belong to the same lap.
+        """
+        def build():
+            inside = np.ones(max(self.offsets[-1] - 1, 0), dtype=bool)
+            inside[self.offsets[1:-1] - 1] = False
+            return inside
+        return self._cached(('inside_pairs',), build)
+
+    def lap_of(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Lap (position in the context) of each sample.
+        """
+        return np.searchsorted(self.offsets, samples, side='right') - 1
+
+    def lap_sum(self, values: np.ndarray) -> np.ndarray:
+        """
+        Sum of a per-sample (or, masked with inside_pairs, per-pair) array in every lap.
+        """
+        return np.bincount(self.lap_of(np.arange(len(values))), weights=values, minlength=self.n_laps)[:self.n_laps]
+
+    def lap_count(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Number of the given samples in every lap.
+        """
+        return np.bincount(self.lap_of(samples), minlength=self.n_laps)[:self.n_laps]
+
+    def duration(self) -> np.ndarray:
+        """
+        Duration of every lap, in seconds.
+        """
+        return self._cached(('duration',), lambda: self.lap_sum(self.column('delta')))
+
+    def harshness(self, name: str, scale: float = 1, window_len: int = 201, window: str = 'hamming') -> np.ndarray:
+        """
+        Integral over TimeStamp of the absolute difference between a signal and its smoothed version, divided by scale.
+        """
+        difference = np.abs(self.column(name) - self.smoothed(name, window_len, window)) / scale
+        return segment_trapz(difference, self.column('TimeStamp'), self.offsets)
+
+    def spectrum(self, name: str, segment: float = 2.0, fs: float | None = None) -> tuple[np.ndarray]:
+        """
+        Welch spectral density of a signal in every lap, resampled at fs Hz (the sample rate of the context if None)
+        with windows of segment seconds (see Modules.spectral).
+
+        output:
+            the frequencies, in Hz
+            the spectral density of every lap, a row per lap
+        """
+        def build():
+            rate = fs if fs is not None else self.fs if self.fs is not None else sample_rate(self.column('delta'))
+            resampled, offsets = resample_uniform(self.column(name), self.column('delta'), self.offsets, rate)
+            return welch_segments(resampled, offsets, rate, nperseg=segment_length(segment, rate))
+        return self._cached(('spectrum', name, segment, fs), build)
+
+
+class MetricEngine:
+    def __init__(self, registry: dict = METRICS) -> None:
+        """
+        Evaluates registered metrics on the laps of a telemetry frame. Values are cached per (lap, metric, parameters),
+        and the laps and metrics not cached yet are evaluated together over a single MetricContext.
+        """
+        self.registry = registry
+        self._values = {}
+
+    @staticmethod
+    def _params_key(params: dict) -> str:
+        return json.dumps(params, sort_keys=True)
+
+    def store(self, name: str, laps: list[int], values: np.ndarray, params: dict | None = None) -> None:
+        """
+        Caches values of a metric computed elsewhere (e.g. harshness computed while building the laps).
+        """
+        key = self._params_key(self.registry[name].resolve(params))
+        for lap, value in zip(laps, values):
+            self._values[(lap, name, key)] = float(value)
+
+    def evaluate(self, df: pd.DataFrame, lap_offsets: np.ndarray, laps: list[int], metrics: list[str], params: dict[str, dict] | None = None, fs: float | None = None) -> pd.DataFrame:
+        """
+        Values of metrics for the given laps (positions in lap_offsets) of df.
+
+        input:
+            df: the telemetry frame
+            lap_offsets: the [start, end) offsets of its laps
+            laps: the laps to evaluate
+            metrics: the names of the metrics
+            params: the parameters of each metric, {metric name: {parameter: value}}, defaults if not given
+            fs: the sample rate of the spectral metrics (see MetricContext), which must not change between calls
+
+        output:
+            a dataframe indexed by lap with a column per metric
+        """
+        params = {} if params is None else params
+        unknown = [name for name in metrics if name not in self.registry]
+        if unknown:
+            raise ValueError(f"Unknown metrics: {unknown}. Registered metrics are {list(self.registry)}")
+        resolved = {name: self.registry[name].resolve(params.get(name)) for name in metrics}
+        keys = {name: self._params_key(metric_params) for name, metric_params in resolved.items()}
+
+        missing = {name: [lap for lap in laps if (lap, name, keys[name]) not in self._values] for name in metrics}
+        missing_laps = sorted(set(lap for name_laps in missing.values() for lap in name_laps))
+        if missing_laps:
+            missing_metrics = [name for name in metrics if missing[name]]
+            columns = sorted(set(column for name in missing_metrics for column in self.registry[name].columns))
+            context = MetricContext.from_frame(df, lap_offsets, missing_laps, columns, fs)
+            for name in missing_metrics:
+                values = self.registry[name].compute(context, **resolved[name])
+                for lap, value in zip(missing_laps, values):
+                    self._values[(lap, name, keys[name])] = float(value)
+
+        return pd.DataFrame(
+            {name: [self._values[(lap, name, keys[name])] for lap in laps] for name in metrics},
+            index=pd.Index(laps, name='lap')
+        )
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Approximate memory of the cached values, i.e. of the cache entries.
+        """
+        return sys.getsizeof(self._values) + sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in list(self._values.items()))
+
+
+@register_metric('steering_harshness', ['Steering', 'TimeStamp'], title='Steering harshness', window_len=201, window='hamming')
+def steering_harshness(context: MetricContext, window_len: int, window: str) -> np.ndarray:
+    return context.harshness('Steering', window_len=window_len, window=window)
+
+@register_metric('throttle_harshness', ['Throttle', 'TimeStamp'], title='Throttle harshness', window_len=201, window='hamming')
+def throttle_harshness(context: MetricContext, window_len: int, window: str) -> np.ndarray:
+    return context.harshness('Throttle', scale=100, window_len=window_len, window=window)
+
+@register_metric('brake_harshness', ['BPE', 'TimeStamp'], title='Brake harshness', window_len=201, window='hamming')
+def brake_harshness(context: MetricContext, window_len: int, window: str) -> np.ndarray:
+    return context.harshness('BPE', window_len=window_len, window=window)
+
+@register_metric('steering_reversal_rate', ['Steering', 'delta'], title='Steering reversals per minute', window_len=51, window='hamming', gap=0.005)
+def steering_reversal_rate(context: MetricContext, window_len: int, window: str, gap: float) -> np.ndarray:
+    """
+    Number of changes of direction of the (smoothed) steering per minute, counting only the ones where the steering
+    moved at least gap radians since the previous change of direction (or the start of the lap).
+    """
+    steering = context.smoothed('Steering', window_len, window)
+    difference = np.diff(steering)
+    moving = np.flatnonzero(context.inside_pairs & (difference != 0))
+    direction = np.sign(difference[moving])
+    moving_lap = context.lap_of(moving)
+    changes = moving[1:][(direction[1:] != direction[:-1]) & (moving_lap[1:] == moving_lap[:-1])]
+
+    changes_lap = context.lap_of(changes)
+    first_of_lap = np.concatenate([[True], changes_lap[1:] != changes_lap[:-1]])
+    previous = np.where(first_of_lap, steering[context.offsets[changes_lap]], steering[np.concatenate([[0], changes[:-1]])])
+    reversals = context.lap_count(changes[np.abs(steering[changes] - previous) >= gap])
+    duration = context.duration()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(duration > 0, reversals / (duration / 60), np.nan)
+
+@register_metric('throttle_lift_count', ['Throttle'], title='Throttle lifts', threshold=0.1)
+def throttle_lift_count(context: MetricContext, threshold: float) -> np.ndarray:
+    """
+    Number of times the throttle drops below threshold (in the units of the Throttle column, 0 to 1 in the
+    bundled data) during the lap.
+    """
+    above = context.column('Throttle') >= threshold
+    lifts = np.flatnonzero(context.inside_pairs & above[:-1] & ~above[1:])
+    return context.lap_count(lifts).astype(np.float64)
+
+@register_metric('jerk', ['VN_ax', 'VN_ay', 'delta'], title='Mean jerk [m/s³]')
+def jerk(context: MetricContext) -> np.ndarray:
+    """
+    Mean magnitude of the rate of change of the acceleration.
+    """
+    delta = context.column('delta')[1:]
+    valid = context.inside_pairs & (delta > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitude = np.where(valid, np.hypot(np.diff(context.column('VN_ax')), np.diff(context.column('VN_ay'))) / delta, 0)
+    counts = context.lap_sum(valid.astype(np.float64))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, context.lap_sum(magnitude) / counts, np.nan)
+
+@register_metric('steering_high_frequency_power', ['Steering', 'delta'], title='Steering power above 2 Hz [rad²]', low=2.0, high=None, segment=2.0)
+def steering_high_frequency_power(context: MetricContext, low: float, high: float | None, segment: float) -> np.ndarray:
+    """
+    Power of the steering between low and high Hz (up to the Nyquist frequency if None): small, fast corrections
+    rather than the steering that follows the track.
+    """
+    return band_power(*context.spectrum('Steering', segment), low, high)
+
+@register_metric('throttle_high_frequency_power', ['Throttle', 'delta'], title='Throttle power above 2 Hz', low=2.0, high=None, segment=2.0)
+def throttle_high_frequency_power(context: MetricContext, low: float, high: float | None, segment: float) -> np.ndarray:
+    return band_power(*context.spectrum('Throttle', segment), low, high)
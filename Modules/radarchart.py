@@ -7,7 +7,7 @@ COLORS = [ # tableau 10
 
 # COLORS = [ # tableau 20
 #     '#4E79A7', '#A0CBE8', '#F28E2B', '#FFBE7D', '#59A14F', '#8CD17D', '#B6992D', '#F1CE63', '#499894', '#86BCB6',
-#     '#E15759', '#FF9D9A', '#79706E', '#BAB0AC', '#D37295', '#FABFD2', '#B07AA1', '#D4A6C8', '#9D7660', '#D7B5A6'] 
+#     '#E15759', '#FF9D9A', '#79706E', '#BAB0AC', '#D37295', '#FABFD2', '#B07AA1', '#D4A6C8', '#9D7660', '#D7B5A6']
 
 class RadarChart:
     def __init__(self, df: pd.DataFrame, n_ticks: int, **kwargs):
@@ -19,6 +19,9 @@ class RadarChart:
          - axis_name: the name of the axis
          - metric: the value of the metric
          - line: the id of the line starting from 0
+
+        The coordinates of every element (background, tick rings, axis lines, labels and lines) are computed
+        once, in a single dataset (see geometry), shared by the few layers of the chart.
         """
         self.df = df
         self.n_ticks = n_ticks
@@ -32,166 +35,127 @@ class RadarChart:
         self.max_value = int(self.df.metric.max()*1.05)
         self.min_value = int(self.df.metric.min()*0.95)
 
-        self._add_line_closing()
-        self._add_axis_ticks()
-        self._add_trigonometric_coordinates()
-        self.df.reset_index(drop=True, inplace=True)
-
-        self._background = self._background_chart()
-        self._axis = self._axis_chart()
-        self._radars = self._radars_chart()
-
-        self.chart = (self._background + self._radars + self._axis).properties(
+        self.geometry = self._geometry()
+        self.chart = alt.layer(
+            self._background_gray(),
+            self._background_lines(),
+            self._radars_chart(),
+            self._axis_lines(),
+            self._axis_labels(),
+            self._axis_ticks(),
+            data=self.geometry
+        ).properties(
             width=self.width,
             height=self.height
         )
 
-    def _add_line_closing(self):
+    def _angles(self, axis: np.ndarray) -> tuple[np.ndarray]:
         """
-        Add a closing point to each line.
+        cos and sin of the direction of each axis, the first one pointing up and the rest clockwise.
         """
-        aux = self.df[self.df['axis'] == 0].copy()
-        aux['axis'] = self.n_axis
-        self.df = pd.concat([self.df, aux])
+        angle = -np.asarray(axis, dtype=np.float64) * 2 * np.pi / self.n_axis + np.pi / 2
+        return np.cos(angle), np.sin(angle)
 
-    def _add_axis_ticks(self):
+    def _geometry(self) -> pd.DataFrame:
         """
-        Add axis ticks to the dataframe.
+        Dataset of the chart, a row per point. kind is the element a point belongs to, group the polygon or
+        segment within it (the line, the tick ring or the axis) and order the position of the point in it.
         """
-        json = []
-        for i in [self.min_value + (i * (self.max_value - self.min_value) / self.n_ticks) for i in range(0, self.n_ticks + 1)]:
-            json.append({
-                'axis': 0,
-                'axis_name': self.df['axis_name'].iloc[0],
-                'metric': round(i),
-                'line': -1})
-        self.df = pd.concat([self.df, pd.DataFrame(json)])
-
-    def _add_trigonometric_coordinates(self):
-        """
-        Add trigonometric coordinates to the dataframe.
-        """
-        self.df['sin'] = [np.sin(((-x) * 2 * np.pi / self.n_axis) + np.pi / 2) for x in self.df.axis]
-        self.df['cos'] = [np.cos(((-x) * 2 * np.pi / self.n_axis) + np.pi / 2) for x in self.df.axis]
+        radius = self.max_value - self.min_value
+        axes = np.arange(self.n_axis)
+        # Polygons go around every axis and back to the first one
+        closed = np.append(axes, self.n_axis)
+        cos, sin = self._angles(closed)
+        parts = []
+
+        def part(kind, x, y, group=0, order=0, text='', metric=np.nan, line=-1):
+            n = len(x)
+            parts.append(pd.DataFrame({
+                'kind': kind, 'x': x, 'y': y,
+                'group': np.broadcast_to(group, n), 'order': np.broadcast_to(order, n),
+                'text': np.broadcast_to(np.asarray(text, dtype=object), n),
+                'metric': np.broadcast_to(metric, n).astype(np.float64), 'line': np.broadcast_to(line, n),
+            }))
+
+        part('background', radius * cos, radius * sin, order=closed)
+
+        rings = np.arange(1, self.n_ticks + 1) * radius / self.n_ticks
+        part('ring', np.outer(rings, cos).ravel(), np.outer(rings, sin).ravel(),
+             group=np.repeat(np.arange(len(rings)), len(closed)), order=np.tile(closed, len(rings)))
+
+        axis_cos, axis_sin = cos[:-1], sin[:-1]
+        part('axis', np.column_stack([np.zeros(self.n_axis), radius * axis_cos]).ravel(), np.column_stack([np.zeros(self.n_axis), radius * axis_sin]).ravel(),
+             group=np.repeat(axes, 2), order=np.tile([0, 1], self.n_axis))
+
+        names = self.df.drop_duplicates('axis').set_index('axis')['axis_name'].reindex(axes).astype(str).values
+        part('label', (radius * axis_cos + axis_cos) * 1.1, (radius * axis_sin + axis_sin) * 1.1, order=axes, text=names)
+
+        ticks = np.round(self.min_value + np.arange(self.n_ticks + 1) * radius / self.n_ticks)
+        part('tick', (ticks - self.min_value) * cos[0] + 0.1 * radius, (ticks - self.min_value) * sin[0],
+             text=[str(int(tick)) for tick in ticks], metric=ticks)
+
+        # A row per (line, axis) and the first axis again to close each line
+        lines = self.df.sort_values(['line', 'axis'], kind='stable')
+        lines = pd.concat([lines, lines[lines['axis'] == 0].assign(axis=self.n_axis)]).sort_values(['line', 'axis'], kind='stable')
+        line_cos, line_sin = self._angles(lines['axis'].values)
+        offset = lines['metric'].values - self.min_value
+        part('radar', offset * line_cos, offset * line_sin, group=lines['line'].values, order=lines['axis'].values,
+             metric=lines['metric'].values, line=lines['line'].values)
+
+        geometry = pd.concat(parts, ignore_index=True)
+        geometry[['x', 'y']] = geometry[['x', 'y']].round(4)
+        return geometry
+
+    @staticmethod
+    def _kind(kind: str) -> alt.Chart:
+        return alt.Chart().transform_filter(alt.datum.kind == kind)
+
+    @staticmethod
+    def _position() -> dict:
+        return {'x': alt.X('x:Q', axis=None), 'y': alt.Y('y:Q', axis=None)}
 
-    def _background_chart(self):
-        return self._background_gray() + self._background_lines()
-    
     def _background_gray(self):
-        return alt.Chart(self.df).transform_filter(
-            (alt.datum.line == self.line_min)
-        ).transform_calculate(
-            dx=(self.max_value - self.min_value) * alt.datum.cos,
-            dy=(self.max_value - self.min_value) * alt.datum.sin
-        ).mark_line(strokeWidth=0, fillOpacity=0.1, fill='gray').encode(
-            x=alt.X("dx:Q", axis=None),
-            y=alt.Y("dy:Q", axis=None),
-            order="axis:Q",
+        return self._kind('background').mark_line(strokeWidth=0, fillOpacity=0.1, fill='gray').encode(
+            **self._position(),
+            order='order:Q',
             tooltip=alt.value(None)
-        ).properties(
-            width=self.width,
-            height=self.height
         )
-    
+
     def _background_lines(self):
-        lines = alt.LayerChart()
-
-        for i in [i * (self.max_value - self.min_value) / self.n_ticks for i in range(1, self.n_ticks + 1)]:
-            lines += alt.Chart(self.df).transform_filter(
-                (alt.datum.line == self.line_min)
-            ).transform_calculate(
-                dx= i * alt.datum.cos,
-                dy= i * alt.datum.sin
-            ).mark_line(strokeDash=[5, 5], strokeWidth=1, strokeOpacity=0.5, color='gray').encode(
-                x=alt.X("dx:Q", axis=None),
-                y=alt.Y("dy:Q", axis=None),
-                order="axis:Q",
-                tooltip=alt.value(None)
-            ).properties(
-                width=self.width,
-                height=self.height
-            )
-            
-        return lines
-    
-    def _axis_chart(self):
-        return self._axis_lines() + self._axis_labels() + self._axis_ticks()
-    
+        return self._kind('ring').mark_line(strokeDash=[5, 5], strokeWidth=1, strokeOpacity=0.5, color='gray').encode(
+            **self._position(),
+            detail='group:N',
+            order='order:Q',
+            tooltip=alt.value(None)
+        )
+
     def _axis_lines(self):
-        radii = alt.LayerChart()
-
-        for axis in range(self.n_axis):
-            radii += alt.Chart(self.df).transform_filter(
-                (alt.datum.line == self.line_min)
-            ).transform_calculate(
-                dx=(alt.datum.axis == axis) * ((self.max_value - self.min_value) * alt.datum.cos),
-                dy=(alt.datum.axis == axis) * ((self.max_value - self.min_value) * alt.datum.sin)
-            ).mark_line(strokeWidth=1, strokeOpacity = 0.5, color="black").encode(
-                x=alt.X("dx:Q", axis=None),
-                y=alt.Y("dy:Q", axis=None),
-                order="axis:Q",
-                tooltip=alt.value(None)
-            ).properties(
-                width=self.width,
-                height=self.height
-            )
-        return radii
+        return self._kind('axis').mark_line(strokeWidth=1, strokeOpacity=0.5, color='black').encode(
+            **self._position(),
+            detail='group:N',
+            order='order:Q',
+            tooltip=alt.value(None)
+        )
 
     def _axis_ticks(self):
-        return alt.Chart(self.df).transform_filter(
-            (alt.datum.line == -1) 
-        ).transform_calculate(
-            dx=(alt.datum.metric - self.min_value) * alt.datum.cos + 0.1 * (self.max_value - self.min_value),
-            dy=(alt.datum.metric - self.min_value) * alt.datum.sin,
-            text=alt.datum.metric
-        ).mark_text(fontStyle="bold", color="black").encode(
-            x=alt.X("dx:Q", axis=None),
-            y=alt.Y("dy:Q", axis=None),
-            order="axis:Q",
-            text="metric:Q",
+        return self._kind('tick').mark_text(fontStyle='bold', color='black').encode(
+            **self._position(),
+            text='text:N',
             tooltip=alt.value(None)
-        ).properties(
-            width=self.width,
-            height=self.height
         )
-    
+
     def _axis_labels(self):
-        return alt.Chart(self.df).transform_filter(
-            (alt.datum.line == self.line_min) 
-        ).transform_calculate(
-            dx=((self.max_value - self.min_value) * alt.datum.cos + alt.datum.cos) * 1.1,
-            dy=((self.max_value - self.min_value) * alt.datum.sin + alt.datum.sin) * 1.1,
-            text=alt.datum.axis
-        ).mark_text(fontStyle="bold").encode(
-            x=alt.X("dx:Q", axis=None),
-            y=alt.Y("dy:Q", axis=None),
-            order="axis:Q",
-            text="axis_name",
+        return self._kind('label').mark_text(fontStyle='bold').encode(
+            **self._position(),
+            text='text:N',
             tooltip=alt.value(None)
-        ).properties(
-            width=self.width,
-            height=self.height
         )
-    
-    def _radar_chart(self, line: int, color: int) -> alt.Chart:
-        return alt.Chart(self.df).transform_filter(
-            (alt.datum.line == line)
-        ).transform_calculate(
-            dx=(alt.datum.metric - self.min_value) * alt.datum.cos,
-            dy=(alt.datum.metric - self.min_value) * alt.datum.sin,
-        ).mark_line(strokeWidth=2, strokeOpacity=1, color=COLORS[color]).encode(
-            x=alt.X("dx:Q", axis=None),
-            y=alt.Y("dy:Q", axis=None),
-            order="axis",
-            tooltip=alt.Tooltip(["metric:Q", "line:N"])
-        ).properties(
-            width=self.width,
-            height=self.height
-        )
-    
-    def _radars_chart(self):
-        radars = alt.layer()
-        for i, line in enumerate(self.n_lines):
-            radars += self._radar_chart(line, color=i)
 
-        return radars
+    def _radars_chart(self):
+        return self._kind('radar').mark_line(strokeWidth=2, strokeOpacity=1).encode(
+            **self._position(),
+            color=alt.Color('group:N', scale=alt.Scale(domain=self.n_lines.tolist(), range=COLORS[:len(self.n_lines)]), legend=None),
+            detail='group:N',
+            order='order:Q',
+            tooltip=[alt.Tooltip('metric:Q'), alt.Tooltip('line:N')]
+        )
@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+def run_nbytes(run) -> int:
+    """
+    Approximate resident size of a Run: its telemetry frame, which laps are views of, and its caches
+    (see Run.memory_usage).
+    """
+    return int(run.memory_usage().sum())
+
+
+class RunRegistry:
+    def __init__(self, loader: Callable[[Hashable], Any], max_entries: int | None = None, max_bytes: int | None = None, sizeof: Callable[[Any], int] = run_nbytes) -> None:
+        """
+        Lazily populated registry of runs.
+
+        A run is built with loader(key) the first time it is requested and kept in memory afterwards.
+        When there are more than max_entries runs, or they take more than max_bytes, the least recently
+        used ones are evicted. The most recently requested run is never evicted, even if it alone exceeds
+        max_bytes. Runs grow as their caches are used, so the runs kept are measured again every time a run
+        is loaded.
+
+        The registry is thread safe, and a run requested by several threads at the same time is only built once.
+        """
+        if max_entries is not None and max_entries < 1:
+            raise ValueError('max_entries must be at least 1')
+        self.loader = loader
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self._runs = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._loading_locks = {}
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            if key in self._runs:
+                self._runs.move_to_end(key)
+                return self._runs[key]
+            loading_lock = self._loading_locks.setdefault(key, threading.Lock())
+
+        with loading_lock:
+            with self._lock:
+                if key in self._runs:
+                    self._runs.move_to_end(key)
+                    return self._runs[key]
+
+            try:
+                run = self.loader(key)
+                size = self.sizeof(run)
+                with self._lock:
+                    kept = list(self._runs.items())
+                sizes = {kept_key: self.sizeof(kept_run) for kept_key, kept_run in kept}
+
+                with self._lock:
+                    # Runs evicted while they were measured are not added back
+                    self._sizes.update({kept_key: kept_size for kept_key, kept_size in sizes.items() if kept_key in self._runs})
+                    self._runs[key] = run
+                    self._sizes[key] = size
+                    self._evict()
+            finally:
+                # Also when the loader fails, so a key that can not be loaded does not keep its lock forever
+                with self._lock:
+                    if self._loading_locks.get(key) is loading_lock:
+                        del self._loading_locks[key]
+        return run
+
+    def _evict(self) -> None:
+        while len(self._runs) > 1 and (
+            (self.max_entries is not None and len(self._runs) > self.max_entries)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            key, _ = self._runs.popitem(last=False)
+            del self._sizes[key]
+
+    def evict(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._runs:
+                del self._runs[key]
+                del self._sizes[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._runs.clear()
+            self._sizes.clear()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._runs
+
+    def __len__(self) -> int:
+        return len(self._runs)
+
+    def __repr__(self) -> str:
+        return f"RunRegistry({list(self._runs.keys())}, {self.nbytes / 2**20:.1f} MiB)"
@@ -0,0 +1,182 @@
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from tilke import Spline
+
+# Channels resampled onto the distance grid. 'time' is the time elapsed from the start of the lap.
+GRID_CHANNELS = ['time', 'Velocity', 'Throttle', 'BPE', 'Steering', 'VN_ax', 'VN_ay']
+
+
+class TrackProjection:
+    def __init__(self, spline: Spline, precision: int = 5000) -> None:
+        """
+        Arc length parametrisation of a closed curve (e.g. the middle curve of a circuit), sampled at precision points,
+        to project positions onto it.
+        """
+        self.points = spline(np.linspace(spline.t[0], spline.t[-1], precision))
+        segments = np.diff(self.points, axis=0)
+        self.segment_lengths = np.hypot(segments[:, 0], segments[:, 1])
+        self.arc_length = np.concatenate([[0], np.cumsum(self.segment_lengths)])
+        self.length = float(self.arc_length[-1])
+        self._tree = cKDTree(self.points)
+
+    def project(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Arc length of the point of the curve nearest to each position, projecting the positions on the two
+        segments around their nearest sampled point.
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        nearest = self._tree.query(positions, workers=-1)[1]
+
+        best_s = np.full(len(positions), np.nan)
+        best_d = np.full(len(positions), np.inf)
+        for segment in [np.maximum(nearest - 1, 0), np.minimum(nearest, len(self.segment_lengths) - 1)]:
+            a, b = self.points[segment], self.points[segment + 1]
+            ab = b - a
+            u = np.clip(np.einsum('ij,ij->i', positions - a, ab) / np.maximum(np.einsum('ij,ij->i', ab, ab), 1e-12), 0, 1)
+            d = np.linalg.norm(a + u[:, None] * ab - positions, axis=1)
+            better = d < best_d
+            best_s[better] = self.arc_length[segment[better]] + u[better] * self.segment_lengths[segment[better]]
+            best_d[better] = d[better]
+        return best_s
+
+    @property
+    def nbytes(self) -> int:
+        return self.points.nbytes + self.segment_lengths.nbytes + self.arc_length.nbytes + self._tree.data.nbytes + self._tree.indices.nbytes
+
+    def lap_distance(self, positions: np.ndarray | None = None, projected: np.ndarray | None = None) -> np.ndarray:
+        """
+        Distance along the curve covered by a lap at each of its positions (or of its already projected positions).
+
+        The projections are unwrapped across the finish line, so the samples of a lap that starts just before
+        it get small negative distances instead of jumping to the end of the track, and the result is made
+        non decreasing so it can be used to interpolate the lap.
+        """
+        s = self.project(positions) if projected is None else projected
+        if not len(s):
+            return s
+        steps = np.diff(s)
+        steps = steps - self.length * np.round(steps / self.length)
+        distance = s[0] + np.concatenate([[0], np.cumsum(steps)])
+        if s[0] > self.length / 2:
+            distance -= self.length
+        return np.maximum.accumulate(distance)
+
+
+def curve_fingerprint(spline: Spline, samples: int = 64) -> str:
+    """
+    Identifies a curve by a few of its points, so grids computed for equal circuits (e.g. rebuilt for every
+    request) are shared.
+    """
+    points = np.round(spline(np.linspace(spline.t[0], spline.t[-1], samples)), 6)
+    return hashlib.sha1(np.ascontiguousarray(points, dtype=np.float64).tobytes()).hexdigest()
+
+
+class DistanceGrid:
+    def __init__(self, distance: np.ndarray, laps: list[int], drivers: list[str], laptimes: list[float], channels: dict[str, np.ndarray], length: float) -> None:
+        """
+        Laps resampled onto a common distance grid.
+
+        distance holds the grid, in meters along the middle curve, and every channel is a matrix with a row per
+        lap (in the order of laps) and a column per grid point. Points of the grid a lap does not reach are NaN.
+        """
+        self.distance = distance
+        self.laps = list(laps)
+        self.drivers = list(drivers)
+        self.laptimes = list(laptimes)
+        self.channels = channels
+        self.length = length
+
+    @classmethod
+    def from_laps(cls, laps: list, projection: TrackProjection, resolution: float = 1.0) -> 'DistanceGrid':
+        """
+        Resamples laps onto a grid with a point every resolution meters of the curve of projection.
+
+        Only anchor samples, a quarter of resolution apart along the distance covered by each lap (cumulative dist1),
+        are projected onto the curve (all the laps at once), the rest of samples are placed between them.
+        """
+        if resolution <= 0:
+            raise ValueError('resolution must be positive')
+        distance = np.arange(0, projection.length, resolution)
+        channels = {channel: np.full((len(laps), len(distance)), np.nan) for channel in GRID_CHANNELS}
+
+        odometers, anchors = [], []
+        for lap in laps:
+            odometer = np.cumsum(lap.df['dist1'].values)
+            step = np.floor(odometer / (resolution / 4))
+            odometers.append(odometer)
+            anchors.append(np.flatnonzero(np.concatenate([[True], step[1:] != step[:-1]])) if len(odometer) else np.array([], dtype=np.int64))
+        positions = [lap.df[['xPosition', 'yPosition']].values[lap_anchors] for lap, lap_anchors in zip(laps, anchors)]
+        projected = projection.project(np.concatenate(positions)) if laps else np.array([])
+        projected = np.split(projected, np.cumsum([len(lap_anchors) for lap_anchors in anchors])[:-1])
+
+        for row, (lap, odometer, lap_anchors, lap_projected) in enumerate(zip(laps, odometers, anchors, projected)):
+            if not len(lap_anchors):
+                continue
+            lap_distance = np.interp(odometer, odometer[lap_anchors], projection.lap_distance(projected=lap_projected))
+            for channel in GRID_CHANNELS:
+                values = lap.cumulative_time if channel == 'time' else lap.df[channel].values.astype(np.float64)
+                channels[channel][row] = np.interp(distance, lap_distance, values, left=np.nan, right=np.nan)
+        return cls(distance, [lap.number for lap in laps], [lap.driver for lap in laps], [lap.laptime for lap in laps], channels, projection.length)
+
+    @property
+    def nbytes(self) -> int:
+        return self.distance.nbytes + sum(channel.nbytes for channel in self.channels.values())
+
+    def extend(self, other: 'DistanceGrid') -> 'DistanceGrid':
+        """
+        Grid with the laps of this one followed by the laps of other, which must share its distance grid.
+        """
+        if len(other.distance) != len(self.distance):
+            raise ValueError('Grids with different distances can not be joined')
+        channels = {channel: np.vstack([self.channels[channel], other.channels[channel]]) for channel in self.channels}
+        return DistanceGrid(self.distance, self.laps + other.laps, self.drivers + other.drivers, self.laptimes + other.laptimes, channels, self.length)
+
+    def __getitem__(self, channel: str) -> np.ndarray:
+        return self.channels[channel]
+
+    def rows(self, laps: list[int]) -> np.ndarray:
+        """
+        Rows of the given lap numbers.
+        """
+        positions = {lap: row for row, lap in enumerate(self.laps)}
+        return np.array([positions[lap] for lap in laps], dtype=np.int64)
+
+    def columns(self, start: float = 0, end: float | None = None) -> slice:
+        """
+        Columns of the grid points between start and end meters, e.g. of a sector.
+        """
+        end = self.length if end is None else end
+        return slice(int(np.searchsorted(self.distance, start)), int(np.searchsorted(self.distance, end)))
+
+    def delta(self, laps: list[int] | None = None, reference: int | None = None, channel: str = 'time') -> np.ndarray:
+        """
+        Difference of channel between the given laps (all by default) and the reference lap (the fastest by default)
+        at every point of the grid, a row per lap.
+        """
+        rows = np.arange(len(self.laps)) if laps is None else self.rows(laps)
+        if reference is None:
+            reference_row = int(np.argmin(self.laptimes))
+        else:
+            reference_row = self.rows([reference])[0]
+        return self.channels[channel][rows] - self.channels[channel][reference_row]
+
+    def driver_means(self, channel: str) -> pd.DataFrame:
+        """
+        Average of channel over the laps of each driver at every point of the grid, a row per driver.
+        """
+        df = pd.DataFrame(self.channels[channel], columns=self.distance)
+        return df.groupby(np.array(self.drivers)).mean()
+
+    def to_frame(self, channel: str) -> pd.DataFrame:
+        """
+        channel in long format, with a row per (lap, distance).
+        """
+        return pd.DataFrame({
+            'lap': np.repeat(self.laps, len(self.distance)),
+            'driver': np.repeat(self.drivers, len(self.distance)),
+            'distance': np.tile(self.distance, len(self.laps)),
+            channel: self.channels[channel].ravel(),
+        })
@@ -1,100 +1,523 @@
+import os
+import json
+import uuid
 import pandas as pd
 import altair as alt
 import numpy as np
-from os.path import basename
-from sklearn.neighbors import KDTree
+from os import listdir
+from os.path import basename, join, isfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 from tilke import Circuit
 
-from .lap import Lap
-from .braking import get_braking_stats
+from .lap import Lap, lap_offsets, telemetry_frame
+from .schema import TELEMETRY_SCHEMA
+from .stream import iter_lap_frames
+from .utils import read_csv_cached, segment_harshness, downsample, POINT_BUDGET, shared_dataset, layer_rows
+from .braking import turn_metrics, select_braking_stats
+from .resample import DistanceGrid, TrackProjection, curve_fingerprint
+from .ideal import IdealLap
+from .metrics import METRICS, MetricEngine
+from .spectral import Spectrum, sample_rate
 from .radarchart import RadarChart
 
+def _load_run_file(path: str, info: dict, filename: str, cache: bool) -> 'Run':
+    return Run(path, info=info, filename=filename, cache=cache)
+
+def _csv_files(path: str) -> list[str]:
+    return sorted(f for f in listdir(path) if isfile(join(path, f)) and f.endswith('.csv'))
+
+def load_runs(data_dir: str, info: dict, runs: list[str] = None, workers: int | None = None, cache: bool = True) -> dict:
+    """
+    Loads several circuits at once. Every csv file of every circuit folder in data_dir is parsed, and its laps
+    built, as an independent task in a pool of `workers` processes (one per cpu if None). The runs of each
+    circuit are merged once all of its files are loaded.
+
+    With workers <= 1 the files are loaded serially in this process, which gives the same result.
+
+    input:
+        data_dir: folder with a subfolder per circuit
+        info: the content of info.json
+        runs: the circuits to load, all the circuits in info if None
+        workers: number of processes
+
+    output:
+        a dictionary with the Run of each circuit
+    """
+    runs = list(info.keys()) if runs is None else runs
+    tasks = [(run, filename) for run in runs for filename in _csv_files(join(data_dir, run))]
+    paths = [join(data_dir, run, filename) for run, filename in tasks]
+    run_infos = [info[run] for run, _ in tasks]
+    filenames = [filename for _, filename in tasks]
+
+    workers = min((os.cpu_count() or 1) if workers is None else workers, len(tasks))
+    if workers <= 1:
+        loaded = list(map(_load_run_file, paths, run_infos, filenames, repeat(cache)))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            loaded = list(executor.map(_load_run_file, paths, run_infos, filenames, repeat(cache)))
+
+    runs_objects = {}
+    for (run, _), run_object in zip(tasks, loaded):
+        runs_objects.setdefault(run, []).append(run_object)
+
+    return {run: Run.concat(run_objects) for run, run_objects in runs_objects.items()}
+
 class Run:
     COLUMNS = ['TimeStamp', 'Throttle', 'Steering', 'VN_ax', 'VN_ay', 'xPosition', 'yPosition', 'zPosition', 'Velocity', 'laps', 'delta', 'dist1', 'BPE', 'sector', 'microsector']
 
-    def __init__(self, csv: str | None | pd.DataFrame = None, info: dict = None, filename: str = None) -> None:
+    def __init__(self, csv: str | None | pd.DataFrame = None, info: dict = None, filename: str = None, cache: bool = True) -> None:
         if info is None:
             self.info = {}
         else:
             self.info = info
 
-        if csv is not None:
-            if isinstance(csv, pd.DataFrame):
-                if not all([col in csv.columns for col in self.COLUMNS]):
-                    raise ValueError(f'csv must contain all of the following columns: {self.COLUMNS}')
-                self.df = csv[self.COLUMNS]
-            if isinstance(csv, str):
-                self.df = pd.read_csv(csv)[self.COLUMNS]
-                filename = basename(csv)
-            if filename is None:
-                raise ValueError('filename must be provided if csv is not a string')
-            
+        # Identifies this run in data_version, even across processes
+        self._uid = uuid.uuid4().hex
+        self._open_lap = []
+        self._closed_frames = []
+        self._lap_summaries = None
+        self._turn_metrics = None
+        self._distance_grids = {}
+        self._track_projections = {}
+        self._ideal_laps = {}
+        self._metric_engine = MetricEngine()
+        self._spectra = {}
+        self._fs = None
+
+        if csv is None:
+            # Empty run, e.g. to be filled with append_rows
+            df = pd.DataFrame({column: np.array([], dtype=TELEMETRY_SCHEMA[column]['dtype']) for column in self.COLUMNS})
+        if isinstance(csv, pd.DataFrame):
+            if not all([col in csv.columns for col in self.COLUMNS]):
+                raise ValueError(f'csv must contain all of the following columns: {self.COLUMNS}')
+            df = csv
+        if isinstance(csv, str):
+            df = read_csv_cached(csv, columns=self.COLUMNS, use_cache=cache)
+            filename = basename(csv)
+        if filename is None and csv is not None:
+            raise ValueError('filename must be provided if csv is not a string')
+
+        self._set_telemetry(*telemetry_frame(df, self.COLUMNS), filename=filename)
+
+    def _set_telemetry(self, df: pd.DataFrame, lap_offsets: np.ndarray, filename: str) -> None:
+        # The telemetry is stored once, laps are views of their [start, end) rows
+        self.df, self.lap_offsets = df, lap_offsets
+        self._filename = filename
+        # Steering and throttle of all the laps are smoothed in one batched pass
+        controls = {
+            control: segment_harshness(self.df[column].values, self.df['TimeStamp'].values, self.lap_offsets, scale=scale)
+            for control, column, scale in [('steering', 'Steering', 1), ('throttle', 'Throttle', 100)]
+        }
+        self.laps = [
+            Lap(
+                self.df.iloc[start:end], number=i, info=self.info, filename=filename,
+                **{control: {'smoothed': smoothed[start:end], 'harshness': harshness[i]} for control, (smoothed, harshness) in controls.items()}
+            )
+            for i, (start, end) in enumerate(zip(self.lap_offsets[:-1], self.lap_offsets[1:]))
+        ]
+        self.lap_map = [0 for _ in self.laps]
+        for control, (_, harshness) in controls.items():
+            self._metric_engine.store(f'{control}_harshness', [lap.number for lap in self.laps], harshness)
+
+    @classmethod
+    def from_stream(cls, csv: str, info: dict = None, filename: str = None, chunksize: int = 100_000, cache: bool = True) -> 'Run':
+        """
+        Builds a Run reading the csv in chunks of chunksize rows. Each lap is cast to the compact telemetry
+        schema as soon as it is complete, so the csv is never held whole in memory with its parsed dtypes.
+
+        To process sessions that do not fit in memory even in compact form use the functions in Modules.stream,
+        which go through the laps one at a time.
+        """
+        frames = list(iter_lap_frames(csv, columns=cls.COLUMNS, chunksize=chunksize, use_cache=cache))
+        if not frames:
+            raise ValueError(f'{csv} has no telemetry')
+        df = pd.concat(frames, ignore_index=True)
+        del frames
+
+        run = cls(info=info)
+        run._set_telemetry(df, lap_offsets(df['laps'].values), filename=basename(csv) if filename is None else filename)
+        return run
+
+    @classmethod
+    def from_directory(cls, path: str, info: dict = None, workers: int | None = None, cache: bool = True) -> 'Run':
+        """
+        Builds a single Run from all the csv files in path, sorted by filename, loading them in a pool
+        of `workers` processes (one per cpu if None). With workers <= 1 they are loaded serially.
+        """
+        data_dir, run = os.path.split(os.path.normpath(path))
+        runs = load_runs(data_dir, {run: info}, workers=workers, cache=cache)
+        if run not in runs:
+            raise FileNotFoundError(f'No csv files found in {path}')
+        return runs[run]
+
+    def append_rows(self, df_chunk: pd.DataFrame, filename: str = None) -> list[Lap]:
+        """
+        Appends telemetry rows to the run, e.g. the new rows of a csv that is still being written (see Modules.live).
+
+        Rows extend the current (open) lap, which is closed, i.e. added to the run laps, as soon as a row of
+        another lap arrives. Already closed laps are not rebuilt, and the per-lap metrics already computed
+        (lap_summaries, turn_metrics, distance_grid, ideal_lap) are only extended with the new laps when requested.
+
+        input:
+            df_chunk: the new rows, with all the Run.COLUMNS
+            filename: the file of the rows, the one given to the constructor if None
+
+        output:
+            the laps closed by these rows
+        """
+        if not all([col in df_chunk.columns for col in self.COLUMNS]):
+            raise ValueError(f'df_chunk must contain all of the following columns: {self.COLUMNS}')
+
+        closed = []
+        chunk = df_chunk[self.COLUMNS]
+        offsets = lap_offsets(chunk['laps'].values)
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            part = chunk.iloc[start:end]
+            if self._open_lap and self._open_lap[-1]['laps'].iat[0] != part['laps'].iat[0]:
+                closed.append(self.close_lap(filename))
+            self._open_lap.append(part)
+        return closed
+
+    def close_lap(self, filename: str = None) -> Lap | None:
+        """
+        Closes the open lap of a run being filled with append_rows, e.g. at the end of the session.
+
+        output:
+            the closed lap, None if there was no open lap
+        """
+        if not self._open_lap:
+            return None
+        filename = self._filename if filename is None else filename
+        frame, _ = telemetry_frame(pd.concat(self._open_lap), self.COLUMNS, first_lap=len(self.laps))
+        self._open_lap = []
+
+        # The frame is added to the telemetry of the run the next time it is read (see df), so closing a lap
+        # does not copy the previous laps
+        self._closed_frames.append(frame)
+        self.lap_offsets = np.append(self.lap_offsets, self.lap_offsets[-1] + len(frame))
+        lap = Lap(frame, number=len(self.laps), info=self.info, filename=filename)
+        self.lap_map.append(self.lap_map[-1] if self.laps and self.laps[-1].filename == filename else len(self.laps))
+        self.laps.append(lap)
+        return lap
+
+    @property
+    def df(self) -> pd.DataFrame:
+        """
+        Telemetry frame of the run. The laps closed since it was last read (see close_lap) are appended to it
+        at once, and the laps are pointed to the extended frame.
+        """
+        if self._closed_frames:
+            self._df = pd.concat([self._df, *self._closed_frames], ignore_index=True)
+            self._closed_frames = []
             self.laps = [
-                Lap(lap_df.reset_index(), number=i, info=self.info, filename=filename)
-                for i, (_, lap_df) in enumerate(self.df.groupby('laps'))
+                lap.rebased(self._df.iloc[start:end], number=lap.number)
+                for lap, start, end in zip(self.laps, self.lap_offsets[:-1], self.lap_offsets[1:])
             ]
-            self.lap_map = [0 for _ in self.laps]
-    
+        return self._df
+
+    @df.setter
+    def df(self, df: pd.DataFrame) -> None:
+        self._df = df
+        self._closed_frames = []
+
+    def _telemetry_since(self, lap: int) -> pd.DataFrame:
+        # Telemetry of laps[lap:], read from the frames closed since df was last read instead of appending them
+        # to it, so extending the per-lap metrics of a tailed run does not copy the previous laps
+        appended = len(self.laps) - len(self._closed_frames)
+        frames = [self._df.iloc[self.lap_offsets[lap]:]] if lap < appended else []
+        frames += self._closed_frames[max(lap - appended, 0):]
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True) if frames else self._df.iloc[:0]
+
+    @property
+    def data_version(self) -> tuple:
+        """
+        Token that changes whenever the telemetry of the run changes (a new run, or laps closed by append_rows
+        or close_lap), e.g. to invalidate charts built from it (see Modules.chartcache).
+        """
+        return (self._uid, len(self.laps), int(self.lap_offsets[-1]))
+
+    @property
+    def open_lap_df(self) -> pd.DataFrame:
+        """
+        Rows appended to the lap that is still open.
+        """
+        return pd.concat(self._open_lap) if self._open_lap else pd.DataFrame(columns=self.COLUMNS)
+
+    def lap_summaries(self) -> pd.DataFrame:
+        """
+        Summary metrics of every lap (see Lap.summary). They are computed once per lap, so after appending
+        rows only the new laps are summarized.
+        """
+        done = 0 if self._lap_summaries is None else len(self._lap_summaries)
+        if self._lap_summaries is None or done < len(self.laps):
+            new = pd.DataFrame([lap.summary() for lap in self.laps[done:]])
+            self._lap_summaries = new if self._lap_summaries is None else pd.concat([self._lap_summaries, new], ignore_index=True)
+        return self._lap_summaries
+
+    def turn_metrics(self, turns_json: list[dict]) -> pd.DataFrame:
+        """
+        Metrics of every lap in every turn of turns_json (see Modules.braking.turn_metrics), indexed by (lap, turn).
+
+        The table is built once per turns definition and kept until turns_json changes, which only rebuilds
+        this table. After appending rows only the new laps are computed.
+        """
+        key = json.dumps(turns_json, sort_keys=True)
+        cached_key, done, table = self._turn_metrics if self._turn_metrics is not None else (None, 0, None)
+        if cached_key != key:
+            done, table = 0, None
+        if table is None or done < len(self.laps):
+            new_laps = self.laps[done:]
+            new = turn_metrics(turns_json, [lap.number for lap in new_laps], self._telemetry_since(done), [lap.driver for lap in new_laps])
+            table = new if table is None else pd.concat([table, new])
+            self._turn_metrics = (key, len(self.laps), table)
+        return table
+
+    def distance_grid(self, circuit: Circuit, resolution: float = 1.0) -> DistanceGrid:
+        """
+        Every lap resampled onto a grid with a point every resolution meters of the circuit middle curve
+        (see Modules.resample.DistanceGrid).
+
+        Positions are projected onto the middle curve once per lap: grids are kept per circuit and resolution,
+        and after appending rows only the new laps are resampled.
+        """
+        key = (curve_fingerprint(circuit.middle_curve), resolution)
+        done, grid = self._distance_grids.get(key, (0, None))
+        if grid is None or done < len(self.laps):
+            new = DistanceGrid.from_laps(self.laps[done:], self.track_projection(circuit), resolution)
+            grid = new if grid is None else grid.extend(new)
+            self._distance_grids[key] = (len(self.laps), grid)
+        return grid
+
+    def track_projection(self, circuit: Circuit) -> TrackProjection:
+        """
+        Arc length parametrisation of the circuit middle curve, built once per circuit.
+        """
+        key = curve_fingerprint(circuit.middle_curve)
+        if key not in self._track_projections:
+            self._track_projections[key] = TrackProjection(circuit.middle_curve)
+        return self._track_projections[key]
+
+    def ideal_lap(self, driver: str | None = None) -> IdealLap:
+        """
+        Theoretical best lap of the run, of a driver or overall if driver is None (see Modules.ideal.IdealLap).
+        It is kept with the run, so after appending rows, or concatenating runs, only the new laps are compared
+        with its microsector bests.
+        """
+        if driver not in self._ideal_laps:
+            self._ideal_laps[driver] = IdealLap(driver)
+        self._ideal_laps[driver].update(self.laps)
+        return self._ideal_laps[driver]
+
+    def metrics(self, names: list[str] | None = None, laps: list[int] | None = None, params: dict[str, dict] | None = None) -> pd.DataFrame:
+        """
+        Values of registered driver-input metrics (see Modules.metrics) for the given laps, all of them by default.
+        Values are cached per lap, metric and parameters, and the missing ones are evaluated together in one pass.
+
+        output:
+            a dataframe with the lap, driver and laptime of every lap and a column per metric
+        """
+        names = list(METRICS) if names is None else names
+        laps = self.laps if laps is None else [self.laps[i] for i in laps]
+        values = self._metric_engine.evaluate(self.df, self.lap_offsets, [lap.number for lap in laps], names, params, fs=self.fs)
+        return pd.concat([
+            pd.DataFrame({'lap': [lap.number for lap in laps], 'driver': [lap.driver for lap in laps], 'laptime': [lap.laptime for lap in laps]}),
+            values.reset_index(drop=True)
+        ], axis=1)
+
+    @property
+    def fs(self) -> float:
+        """
+        Nominal sample rate of the run, in Hz, which laps are resampled at for their spectra (see spectrum and the
+        spectral metrics). It is fixed the first time it is read once the run has laps, so appending rows
+        does not change it.
+        """
+        if self._fs is not None:
+            return self._fs
+        fs = sample_rate(self.df['delta'].values)
+        if self.laps:
+            self._fs = fs
+        return fs
+
+    def spectrum(self, column: str = 'Steering', segment: float = 2.0) -> Spectrum:
+        """
+        Welch spectral density of a telemetry column for every lap, with windows of segment seconds
+        (see Modules.spectral.Spectrum). Laps are resampled at the nominal sample rate of the run (see fs).
+
+        Spectra are kept per column and segment, and after appending rows only the new laps are computed.
+        """
+        done, spectrum = self._spectra.get((column, segment), (0, None))
+        if spectrum is None or done < len(self.laps):
+            fs = self.fs if spectrum is None else spectrum.fs
+            new = Spectrum.from_frame(self.df, self.lap_offsets, self.laps[done:], column, fs, segment)
+            spectrum = new if spectrum is None else spectrum.extend(new)
+            self._spectra[(column, segment)] = (len(self.laps), spectrum)
+        return spectrum
+
+    def reference_lap(self, reference: int | str | None = None) -> int:
+        """
+        Number of a reference lap: the given lap number, the fastest lap of the given driver or, if None, the fastest lap of the run.
+        """
+        if isinstance(reference, (int, np.integer)):
+            return int(reference)
+        laps = self.laps if reference is None else [lap for lap in self.laps if lap.driver == reference]
+        if not laps:
+            raise ValueError(f'There are no laps of {reference}')
+        return min(laps, key=lambda lap: lap.laptime).number
+
+    def laps_delta_matrix(self, circuit: Circuit, reference: int | str | None = None, resolution: float = 1.0) -> pd.DataFrame:
+        """
+        Time difference between every lap and a reference lap (see reference_lap) along the track, computed at
+        once on the distance grid of the run (see distance_grid).
+
+        output:
+            a dataframe with a row per lap and a column per distance of the grid, positive where the lap is behind the reference
+        """
+        grid = self.distance_grid(circuit, resolution)
+        return pd.DataFrame(
+            grid.delta(reference=self.reference_lap(reference)),
+            index=pd.Index(grid.laps, name='lap'),
+            columns=pd.Index(grid.distance, name='distance')
+        )
+
     def describe(self):
         return self.df.describe()
+
+    def memory_usage(self, deep: bool = True) -> pd.Series:
+        """
+        Memory used by each column of the run telemetry and by the structures cached from it, in bytes:
+        'lap_caches' for the smoothed signals and spatial indexes of the laps (which are views of the telemetry,
+        so their samples take no extra memory), and an entry per cache of the run (summaries, distance grids,
+        spectra, ...).
+
+        Caches grow as they are used, so the memory of a run is the one at the time it is measured.
+        """
+        def frame_nbytes(df: pd.DataFrame | None) -> int:
+            return 0 if df is None else int(df.memory_usage(index=True, deep=deep).sum())
+
+        caches = {
+            'lap_caches': sum(lap.nbytes for lap in self.laps),
+            'lap_summaries': frame_nbytes(self._lap_summaries),
+            'turn_metrics': frame_nbytes(self._turn_metrics[2] if self._turn_metrics is not None else None),
+            'distance_grids': sum(grid.nbytes for _, grid in list(self._distance_grids.values())),
+            'track_projections': sum(projection.nbytes for projection in list(self._track_projections.values())),
+            'spectra': sum(spectrum.nbytes for _, spectrum in list(self._spectra.values())),
+            'ideal_laps': sum(ideal.nbytes for ideal in list(self._ideal_laps.values())),
+            'metrics': self._metric_engine.nbytes,
+        }
+        return pd.concat([self.df.memory_usage(index=True, deep=deep), pd.Series(caches, dtype=np.int64)])
     
-    def __add__(self, other):
-        sum = Run()
-        sum.df = pd.concat([self.df, other.df])
+    @classmethod
+    def concat(cls, runs: list['Run']) -> 'Run':
+        """
+        Concatenates several runs into a new one in a single pass: the telemetry frames are concatenated once,
+        laps are numbered consecutively and lap_map is shifted accordingly.
 
-        sum.laps = other.laps
-        for lap in sum.laps:
-            lap.number += len(self.laps)
-            lap.df['laps'] = lap.number
-        sum.laps = self.laps + sum.laps
-        sum.lap_map = self.lap_map + [lap_map + len(self.laps) for lap_map in other.lap_map]
+        The given runs are left untouched, the laps of the new run are renumbered copies of theirs that
+        read the new telemetry frame, with their smoothed signals and harshness, which also seed the metrics
+        of the new run as in _set_telemetry.
+        """
+        if not runs:
+            raise ValueError('At least one run is needed')
 
+        result = cls()
+        result.df = pd.concat([run.df for run in runs], ignore_index=True)
+        result.lap_offsets = np.concatenate([[0]] + [
+            run.lap_offsets[1:] + row_offset
+            for run, row_offset in zip(runs, np.cumsum([0] + [len(run.df) for run in runs[:-1]]))
+        ]).astype(np.int64)
+        result.df['laps'] = np.repeat(np.arange(len(result.lap_offsets) - 1), np.diff(result.lap_offsets)).astype(result.df['laps'].dtype)
 
-        if self.info == other.info:
-            sum.info = self.info
+        result.laps = []
+        result.lap_map = []
+        for run in runs:
+            offset = len(result.laps)
+            result.lap_map += [lap_map + offset for lap_map in run.lap_map]
+            result.laps += [
+                lap.rebased(result.df.iloc[start:end], number=lap.number + offset)
+                for lap, start, end in zip(run.laps, result.lap_offsets[offset:-1], result.lap_offsets[offset + 1:])
+            ]
+        for control in ['steering', 'throttle']:
+            result._metric_engine.store(f'{control}_harshness', [lap.number for lap in result.laps], [getattr(lap, control).harshness for lap in result.laps])
+
+        if all(run.info == runs[0].info for run in runs):
+            result.info = runs[0].info
+        else:
+            result.info = {key: value for run in runs for key, value in run.info.items()}
 
-        return sum
+        # The laps of the first run keep their numbers, so its theoretical best laps only need the rest of the laps
+        result._ideal_laps = {driver: ideal.copy() for driver, ideal in runs[0]._ideal_laps.items()}
 
+        return result
+
+    def __add__(self, other):
+        return Run.concat([self, other])
 
     def steering_harshness_chart(self, laps: list[int] = None, drivers: bool = False, scheme: str = "tableau10") -> alt.Chart:
-        steering_json = [
-            {'harshness': lap.steering.harshness, 'lap': lap.number, 'laptime': lap.laptime, 'driver': lap.driver}
-            for lap in (self.laps if laps is None else [self.laps[i] for i in laps])
-            if lap.laptime is not None
-        ]
-        chart = self._harshness_chart(pd.DataFrame(steering_json), drivers=drivers, scheme=scheme)
-        return chart.properties(title='Steering harshness vs laptime')
+        return self.metric_chart('steering_harshness', laps=laps, drivers=drivers, scheme=scheme)
     
     def throttle_harshness_chart(self, laps: list[int] = None, drivers: bool = False, scheme: str = "tableau10") -> alt.Chart:
-        throttle_json = [
-            {'harshness': lap.throttle.harshness, 'lap': lap.number, 'laptime': lap.laptime, 'driver': lap.driver}
-            for lap in (self.laps if laps is None else [self.laps[i] for i in laps])
-            if lap.laptime is not None
-        ]
-        chart = self._harshness_chart(pd.DataFrame(throttle_json), drivers=drivers, scheme=scheme)
-        return chart.properties(title='Throttle harshness vs laptime')
+        return self.metric_chart('throttle_harshness', laps=laps, drivers=drivers, scheme=scheme)
+
+    def metric_chart(self, metric: str, laps: list[int] = None, drivers: bool = False, scheme: str = "tableau10", params: dict | None = None) -> alt.Chart:
+        """
+        Any registered metric (see Modules.metrics) of the laps, or the mean of each driver, against the laptime.
+        """
+        df = self.metrics([metric], laps=laps, params=None if params is None else {metric: params})
+        df = df[df['laptime'].notna()].rename(columns={metric: 'harshness'})
+        chart = self._harshness_chart(df, drivers=drivers, scheme=scheme, title=METRICS[metric].title)
+        return chart.properties(title=f'{METRICS[metric].title} vs laptime')
 
-    def _harshness_chart(self, df: pd.DataFrame, drivers: bool, scheme: str) -> alt.Chart:
+    def _harshness_chart(self, df: pd.DataFrame, drivers: bool, scheme: str, title: str = 'Harshness') -> alt.Chart:
         if drivers:
             return alt.Chart(df).mark_point(filled=True).encode(
                 y = alt.Y('mean(laptime):Q', axis=alt.Axis(title='Laptime [s]'), scale=alt.Scale(zero=False)),
-                x = alt.X('mean(harshness):Q', axis=alt.Axis(title='Harshness'), scale=alt.Scale(zero=False)),
+                x = alt.X('mean(harshness):Q', axis=alt.Axis(title=title), scale=alt.Scale(zero=False)),
                 color=alt.Color('driver:N', scale=alt.Scale(scheme='tableau10'), legend=alt.Legend(title='Driver')),
                 shape=alt.Shape('driver:N', legend=alt.Legend(title='Driver')),
                 tooltip=['driver', alt.Tooltip('mean(laptime)', format='.3f'), 'mean(harshness)']
             )
         return alt.Chart(df).mark_point(filled=True).encode(
             y = alt.Y('laptime:Q', axis=alt.Axis(title='Laptime [s]'), scale=alt.Scale(zero=False)),
-            x = alt.X('harshness:Q', axis=alt.Axis(title='Harshness'), scale=alt.Scale(zero=False)),
+            x = alt.X('harshness:Q', axis=alt.Axis(title=title), scale=alt.Scale(zero=False)),
             color = alt.Color('lap:N', scale=alt.Scale(scheme=scheme), legend=alt.Legend(title='Lap number')),
             shape=alt.Shape('driver:N', legend=alt.Legend(title='Driver')),
             tooltip=['lap', alt.Tooltip('laptime', format='.3f'), 'driver']
         )
     
+    def spectrum_chart(self, column: str = 'Steering', laps: list[int] = None, drivers: bool = True, max_frequency: float = 10, scheme: str = "tableau10", budget: int = POINT_BUDGET) -> alt.Chart:
+        """
+        Spectral density of a telemetry column up to max_frequency Hz, a line per lap or the mean of each driver,
+        on a logarithmic scale. Lines per lap are downsampled to budget points in total.
+        """
+        df = self.spectrum(column).to_frame(max_frequency)
+        if laps is not None:
+            df = df[df['lap'].isin(laps)]
+        df = df[(df['frequency'] > 0) & (df['psd'] > 0)]
+
+        x = alt.X('frequency:Q', axis=alt.Axis(title='Frequency [Hz]'))
+        if drivers:
+            return alt.Chart(df).mark_line().encode(
+                x=x,
+                y=alt.Y('mean(psd):Q', axis=alt.Axis(title='Power spectral density'), scale=alt.Scale(type='log')),
+                color=alt.Color('driver:N', scale=alt.Scale(scheme=scheme), legend=alt.Legend(title='Driver')),
+                tooltip=['driver', alt.Tooltip('frequency', format='.2f'), alt.Tooltip('mean(psd)', format='.3e')]
+            ).properties(title=f'{column} spectrum')
+        return alt.Chart(downsample(df, 'frequency', 'psd', budget=budget, by='lap')).mark_line().encode(
+            x=x,
+            y=alt.Y('psd:Q', axis=alt.Axis(title='Power spectral density'), scale=alt.Scale(type='log')),
+            color=alt.Color('lap:N', scale=alt.Scale(scheme=scheme), legend=alt.Legend(title='Lap number')),
+            strokeDash=alt.StrokeDash('driver:N', legend=alt.Legend(title='Driver')),
+            tooltip=['lap', 'driver', alt.Tooltip('frequency', format='.2f'), alt.Tooltip('psd', format='.3e')]
+        ).properties(title=f'{column} spectrum')
+
     def braking_charts(self, turns_json: list[dict], chart_sections: int = 4, laps: list = [], drivers: bool = False) -> tuple[alt.Chart]:
         radars = []
-        axis_names, axis_idxs, lines, drivers_names, mean_v, out_v, distance_before_braking = get_braking_stats(turns_json, [lap.number for lap in self.laps], self.df, self.lap_map, [lap.driver for lap in self.laps], lap_idxs=laps, groupby=drivers)
+        selected = [self.laps[i] for i in laps] if laps else self.laps
+        axis_names, axis_idxs, lines, drivers_names, mean_v, out_v, distance_before_braking = select_braking_stats(self.turn_metrics(turns_json), [lap.number for lap in selected], [lap.driver for lap in selected], groupby=drivers)
         
         for metric, title in zip([mean_v, out_v], ['Mean velocity [m/s]', 'Velocity at the exit of the turn [m/s]']):
             df = pd.DataFrame({'axis_name': axis_names, 'axis': axis_idxs, 'line': lines, 'metric': metric})
@@ -121,57 +544,149 @@ class Run:
         
         return tuple(radars)
     
-    def laps_delta_comparison_chart(self, circuit: Circuit,  lapA: int, lapB: int, intervals: int = None, sector: int | tuple = None) -> alt.Chart:
+    def laps_delta_heatmap_chart(self, circuit: Circuit, reference: int | str | None = None, bins: int = 100, resolution: float = 1.0, max_cells: int = 20_000) -> alt.Chart:
+        """
+        Heatmap of the time difference of every lap to a reference lap (see laps_delta_matrix) along the track.
+        The track is split in bins segments and each cell shows the mean difference of a lap in a segment, so
+        the chart size does not depend on the grid resolution. With many laps the number of bins is reduced
+        to keep at most max_cells cells.
+        """
+        matrix = self.laps_delta_matrix(circuit, reference, resolution)
+        bins = max(1, min(bins, max_cells // max(len(matrix), 1)))
+        distance = matrix.columns.values
+        values = matrix.values
+        edges = np.unique(np.linspace(0, len(distance), bins + 1).astype(np.int64)[:-1])
+        reached = ~np.isnan(values)
+        with np.errstate(invalid='ignore'):
+            binned = np.add.reduceat(np.where(reached, values, 0), edges, axis=1) / np.add.reduceat(reached, edges, axis=1)
+        bin_ends = np.append(distance[edges[1:]], distance[-1] + (distance[1] - distance[0] if len(distance) > 1 else 0))
+
+        reference_number = self.reference_lap(reference)
+        data = pd.DataFrame({
+            'lap': np.repeat(matrix.index.values, len(edges)),
+            'driver': np.repeat([self.laps[lap].driver for lap in matrix.index], len(edges)),
+            'start': np.tile(distance[edges], len(matrix)),
+            'end': np.tile(bin_ends, len(matrix)),
+            'delta': binned.ravel(),
+        }).dropna(subset=['delta'])
+        domain = np.max(np.abs(data['delta'].quantile([0.05, 0.95]).values.tolist())) if len(data) else 1
+        domain = domain if domain > 0 else 1
+
+        return alt.Chart(data).mark_rect().encode(
+            x=alt.X('start:Q', axis=alt.Axis(title='Distance covered [m]')),
+            x2='end:Q',
+            y=alt.Y('lap:O', axis=alt.Axis(title='Lap', labelOverlap=True)),
+            color=alt.Color(
+                'delta:Q',
+                scale=alt.Scale(scheme='redblue', reverse=True, domain=[-domain, domain], clamp=True),
+                legend=alt.Legend(title='Time difference [s]')
+            ),
+            tooltip=['lap', 'driver', alt.Tooltip('start:Q', title='distance', format='.0f'), alt.Tooltip('delta:Q', format='.3f')]
+        ).properties(
+            title=f'Time difference along track to lap {reference_number}',
+            height=min(max(6 * len(matrix), 120), 600),
+        )
+
+    def ideal_lap_chart(self, circuit: Circuit, lap: int, driver: str | None = None, resolution: float = 1.0, budget: int = POINT_BUDGET) -> alt.Chart:
+        """
+        Time difference of a lap to the theoretical best lap (see ideal_lap) along the track, above the velocity
+        of both laps. Raises ValueError if there is no theoretical best lap, i.e. no laps with microsector times.
+        """
+        ideal = self.ideal_lap(driver)
+        if ideal.lap is None:
+            raise ValueError(f"There is no theoretical best lap of {driver if driver is not None else 'the run'}")
+        grid = self.distance_grid(circuit, resolution)
+        ideal_grid = DistanceGrid.from_laps([ideal.lap], self.track_projection(circuit), resolution)
+        row = grid.rows([lap])[0]
+
+        curves = [f'Lap {lap}', 'Theoretical best']
+        data = pd.DataFrame({
+            'dist': grid.distance,
+            'delta': grid['time'][row] - ideal_grid['time'][0],
+            curves[0]: grid['Velocity'][row],
+            curves[1]: ideal_grid['Velocity'][0],
+        }).dropna()
+        # Both charts read this dataset, the velocities are folded into curves by the chart itself
+        data = downsample(data, None, ['delta'] + curves, budget=budget, method='minmax')
+        color = alt.Color('curve:N', scale=alt.Scale(range=['#4E79A7', '#F28E2B'], domain=curves), legend=alt.Legend(title=None, orient='top'))
+
+        delta_chart = alt.Chart().mark_area(fillOpacity=0.75, color='#4E79A7').encode(
+            x=alt.X('dist:Q', axis=alt.Axis(title=None)),
+            y=alt.Y('delta:Q', axis=alt.Axis(title='Time lost [s]')),
+            tooltip=[alt.Tooltip('dist:Q', format='.0f'), alt.Tooltip('delta:Q', format='.3f')]
+        ).properties(
+            title=f'Lap {lap} vs theoretical best lap ({ideal.laptime:.3f}s)',
+            height=150,
+        )
+        velocity_chart = alt.Chart().transform_fold(curves, as_=['curve', 'velocity']).mark_line().encode(
+            x=alt.X('dist:Q', axis=alt.Axis(title='Distance covered [m]')),
+            y=alt.Y('velocity:Q', axis=alt.Axis(title='Velocity [m/s]'), scale=alt.Scale(zero=False)),
+            color=color,
+            tooltip=['curve:N', alt.Tooltip('velocity:Q', format='.2f')]
+        ).properties(
+            height=150,
+        )
+        return alt.vconcat(delta_chart, velocity_chart, data=shared_dataset(ideal_lap=data))
+
+    def laps_delta_comparison_chart(self, circuit: Circuit,  lapA: int, lapB: int, intervals: int = None, sector: int | tuple = None, budget: int = POINT_BUDGET) -> alt.Chart:
+        """
+        Time difference between two laps along the track. The track (or the selected sector or microsectors range)
+        is split by doors on the circuit middle curve, and at each door the nearest sample of each lap gives
+        the time elapsed by it.
+
+        intervals is the number of doors of the whole track, 100 by default. A sector gets the doors of its
+        share of the track. At most budget doors are charted.
+        """
         microsectors = False
         if isinstance(sector, tuple):
             microsectors = True
             sector = None if not sector else list(range(sector[0], sector[-1] + 1))
+        intervals = 100 if intervals is None else intervals
 
         if sector is None:
-            positionsA = self.laps[lapA].df[['xPosition', 'yPosition']]
-            positionsB = self.laps[lapB].df[['xPosition', 'yPosition']]
+            column, values = None, ()
             start = circuit.middle_curve.t[0]
             end = circuit.middle_curve.t[-1]
-            intervals = 100
+            doors_count = intervals
         elif microsectors:
-            positionsA = self.laps[lapA].df[self.laps[lapA].df['microsector'].isin(sector)][['xPosition', 'yPosition']]
-            positionsB = self.laps[lapB].df[self.laps[lapB].df['microsector'].isin(sector)][['xPosition', 'yPosition']]
+            column, values = 'microsector', tuple(sector)
             start = circuit.middle_curve.t[-1] * (sector[0] - 1) / circuit.N_MICROSECTORS
             end = circuit.middle_curve.t[-1] * sector[-1] / circuit.N_MICROSECTORS
-            intervals = int(np.ceil(100 * (end-start) / (circuit.middle_curve.t[-1] - circuit.middle_curve.t[0])))
+            doors_count = int(np.ceil(intervals * (end-start) / (circuit.middle_curve.t[-1] - circuit.middle_curve.t[0])))
         else:
-            positionsA = self.laps[lapA].df[self.laps[lapA].df['sector'] == sector][['xPosition', 'yPosition']]
-            positionsB = self.laps[lapB].df[self.laps[lapB].df['sector'] == sector][['xPosition', 'yPosition']]
+            column, values = 'sector', (sector,)
             start = circuit.middle_curve.t[-1] * (sector - 1) / circuit.N_SECTORS
             end = circuit.middle_curve.t[-1] * sector / circuit.N_SECTORS
-            intervals = int(np.ceil(100 * (end-start) / (circuit.middle_curve.t[-1] - circuit.middle_curve.t[0])))
+            doors_count = int(np.ceil(intervals * (end-start) / (circuit.middle_curve.t[-1] - circuit.middle_curve.t[0])))
 
-        lapA_kdtree = KDTree(positionsA)
-        lapB_kdtree = KDTree(positionsB)
+        lap_a, lap_b = self.laps[lapA], self.laps[lapB]
+        lapA_kdtree, lapA_rows = lap_a.position_tree(column, values)
+        lapB_kdtree, lapB_rows = lap_b.position_tree(column, values)
 
-        delta = []
-        color = []
-        covered_distance = []
-        circuit_length = self.laps[lapA].df['dist1'].sum()
-        for i in range(intervals):
-            door = circuit.middle_curve(start + ((end - start) * (i+1)/intervals))
-            Ai = lapA_kdtree.query([door])[1][0][0]
-            Bi = lapB_kdtree.query([door])[1][0][0]
-            if self.laps[lapA].df['microsector'][Ai] == self.laps[lapB].df['microsector'][Bi]:
-                delta.append(self.laps[lapA].df['delta'][:Ai].sum() - self.laps[lapB].df['delta'][:Bi].sum())
-                color.append(-1 if delta[-1] == 0 else (lapA if delta[-1] < 0 else lapB))
-                covered_distance.append(((start + ((end - start) * (i+1)/intervals))/circuit.middle_curve.t[-1]) * circuit_length)
+        # All the doors are queried at once, tree indices are mapped back to positions in the laps
+        doors_t = start + (end - start) * np.arange(1, doors_count + 1) / doors_count
+        doors = np.atleast_2d(circuit.middle_curve(doors_t))
+        Ai = lapA_rows[lapA_kdtree.query(doors, return_distance=False)[:, 0]]
+        Bi = lapB_rows[lapB_kdtree.query(doors, return_distance=False)[:, 0]]
+        matched = lap_a.df['microsector'].values[Ai] == lap_b.df['microsector'].values[Bi]
 
-        data = pd.DataFrame({
+        circuit_length = lap_a.df['dist1'].sum()
+        delta = lap_a.cumulative_time[Ai[matched]] - lap_b.cumulative_time[Bi[matched]]
+        color = np.where(delta == 0, -1, np.where(delta < 0, lapA, lapB))
+        covered_distance = (doors_t[matched] / circuit.middle_curve.t[-1]) * circuit_length
+
+        data = downsample(pd.DataFrame({
             'delta': delta,
             'dist': covered_distance,
             'color': color
-        })
+        }), 'dist', 'delta', budget=budget)
         domain = np.max(np.abs(data['delta'].quantile([0.05, 0.95]).values.tolist()))
 
-        rulers_chart = self._laps_delta_comparison_rulers_chart(circuit, lapA, lapB, sector, microsectors, domain)
+        rulers_df, labels_df = self._laps_delta_comparison_rulers_df(circuit, lapA, sector, microsectors, domain)
 
-        return (alt.Chart(data).mark_area(fillOpacity=0.75).encode(
+        # The deltas and the sector rulers are a single dataset shared by the layers
+        return alt.layer(
+            layer_rows('delta').mark_area(fillOpacity=0.75).encode(
                 x=alt.X('dist:Q', axis=alt.Axis(title='Distance covered [m]')),
                 y=alt.Y('delta:Q', impute={'value': 0}, axis=alt.Axis(title='Time difference [s]'), scale=alt.Scale(domain=[-domain, domain])),
                 color=alt.condition(
@@ -185,11 +700,17 @@ class Run:
                     alt.ColorValue('grey'),
                 ),
                 tooltip=[alt.Tooltip('delta:Q', format='.3f')]
-            ) + rulers_chart).properties(
-                title=f'Time difference along track (lap {lapA} - lap {lapB})',
-            )
+            ),
+            *self._laps_delta_comparison_rulers_chart(),
+            data=shared_dataset(delta=data, rulers=rulers_df, ruler_labels=labels_df)
+        ).properties(
+            title=f'Time difference along track (lap {lapA} - lap {lapB})',
+        )
 
-    def _laps_delta_comparison_rulers_chart(self, circuit: Circuit, lapA: int, lapB: int, sector: None|int|list, microsectors: bool, domain: float) -> alt.Chart:
+    def _laps_delta_comparison_rulers_df(self, circuit: Circuit, lapA: int, sector: None|int|list, microsectors: bool, domain: float) -> tuple[pd.DataFrame]:
+        """
+        Distance of the ends of the sectors (or microsectors) shown in laps_delta_comparison_chart, and the position of their labels.
+        """
         circuit_length = self.laps[lapA].df['dist1'].sum()
         
         if sector is None:
@@ -213,13 +734,18 @@ class Run:
             rulers = []
             sector = []
 
-        return alt.Chart(pd.DataFrame({'x': rulers})).mark_rule(strokeDash=[5, 5], strokeOpacity=0.5).encode(
-            x='x:Q',
-            tooltip=alt.value(None)
-        ) + alt.Chart(pd.DataFrame({'x': [r - 3 for r in rulers], 'y': [domain] * len(rulers), 'sector': sector})).mark_text().encode(
-            x='x:Q',
-            y='y:Q',
-            text='sector:N',
-            tooltip=alt.value(None)
-        )
-            
+        return pd.DataFrame({'x': rulers}), pd.DataFrame({'x': [r - 3 for r in rulers], 'y': [domain] * len(rulers), 'sector': sector})
+
+    def _laps_delta_comparison_rulers_chart(self) -> list[alt.Chart]:
+        return [
+            layer_rows('rulers').mark_rule(strokeDash=[5, 5], strokeOpacity=0.5).encode(
+                x='x:Q',
+                tooltip=alt.value(None)
+            ),
+            layer_rows('ruler_labels').mark_text().encode(
+                x='x:Q',
+                y='y:Q',
+                text='sector:N',
+                tooltip=alt.value(None)
+            ),
+        ]
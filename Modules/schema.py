@@ -0,0 +1,59 @@
+import warnings
+import numpy as np
+
+# Compact dtype of every telemetry column and the largest absolute error allowed when casting to it.
+# TimeStamp, delta and dist1 are kept in float64 because they are accumulated along the lap.
+TELEMETRY_SCHEMA = {
+    'TimeStamp': {'dtype': 'float64', 'atol': 0},
+    'Throttle': {'dtype': 'float32', 'atol': 1e-3},
+    'Steering': {'dtype': 'float32', 'atol': 1e-5},
+    'VN_ax': {'dtype': 'float32', 'atol': 1e-4},
+    'VN_ay': {'dtype': 'float32', 'atol': 1e-4},
+    'xPosition': {'dtype': 'float32', 'atol': 1e-3},
+    'yPosition': {'dtype': 'float32', 'atol': 1e-3},
+    'zPosition': {'dtype': 'float32', 'atol': 1e-3},
+    'Velocity': {'dtype': 'float32', 'atol': 1e-4},
+    'laps': {'dtype': 'int16', 'atol': 0},
+    'delta': {'dtype': 'float64', 'atol': 0},
+    'dist1': {'dtype': 'float64', 'atol': 0},
+    'BPE': {'dtype': 'float32', 'atol': 1e-4},
+    'sector': {'dtype': 'int8', 'atol': 0},
+    'microsector': {'dtype': 'int8', 'atol': 0},
+}
+
+
+def cast_column(name: str, values: np.ndarray, schema: dict = TELEMETRY_SCHEMA) -> np.ndarray:
+    """
+    Casts a telemetry column to its dtype in the schema.
+
+    If the values do not fit in it (not integer or out of range values for an integer dtype, or an
+    error bigger than the column tolerance for a float dtype) a warning is raised and the column is
+    returned unchanged. Columns not in the schema are also returned unchanged.
+    """
+    if name not in schema:
+        return values
+
+    dtype = np.dtype(schema[name]['dtype'])
+    if values.dtype == dtype:
+        return values
+
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        fits = np.all(np.isfinite(values)) and np.all(np.mod(values, 1) == 0) and (values.size == 0 or (info.min <= values.min() and values.max() <= info.max))
+        if not fits:
+            warnings.warn(f"Column {name} can not be stored as {dtype} without losing information, it is kept as {values.dtype}")
+            return values
+        return values.astype(dtype)
+
+    cast = values.astype(dtype)
+    error = np.nanmax(np.abs(cast.astype(values.dtype) - values)) if values.size else 0
+    if error > schema[name]['atol']:
+        warnings.warn(f"Column {name} loses up to {error:.3g} of precision as {dtype}, it is kept as {values.dtype}")
+        return values
+    return cast
+
+def cast_telemetry(data: dict, schema: dict = TELEMETRY_SCHEMA) -> dict:
+    """
+    Casts every column of a {column: values} dictionary to the schema (see cast_column).
+    """
+    return {name: cast_column(name, np.asarray(values), schema) for name, values in data.items()}
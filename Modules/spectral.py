@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+from scipy.signal import get_window
+
+
+def sample_rate(delta: np.ndarray) -> float:
+    """
+    Nominal sample rate of the telemetry, in Hz, from its per-row time steps, rounded to 1 Hz so it is stable
+    when laps are added.
+    """
+    delta = np.asarray(delta, dtype=np.float64)
+    delta = delta[delta > 0]
+    return float(np.round(1 / np.median(delta))) if delta.size else 1.0
+
+def segment_length(segment: float, fs: float) -> int:
+    """
+    Number of samples of a Welch window of segment seconds at fs Hz.
+    """
+    return max(int(round(segment * fs)), 2)
+
+def resample_uniform(values: np.ndarray, delta: np.ndarray, offsets: np.ndarray, fs: float) -> tuple[np.ndarray]:
+    """
+    Resamples every [start, end) segment of values (e.g. every lap) at fs Hz.
+
+    TimeStamp is a sample index in the telemetry, and samples are not evenly spaced in time, so the time of each
+    sample is the cumulative sum of the deltas of the previous ones in its segment.
+
+    output:
+        the resampled values of all the segments, concatenated
+        the [start, end) offsets of the resampled segments
+    """
+    values = np.asarray(values, dtype=np.float64)
+    delta = np.asarray(delta, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    non_empty = lengths > 0
+
+    # A single clock for all the segments, each sample at the sum of the deltas before it
+    time = np.cumsum(delta) - delta
+    starts = np.where(non_empty, time[np.minimum(offsets[:-1], len(time) - 1)], 0) if len(time) else np.zeros(len(lengths))
+    ends = np.where(non_empty, time[np.maximum(offsets[1:] - 1, 0)], 0) if len(time) else np.zeros(len(lengths))
+    resampled_lengths = np.where(non_empty, np.floor((ends - starts) * fs).astype(np.int64) + 1, 0)
+    resampled_offsets = np.concatenate([[0], np.cumsum(resampled_lengths)]).astype(np.int64)
+
+    # Resampled times of all the segments, none of them after the last sample of its segment
+    position = np.arange(resampled_offsets[-1]) - np.repeat(resampled_offsets[:-1], resampled_lengths)
+    targets = np.repeat(starts, resampled_lengths) + position / fs
+    return np.interp(targets, time, values), resampled_offsets
+
+def welch_segments(x: np.ndarray, offsets: np.ndarray, fs: float, nperseg: int = 1024, noverlap: int | None = None, window: str = 'hann') -> tuple[np.ndarray]:
+    """
+    Welch power spectral density of every [start, end) segment of x (e.g. every lap), as scipy.signal.welch
+    with a constant detrend and a one-sided density, computed for all the segments at once.
+
+    The overlapping windows of all the segments are gathered in a single matrix, transformed with one rfft and
+    averaged per segment with reduceat. Segments shorter than nperseg get a NaN spectrum.
+
+    output:
+        the frequencies, in Hz
+        the spectral density of every segment, a row per segment
+    """
+    x = np.asarray(x, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    noverlap = nperseg // 2 if noverlap is None else noverlap
+    step = nperseg - noverlap
+    n_segments = len(offsets) - 1
+    freqs = np.fft.rfftfreq(nperseg, 1 / fs)
+    psd = np.full((n_segments, len(freqs)), np.nan)
+
+    windows_per_segment = np.maximum((np.diff(offsets) - noverlap) // step, 0)
+    if not windows_per_segment.sum():
+        return freqs, psd
+
+    starts = np.concatenate([
+        start + np.arange(count) * step for start, count in zip(offsets[:-1], windows_per_segment)
+    ])
+    frames = x[starts[:, None] + np.arange(nperseg)]
+    frames = frames - frames.mean(axis=1, keepdims=True)
+
+    w = get_window(window, nperseg)
+    power = np.abs(np.fft.rfft(frames * w, axis=1)) ** 2 / (fs * (w ** 2).sum())
+    # One-sided density: every frequency but DC (and Nyquist for even nperseg) counts twice
+    power[:, 1:(-1 if nperseg % 2 == 0 else None)] *= 2
+
+    has_windows = windows_per_segment > 0
+    first_window = np.concatenate([[0], np.cumsum(windows_per_segment)[:-1]])[has_windows]
+    psd[has_windows] = np.add.reduceat(power, first_window, axis=0) / windows_per_segment[has_windows, None]
+    return freqs, psd
+
+def band_power(freqs: np.ndarray, psd: np.ndarray, low: float = 0, high: float | None = None) -> np.ndarray:
+    """
+    Power of every spectrum (row of psd) in the [low, high) Hz band, up to the Nyquist frequency if high is None.
+    """
+    band = (freqs >= low) & (freqs < (np.inf if high is None else high))
+    return psd[:, band].sum(axis=1) * (freqs[1] - freqs[0])
+
+
+class Spectrum:
+    def __init__(self, column: str, freqs: np.ndarray, psd: np.ndarray, laps: list[int], drivers: list[str], fs: float) -> None:
+        """
+        Welch spectral density of a telemetry column for several laps, a row of psd per lap (in the order of laps).
+        """
+        self.column = column
+        self.freqs = freqs
+        self.psd = psd
+        self.laps = list(laps)
+        self.drivers = list(drivers)
+        self.fs = fs
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, lap_offsets: np.ndarray, laps: list, column: str, fs: float, segment: float = 2.0) -> 'Spectrum':
+        """
+        Spectrum of column for the given laps (Lap objects, whose numbers are positions in lap_offsets) of df,
+        with Welch windows of segment seconds.
+        """
+        numbers = np.array([lap.number for lap in laps], dtype=np.int64)
+        starts, ends = lap_offsets[numbers], lap_offsets[numbers + 1]
+        rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)]) if len(numbers) else np.array([], dtype=np.int64)
+        resampled, offsets = resample_uniform(df[column].values[rows], df['delta'].values[rows], np.concatenate([[0], np.cumsum(ends - starts)]), fs)
+        freqs, psd = welch_segments(resampled, offsets, fs, nperseg=segment_length(segment, fs))
+        return cls(column, freqs, psd, numbers.tolist(), [lap.driver for lap in laps], fs)
+
+    def extend(self, other: 'Spectrum') -> 'Spectrum':
+        return Spectrum(self.column, self.freqs, np.vstack([self.psd, other.psd]), self.laps + other.laps, self.drivers + other.drivers, self.fs)
+
+    @property
+    def nbytes(self) -> int:
+        return self.freqs.nbytes + self.psd.nbytes
+
+    def band_power(self, low: float = 0, high: float | None = None) -> np.ndarray:
+        return band_power(self.freqs, self.psd, low, high)
+
+    def to_frame(self, max_frequency: float | None = None) -> pd.DataFrame:
+        """
+        Spectrum in long format, with a row per (lap, frequency) up to max_frequency.
+        """
+        keep = self.freqs <= (np.inf if max_frequency is None else max_frequency)
+        return pd.DataFrame({
+            'lap': np.repeat(self.laps, keep.sum()),
+            'driver': np.repeat(self.drivers, keep.sum()),
+            'frequency': np.tile(self.freqs[keep], len(self.laps)),
+            'psd': self.psd[:, keep].ravel(),
+        })
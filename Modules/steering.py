@@ -1,11 +1,12 @@
+import copy
 import numpy as np
 import pandas as pd
 import altair as alt
 
-from .utils import smooth
+from .utils import smooth, downsample, POINT_BUDGET
 
 class Steering:
-    def __init__(self, df: pd.DataFrame, **kwargs):
+    def __init__(self, df: pd.DataFrame, smoothed: np.ndarray | None = None, harshness: float | None = None, **kwargs):
         if not 'Steering' in df.columns:
             raise ValueError("Steering column not found in dataframe")
         if not 'TimeStamp' in df.columns:
@@ -13,29 +14,46 @@ class Steering:
         
         self._steering = df['Steering']
         self._time = df['TimeStamp']
-        self._smoothed_steering = smooth(self._steering, **kwargs)
+        # The smoothed signal and the harshness can be given, e.g. computed for all the laps of a run at once (see Run)
+        self._smoothed_steering = smooth(self._steering.values, **kwargs) if smoothed is None else smoothed
 
-        self._angle_difference_to_smoothed = abs(self._steering - self._smoothed_steering)
-        self.harshness = np.trapz(self._angle_difference_to_smoothed, self._time)
+        self._angle_difference_to_smoothed = np.abs(self._steering.values - self._smoothed_steering)
+        self.harshness = np.trapz(self._angle_difference_to_smoothed, self._time) if harshness is None else harshness
 
     
-    def chart(self):
-        steering_json = [{'steering': st, 'time': time, 'line': 'steering'} for st, time in zip(self._steering, self._time)]
-        steering_json.extend([{'steering': st, 'time': time, 'line': 'smoothed_steering'} for st, time in zip(self._smoothed_steering, self._time)])
-        steering_df = pd.DataFrame(steering_json)
+    def rebased(self, df: pd.DataFrame) -> 'Steering':
+        """
+        Returns a copy that reads the raw signal from df, which must hold the same samples.
+        """
+        steering = copy.copy(self)
+        steering._steering = df['Steering']
+        steering._time = df['TimeStamp']
+        return steering
 
-        return alt.Chart(pd.DataFrame(steering_df)).mark_line().encode(
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory of the arrays derived from the raw signal, which is read from the telemetry of the lap.
+        """
+        return self._smoothed_steering.nbytes + self._angle_difference_to_smoothed.nbytes
+
+    def chart(self, budget: int = POINT_BUDGET):
+        steering_df = pd.DataFrame({
+            'steering': np.concatenate([self._steering.values, self._smoothed_steering]),
+            'time': np.tile(self._time.values, 2),
+            'line': np.repeat(['steering', 'smoothed_steering'], len(self._time)),
+        })
+
+        return alt.Chart(downsample(steering_df, None, 'steering', budget=budget, method='minmax', by='line')).mark_line().encode(
             y='steering:Q',
             x = 'time:T',
             color='line:N'
         )
     
-    
-    def difference_chart(self):
-        steering_difference_json = [{'steering_difference': diff, 'time': time} for diff, time in zip(self._angle_difference_to_smoothed, self._time)]
-        steering_difference_df = pd.DataFrame(steering_difference_json)
+    def difference_chart(self, budget: int = POINT_BUDGET):
+        steering_difference_df = pd.DataFrame({'steering_difference': self._angle_difference_to_smoothed, 'time': self._time.values})
         
-        return alt.Chart(pd.DataFrame(steering_difference_df)).mark_area().encode(
+        return alt.Chart(downsample(steering_difference_df, None, 'steering_difference', budget=budget, method='minmax')).mark_area().encode(
             y='steering_difference:Q',
             x = 'time:T'
         )
@@ -0,0 +1,51 @@
+import pandas as pd
+from os.path import basename
+from typing import Iterator
+
+from .lap import Lap, lap_offsets, telemetry_frame
+from .schema import TELEMETRY_SCHEMA
+from .utils import iter_csv_chunks
+
+TELEMETRY_COLUMNS = list(TELEMETRY_SCHEMA.keys())
+
+
+def iter_lap_frames(csv_path: str, columns: list[str] = TELEMETRY_COLUMNS, chunksize: int = 100_000, use_cache: bool = True) -> Iterator[pd.DataFrame]:
+    """
+    Reads a telemetry csv in chunks and yields the telemetry frame of each lap (see telemetry_frame) as soon
+    as the laps column changes value, so only one chunk and one lap are held in memory at a time.
+    A lap split by a chunk boundary is carried over to the next chunk.
+
+    Laps are expected in order in the file: a lap number that appears again after a different one is
+    yielded as a new lap.
+    """
+    number = 0
+    pending = []
+    for chunk in iter_csv_chunks(csv_path, columns=columns, chunksize=chunksize, use_cache=use_cache):
+        offsets = lap_offsets(chunk['laps'].values)
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            part = chunk.iloc[start:end]
+            if pending and pending[-1]['laps'].iat[0] != part['laps'].iat[0]:
+                yield telemetry_frame(pd.concat(pending), columns, first_lap=number)[0]
+                number += 1
+                pending = []
+            pending.append(part)
+
+    if pending:
+        yield telemetry_frame(pd.concat(pending), columns, first_lap=number)[0]
+
+def iter_laps(csv_path: str, info: dict = None, filename: str = None, chunksize: int = 100_000, use_cache: bool = True) -> Iterator[Lap]:
+    """
+    Yields the laps of a telemetry csv one by one, reading it in chunks (see iter_lap_frames).
+    Every lap owns its own telemetry frame, so laps that are not kept are freed.
+    """
+    info = {} if info is None else info
+    filename = basename(csv_path) if filename is None else filename
+    for lap_df in iter_lap_frames(csv_path, chunksize=chunksize, use_cache=use_cache):
+        yield Lap(lap_df, number=int(lap_df['laps'].iat[0]), info=info, filename=filename)
+
+def stream_lap_summaries(csv_path: str, info: dict = None, filename: str = None, chunksize: int = 100_000, use_cache: bool = True) -> pd.DataFrame:
+    """
+    Per-lap summaries (laptime, steering and throttle harshness, distance, velocities...) of a telemetry csv,
+    computed lap by lap without materialising the whole run.
+    """
+    return pd.DataFrame([lap.summary() for lap in iter_laps(csv_path, info=info, filename=filename, chunksize=chunksize, use_cache=use_cache)])
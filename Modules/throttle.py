@@ -1,11 +1,12 @@
+import copy
 import pandas as pd
 import altair as alt
 import numpy as np
 
-from .utils import smooth
+from .utils import smooth, downsample, POINT_BUDGET
 
 class Throttle:
-    def __init__(self, df: pd.DataFrame, **kwargs) -> None:
+    def __init__(self, df: pd.DataFrame, smoothed: np.ndarray | None = None, harshness: float | None = None, **kwargs) -> None:
         if not 'Throttle' in df.columns:
             raise ValueError("Throttle column not found in dataframe")
         if not 'TimeStamp' in df.columns:
@@ -13,28 +14,46 @@ class Throttle:
         
         self._throttle = df['Throttle']
         self._time = df['TimeStamp']
-        self._smoothed_throttle = smooth(self._throttle, **kwargs)
+        # Precomputed by Run._set_telemetry for the laps of a run
+        self._smoothed_throttle = smooth(self._throttle.values, **kwargs) if smoothed is None else smoothed
 
-        self._throttle_difference_to_smoothed = abs(self._throttle - self._smoothed_throttle)/100
-        self.harshness = np.trapz(self._throttle_difference_to_smoothed, self._time)
+        self._throttle_difference_to_smoothed = np.abs(self._throttle.values - self._smoothed_throttle)/100
+        self.harshness = np.trapz(self._throttle_difference_to_smoothed, self._time) if harshness is None else harshness
 
     
-    def chart(self):
-        throttle_json = [{'throttle': st, 'time': time, 'line': 'throttle'} for st, time in zip(self._throttle, self._time)]
-        throttle_json.extend([{'throttle': st, 'time': time, 'line': 'smoothed_throttle'} for st, time in zip(self._smoothed_throttle, self._time)])
-        throttle_df = pd.DataFrame(throttle_json)
+    def rebased(self, df: pd.DataFrame) -> 'Throttle':
+        """
+        Returns a copy that reads the raw signal from df, which must hold the same samples.
+        """
+        throttle = copy.copy(self)
+        throttle._throttle = df['Throttle']
+        throttle._time = df['TimeStamp']
+        return throttle
 
-        return alt.Chart(pd.DataFrame(throttle_df)).mark_line().encode(
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory of the arrays derived from the raw signal, which is read from the telemetry of the lap.
+        """
+        return self._smoothed_throttle.nbytes + self._throttle_difference_to_smoothed.nbytes
+
+    def chart(self, budget: int = POINT_BUDGET):
+        throttle_df = pd.DataFrame({
+            'throttle': np.concatenate([self._throttle.values, self._smoothed_throttle]),
+            'time': np.tile(self._time.values, 2),
+            'line': np.repeat(['throttle', 'smoothed_throttle'], len(self._time)),
+        })
+
+        return alt.Chart(downsample(throttle_df, None, 'throttle', budget=budget, method='minmax', by='line')).mark_line().encode(
             y='throttle:Q',
             x = 'time:T',
             color='line:N'
         )
     
-    def difference_chart(self):
-        throttle_difference_json = [{'throttle_difference': diff, 'time': time} for diff, time in zip(self._throttle_difference_to_smoothed, self._time)]
-        throttle_difference_df = pd.DataFrame(throttle_difference_json)
+    def difference_chart(self, budget: int = POINT_BUDGET):
+        throttle_difference_df = pd.DataFrame({'throttle_difference': self._throttle_difference_to_smoothed, 'time': self._time.values})
         
-        return alt.Chart(pd.DataFrame(throttle_difference_df)).mark_area(color='orange').encode(
+        return alt.Chart(downsample(throttle_difference_df, None, 'throttle_difference', budget=budget, method='minmax')).mark_area(color='orange').encode(
             y='throttle_difference:Q',
             x = 'time:T'
         )
\ No newline at end of file
@@ -1,2 +1,5 @@
 from .signals import *
-from .app import *
\ No newline at end of file
+from .downsample import *
+from .charts import *
+from .app import *
+from .cache import *
\ No newline at end of file
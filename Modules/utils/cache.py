@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import warnings
+from os.path import basename, dirname, join, isfile
+from typing import Iterator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CACHE_DIRNAME = '.cache'
+CACHE_VERSION = 1
+_SOURCE_METADATA_KEY = b'dpa_source'
+
+
+def source_signature(path: str, digest: bool = False) -> dict:
+    """
+    Returns the signature used to decide if a cached file is still fresh: the cache format version,
+    the size and the modification time of the source file and, if requested, its sha256 digest.
+    """
+    stat = os.stat(path)
+    signature = {'version': CACHE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if digest:
+        signature['sha256'] = file_digest(path)
+    return signature
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def cache_path(csv_path: str, cache_dir: str | None = None) -> str:
+    """
+    Path of the columnar copy of a csv file. By default it is stored in a `.cache` folder next to the csv.
+    """
+    return join(cache_dir if cache_dir is not None else join(dirname(csv_path), CACHE_DIRNAME), basename(csv_path) + '.parquet')
+
+def cached_signature(parquet_path: str) -> dict | None:
+    if not isfile(parquet_path):
+        return None
+    try:
+        metadata = pq.read_schema(parquet_path).metadata or {}
+    except (OSError, pa.ArrowException):
+        return None
+    if _SOURCE_METADATA_KEY not in metadata:
+        return None
+    return json.loads(metadata[_SOURCE_METADATA_KEY])
+
+def is_cache_fresh(csv_path: str, parquet_path: str) -> bool:
+    """
+    A cache is fresh when it was written by the current cache version from a source with the same size and,
+    either the same modification time or, if the file has been touched, the same content hash.
+    """
+    cached = cached_signature(parquet_path)
+    if cached is None:
+        return False
+    current = source_signature(csv_path)
+    if cached.get('version') != current['version'] or cached.get('size') != current['size']:
+        return False
+    if cached.get('mtime_ns') == current['mtime_ns']:
+        return True
+    if cached.get('sha256') != file_digest(csv_path):
+        return False
+    # The file was touched but not modified: the new modification time is recorded so the next check does
+    # not hash it again
+    try:
+        refresh_signature(parquet_path, {**cached, 'mtime_ns': current['mtime_ns']})
+    except (OSError, pa.ArrowException) as e:
+        warnings.warn(f"Could not refresh the cache of {csv_path}: {e}")
+    return True
+
+def write_cache(csv_path: str, df: pd.DataFrame, parquet_path: str) -> None:
+    """
+    Writes df as the columnar copy of csv_path. The file is written to a temporary path and then moved
+    so concurrent readers (or writers) never see a partial file.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_SOURCE_METADATA_KEY] = json.dumps(source_signature(csv_path, digest=True)).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    os.makedirs(dirname(parquet_path), exist_ok=True)
+    tmp_path = f'{parquet_path}.{os.getpid()}.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, parquet_path)
+
+def refresh_signature(parquet_path: str, signature: dict) -> None:
+    """
+    Replaces the source signature stored in a cached file, which is rewritten (a parquet footer can not be
+    edited in place) to a temporary path and then moved, as in write_cache.
+    """
+    table = pq.read_table(parquet_path)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_SOURCE_METADATA_KEY] = json.dumps(signature).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    tmp_path = f'{parquet_path}.{os.getpid()}.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, parquet_path)
+
+def read_csv_cached(csv_path: str, columns: list[str] | None = None, cache_dir: str | None = None, use_cache: bool = True) -> pd.DataFrame:
+    """
+    Reads a telemetry csv through its columnar cache.
+
+    If the cache is fresh only the requested columns are read from it, otherwise the csv is parsed
+    and the cache is (re)written with all of its columns.
+
+    input:
+        csv_path: path of the csv file
+        columns: the columns to read, all of them if None
+        cache_dir: folder where the cache is stored, `.cache` next to the csv if None
+        use_cache: if False the csv is always parsed and the cache is left untouched
+
+    output:
+        the dataframe with the requested columns
+    """
+    if not use_cache:
+        df = pd.read_csv(csv_path)
+        return df if columns is None else df[columns]
+
+    parquet_path = cache_path(csv_path, cache_dir)
+    if is_cache_fresh(csv_path, parquet_path):
+        df = pq.read_table(parquet_path, columns=columns).to_pandas()
+        return df if columns is None else df[columns]
+
+    df = pd.read_csv(csv_path)
+    try:
+        write_cache(csv_path, df, parquet_path)
+    except OSError as e:
+        warnings.warn(f"Could not write the cache of {csv_path}: {e}")
+    return df if columns is None else df[columns]
+
+def iter_csv_chunks(csv_path: str, columns: list[str] | None = None, chunksize: int = 100_000, cache_dir: str | None = None, use_cache: bool = True) -> Iterator[pd.DataFrame]:
+    """
+    Reads a telemetry csv in chunks of at most chunksize rows, without loading it whole.
+
+    If the columnar cache of the file is fresh the chunks are read from it, otherwise the csv is parsed
+    in chunks (and the cache is not written, since that would need the whole file).
+    """
+    parquet_path = cache_path(csv_path, cache_dir)
+    if use_cache and is_cache_fresh(csv_path, parquet_path):
+        for batch in pq.ParquetFile(parquet_path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+        return
+
+    for chunk in pd.read_csv(csv_path, usecols=columns, chunksize=chunksize):
+        yield chunk if columns is None else chunk[columns]
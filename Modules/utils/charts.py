@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+import altair as alt
+
+
+def shared_dataset(**layers: pd.DataFrame) -> pd.DataFrame:
+    """
+    Data of the layers of a chart in a single frame, with a `layer` column naming the layer of each row, to give
+    to alt.layer(..., data=...). Every layer then reads the same top-level dataset (see layer_rows) instead of
+    embedding its own copy, and the frame is sent once (as Arrow by Streamlit).
+
+    Columns are made compact for the transport: floats are stored as float32, columns with values of mixed
+    types (e.g. sector numbers and names) as strings, and columns with few distinct strings (e.g. the curve or
+    the layer) as categoricals, i.e. dictionary encoded.
+    """
+    parts = [df.assign(layer=name) for name, df in layers.items() if df is not None]
+    df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame({'layer': []})
+    for column in df.columns:
+        values = df[column]
+        if values.dtype == np.float64:
+            df[column] = values.astype(np.float32)
+        elif values.dtype == object:
+            if values.dropna().map(type).nunique() > 1:
+                values = values.where(values.isna(), values.astype(str))
+            df[column] = values.astype('category') if values.nunique() <= max(len(values) // 10, 1) else values
+    return df
+
+def layer_rows(name: str) -> alt.Chart:
+    """
+    A chart without data of its own that reads the rows of layer name of the shared dataset of its layered chart.
+    """
+    return alt.Chart().transform_filter(alt.datum.layer == name)
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+# Default number of points sent to the browser per chart
+POINT_BUDGET = 2000
+# Default number of points of a scatter chart, where points do not need to be dense to read as a shape
+SCATTER_BUDGET = 300
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling of the line through the points (x, y), in order.
+
+    The first and last points are kept, the rest are split in n_out - 2 buckets of consecutive points and
+    from each bucket the point that forms the largest triangle with the point kept from the previous bucket
+    and the mean of the next bucket is kept. Peaks and the overall shape of the line are preserved.
+
+    output:
+        the sorted positions of the kept points
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        return np.unique([0, n - 1])[:max(n_out, 0)]
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    counts = np.diff(edges)
+    means_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / counts
+    means_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / counts
+    # The bucket after the last one is the last point
+    next_x = np.append(means_x[1:], x[-1])
+    next_y = np.append(means_y[1:], y[-1])
+
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    previous = 0
+    for bucket, (start, end) in enumerate(zip(edges[:-1], edges[1:])):
+        area = np.abs(
+            (x[previous] - next_x[bucket]) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y[bucket] - y[previous])
+        )
+        previous = start + int(np.argmax(area))
+        kept[bucket + 1] = previous
+    return kept
+
+def minmax_indices(values: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Min/max-per-bucket downsampling of one or more signals (values of shape (n,) or (n, k)).
+
+    The samples are split in buckets of consecutive samples and, for every signal, the minimum and maximum
+    of every bucket are kept along with the first and last samples, so no peak is lost. About n_out samples
+    are kept in total.
+
+    output:
+        the sorted positions of the kept samples
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values.reshape(len(values), -1)
+    n, k = values.shape
+    n_buckets = max(n_out // (2 * k), 1)
+    if n <= n_out or n <= 2 * k * n_buckets:
+        return np.arange(n)
+
+    bucket = np.arange(n) * n_buckets // n
+    bucket_starts = np.searchsorted(bucket, np.arange(n_buckets))
+    bucket_ends = np.append(bucket_starts[1:], n) - 1
+    kept = [np.array([0, n - 1])]
+    for column in values.T:
+        # Sorted by bucket and then value, the first sample of each bucket is its minimum and the last its maximum
+        order = np.lexsort((column, bucket))
+        kept += [order[bucket_starts], order[bucket_ends]]
+    return np.unique(np.concatenate(kept))
+
+def downsample(df: pd.DataFrame, x: str | None, y: str | list[str], budget: int = POINT_BUDGET, method: str = 'lttb', by: str | list[str] | None = None) -> pd.DataFrame:
+    """
+    Rows of df to chart within a budget of points, so the size of a chart does not depend on the sample rate
+    of the telemetry or on the number of laps it shows.
+
+    input:
+        df: the data of the chart
+        x: the column of the horizontal axis for 'lttb', the row order if None
+        y: the column of the vertical axis for 'lttb', or the columns of the signals for 'minmax'
+        budget: the number of rows to keep, shared by the series in proportion to their length
+        method: 'lttb' for lines (see lttb_indices) or 'minmax' for signals whose peaks matter (see minmax_indices)
+        by: the column(s) that identify each series (e.g. the lap or the curve), a single series if None
+
+    output:
+        the kept rows of df, in their original order
+    """
+    if method not in ('lttb', 'minmax'):
+        raise ValueError("method must be one of 'lttb', 'minmax'")
+    if len(df) <= budget:
+        return df
+
+    series = [np.arange(len(df))] if by is None else list(df.groupby(by, sort=False).indices.values())
+    kept = []
+    for rows in series:
+        n_out = max(int(budget * len(rows) / len(df)), 3)
+        if method == 'lttb':
+            xs = rows if x is None else df[x].values[rows]
+            kept.append(rows[lttb_indices(xs, df[y].values[rows], n_out)])
+        else:
+            kept.append(rows[minmax_indices(df[y].values[rows], n_out)])
+    return df.iloc[np.sort(np.concatenate(kept))]
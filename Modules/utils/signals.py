@@ -1,39 +1,106 @@
+import functools
 import numpy as np
+from scipy.signal import oaconvolve
+
+WINDOWS = {
+    'flat': np.ones,
+    'hanning': np.hanning,
+    'hamming': np.hamming,
+    'bartlett': np.bartlett,
+    'blackman': np.blackman,
+}
+
+
+@functools.lru_cache(maxsize=32)
+def window_kernel(window_len: int, window: str = 'hamming') -> np.ndarray:
+    """
+    Normalised smoothing window, built once per (window_len, window). The returned array is read only.
+    """
+    if not window in WINDOWS:
+        raise ValueError("Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
+    w = WINDOWS[window](window_len)
+    w = w/w.sum()
+    w.setflags(write=False)
+    return w
 
 def smooth(x: np.ndarray, window_len: int = 201, window: str = 'hamming'):
     """smooth the data using a window with requested size.
-    
+
     This method is based on the convolution of a scaled window with the signal.
-    The signal is prepared by introducing reflected copies of the signal 
+    The signal is prepared by introducing reflected copies of the signal
     (with the window size) in both ends so that transient parts are minimized
     in the begining and end part of the output signal.
-    
+
     input:
-        x: the input signal 
+        x: the input signal
         window_len: the dimension of the smoothing window; should be an odd integer
         window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
             flat window will produce a moving average smoothing.
 
     output:
-        the smoothed signal
+        the smoothed signal, or the signal itself if it is shorter than the window
     """
 
     if x.ndim != 1:
         raise ValueError("smooth only accepts 1 dimension arrays.")
 
-    if x.size < window_len:
-        raise ValueError("Input vector needs to be bigger than window size.")
+    return smooth_segments(np.asarray(x), np.array([0, x.size]), window_len=window_len, window=window)
 
+def smooth_segments(x: np.ndarray, offsets: np.ndarray, window_len: int = 201, window: str = 'hamming') -> np.ndarray:
+    """
+    Smooths every [start, end) segment of x given by offsets (e.g. the laps of a run telemetry frame, see
+    lap_offsets) independently, as smooth does, in a single convolution.
 
-    if window_len<3:
-        return x
+    Each segment is padded with its own reflected copies, the padded segments are concatenated and convolved
+    at once with the window (by overlap-add FFT), and only the outputs that do not mix segments are kept.
+    Segments shorter than the window (e.g. an aborted lap) can not be smoothed and are returned as they are.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    smoothed = x.copy()
+    # Only segments at least as long as the window are smoothed
+    segments = np.flatnonzero(lengths >= window_len)
 
+    if window_len<3 or not len(segments):
+        return smoothed
 
-    if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-        raise ValueError("Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
+    w = window_kernel(window_len, window)
+    left, right = window_len // 2, window_len - 1 - window_len // 2
+    padded = np.concatenate([
+        np.pad(x[offsets[i]:offsets[i + 1]], (left, right), mode='reflect')
+        for i in segments
+    ])
 
+    convolved = oaconvolve(padded, w, mode='valid')
+    # The output of a segment starts where its padded copy starts
+    padded_starts = np.concatenate([[0], np.cumsum(lengths[segments] + window_len - 1)[:-1]])
+    for i, start in zip(segments, padded_starts):
+        smoothed[offsets[i]:offsets[i + 1]] = convolved[start:start + lengths[i]]
+    return smoothed
 
-    w = np.ones(window_len) if window == 'flat' else eval('np.'+window+'(window_len)')
-    w = w/w.sum()
-    return np.convolve(w, x, mode='same')
+def segment_trapz(y: np.ndarray, t: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Integral of y over t (trapezoidal rule, as np.trapz) in every [start, end) segment given by offsets.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if len(offsets) < 2:
+        return np.array([])
+    areas = 0.5 * (y[1:] + y[:-1]) * np.diff(t)
+    # Trapezoids between the last sample of a segment and the first of the next one are dropped
+    areas[offsets[1:-1] - 1] = 0
+    cumulative = np.concatenate([[0], np.cumsum(areas)])
+    return cumulative[np.maximum(offsets[1:] - 1, offsets[:-1])] - cumulative[offsets[:-1]]
 
+def segment_harshness(x: np.ndarray, t: np.ndarray, offsets: np.ndarray, scale: float = 1, window_len: int = 201, window: str = 'hamming') -> tuple[np.ndarray]:
+    """
+    Harshness of a signal in every segment given by offsets: the integral over time of the absolute difference
+    between the signal and its smoothed version, divided by scale.
+
+    output:
+        the smoothed signal
+        the harshness of each segment
+    """
+    smoothed = smooth_segments(x, offsets, window_len=window_len, window=window)
+    difference = np.abs(np.asarray(x, dtype=np.float64) - smoothed) / scale
+    return smoothed, segment_trapz(difference, np.asarray(t, dtype=np.float64), offsets)
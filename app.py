@@ -3,30 +3,72 @@ import pandas as pd
 import altair as alt
 import numpy as np
 import json
-from os import listdir
-from os.path import dirname, abspath, join, isfile
+from os import environ
+from os.path import dirname, abspath, join
 import vegafusion as vf
 vf.enable()
 
 from Modules import Run, compute_sectors_deltas, compute_sectors_comparison, laps_df
-from Modules.circuit import CircuitChart
+from Modules.registry import RunRegistry
+from Modules.chartcache import ChartCache, chart_key
+from Modules.circuit import CircuitChart, shared_circuit
+from Modules.utils import source_signature
 alt.data_transformers.disable_max_rows()
 
 
 # ---------- DATA LOADING ----------
-with open(join(dirname(abspath(__file__)), 'data', 'info.json'), 'r') as f:
+DATA_DIR = join(dirname(abspath(__file__)), 'data')
+LOAD_WORKERS = int(environ['DPA_LOAD_WORKERS']) if 'DPA_LOAD_WORKERS' in environ else None
+MAX_CACHED_RUNS = int(environ.get('DPA_MAX_CACHED_RUNS', 8))
+MAX_CACHED_RUNS_MB = float(environ['DPA_MAX_CACHED_RUNS_MB']) if 'DPA_MAX_CACHED_RUNS_MB' in environ else None
+MAX_CACHED_CHARTS = int(environ.get('DPA_MAX_CACHED_CHARTS', 256))
+
+with open(join(DATA_DIR, 'info.json'), 'r') as f:
     INFO = json.load(f)
 RUNS = list(INFO.keys())
-RUN_OBJECTS_DICT = {}
 
-for run in RUNS:
-    run_object = None
-    for f in listdir(join(dirname(abspath(__file__)), 'data', run)):
-        if isfile(join(dirname(abspath(__file__)), 'data', run, f)) and f.endswith('.csv'):
-            new_run_object = Run(join(dirname(abspath(__file__)), 'data', run, f), info=INFO[run], filename=f)
-            run_object = new_run_object if run_object is None else run_object + new_run_object
+def load_run(run: str) -> Run:
+    return Run.from_directory(join(DATA_DIR, run), info=INFO[run], workers=LOAD_WORKERS)
+
+@st.cache_resource
+def run_registry() -> RunRegistry:
+    """Process-wide registry, shared by every rerun and session, where runs are loaded the first time they are selected."""
+    return RunRegistry(
+        load_run,
+        max_entries=MAX_CACHED_RUNS,
+        max_bytes=int(MAX_CACHED_RUNS_MB * 2**20) if MAX_CACHED_RUNS_MB is not None else None
+    )
+
+@st.cache_resource
+def chart_cache() -> ChartCache:
+    """Process-wide cache of the charts, so a rerun only rebuilds the charts whose selection or data changed."""
+    return ChartCache(max_entries=MAX_CACHED_CHARTS)
+
+def circuit_chart(seed: int) -> CircuitChart:
+    """Circuit of the run, shared by every rerun and session and loaded from its cached geometry once generated."""
+    return shared_circuit(seed, random_orientation=False)
+
+def run_turns(run: str) -> tuple:
+    """Turns of a run and the signature of its turns.json, both None if the run has no turns.json."""
+    turns_path = join(DATA_DIR, run, 'turns.json')
+    try:
+        with open(turns_path, 'r') as f:
+            return json.load(f), source_signature(turns_path)
+    except FileNotFoundError:
+        return None, None
+
+def run_charts(run: str):
+    """cached_chart of the charts of a run, which are rebuilt when its telemetry or its turns.json change."""
+    _, turns_signature = run_turns(run)
+    data_version = (run_registry().get(run).data_version, json.dumps(turns_signature, sort_keys=True))
+
+    def cached_chart(name: str, build, lap_a: int | None = None, lap_b: int | None = None, selection = None, drivers: bool = False, **params):
+        """Chart of the run for the given selection, built with build() only if it is not cached."""
+        lap_a = None if lap_a == '<select>' else lap_a
+        lap_b = None if lap_b == '<select>' else lap_b
+        return chart_cache().get(chart_key(name, run, lap_a, lap_b, selection, drivers, **params), build, version=data_version)
+    return cached_chart
 
-    RUN_OBJECTS_DICT[run] = run_object
 
 # ---------- APP SETUP ----------
 st.set_page_config(
@@ -44,7 +86,25 @@ lap_panel = st.container()
 with header_panel:
     st.title('DPA Visualization Tool')
 
+# A fragment is run again on its own when one of its widgets changes, instead of the whole app, e.g. moving the
+# microsector slider only reruns the microsectors tab. The selections a fragment depends on are its arguments,
+# and it is run with the rest of the app when they change. Streamlit versions without fragments (before 1.33)
+# rerun the whole app, where fragments are plain functions and only the charts whose selection changed are rebuilt.
+fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None) or (lambda function: function)
+
 # ---------- SELECTORS ----------
+@fragment
+def laps_table(run_selector: str, lapA_selector: int | str, lapB_selector: int | str) -> None:
+    run_object = run_registry().get(run_selector)
+    if lapB_selector != '<select>':
+        laps_data_frame = laps_df(run_object.laps, run_object.info, lapA_selector, lapB_selector)
+    elif lapA_selector != '<select>':
+        laps_data_frame = laps_df(run_object.laps, run_object.info, lapA_selector)
+    else:
+        laps_data_frame = laps_df(run_object.laps, run_object.info)
+    st.dataframe(laps_data_frame)
+
+
 with st.sidebar:
     st.header('Select run and lap')
     run_selector = st.selectbox(
@@ -52,20 +112,21 @@ with st.sidebar:
         RUNS,
         index=0
     )
+    run_object = run_registry().get(run_selector)
     
     lapA_selector = st.selectbox(
         label = 'Select lap A',
-        options = ['<select>'] + list(range(len(RUN_OBJECTS_DICT[run_selector].laps))),
-        format_func = lambda x: f"Lap {x} [{RUN_OBJECTS_DICT[run_selector].laps[x].driver}]" if x != '<select>' else x,
+        options = ['<select>'] + list(range(len(run_object.laps))),
+        format_func = lambda x: f"Lap {x} [{run_object.laps[x].driver}]" if x != '<select>' else x,
         index=0
     )
     
-    lapB_options = set(range(len(RUN_OBJECTS_DICT[run_selector].laps))) - (set([lapA_selector]) if lapA_selector != '<select>' else set())
+    lapB_options = set(range(len(run_object.laps))) - (set([lapA_selector]) if lapA_selector != '<select>' else set())
     lapB_options = ['<select>'] + list(lapB_options)
     lapB_selector = st.selectbox(
         'Select lap B',
         options = lapB_options,
-        format_func = lambda x: f"Lap {x} [{RUN_OBJECTS_DICT[run_selector].laps[x].driver}]" if x != '<select>' else x,
+        format_func = lambda x: f"Lap {x} [{run_object.laps[x].driver}]" if x != '<select>' else x,
         index=0,
         disabled = True if lapA_selector == '<select>' else False
     )
@@ -73,22 +134,16 @@ with st.sidebar:
     if lapB_selector != '<select>' and lapA_selector > lapB_selector:
         lapA_selector, lapB_selector = lapB_selector, lapA_selector
     
-    if lapB_selector != '<select>':
-        laps_data_frame = laps_df(RUN_OBJECTS_DICT[run_selector].laps, RUN_OBJECTS_DICT[run_selector].info, lapA_selector, lapB_selector)
-    elif lapA_selector != '<select>':
-        laps_data_frame = laps_df(RUN_OBJECTS_DICT[run_selector].laps, RUN_OBJECTS_DICT[run_selector].info, lapA_selector)
-    else:
-        laps_data_frame = laps_df(RUN_OBJECTS_DICT[run_selector].laps, RUN_OBJECTS_DICT[run_selector].info)
-    st.dataframe(laps_data_frame)
+    laps_table(run_selector, lapA_selector, lapB_selector)
 
 # ---------- RUN PANEL ----------
-try:
-    with open(join(dirname(abspath(__file__)), 'data', run_selector, 'turns.json'), 'r') as f:
-        turns_json = json.load(f)
-except FileNotFoundError:
-    turns_json = None
+@fragment
+def run_overview(run_selector: str, lapA_selector: int | str, lapB_selector: int | str) -> None:
+    run_object = run_registry().get(run_selector)
+    circuit = circuit_chart(int(run_selector.split(':')[1]))
+    turns_json, _ = run_turns(run_selector)
+    cached_chart = run_charts(run_selector)
 
-with run_panel:
     st.divider()
     st.header('Run overview')
 
@@ -101,10 +156,11 @@ with run_panel:
         else:
             with radars_panel:
                 if lapA_selector == '<select>':
-                    mean_v_chart, out_v_chart, braking_point_chart = RUN_OBJECTS_DICT[run_selector].braking_charts(turns_json)
+                    mean_v_chart, out_v_chart, braking_point_chart = cached_chart('braking', lambda: run_object.braking_charts(turns_json))
                 else:
                     lap_numbers = [lapA_selector, lapB_selector] if lapB_selector != '<select>' else [lapA_selector]
-                    mean_v_chart, out_v_chart, braking_point_chart = RUN_OBJECTS_DICT[run_selector].braking_charts(turns_json, laps=lap_numbers)
+                    mean_v_chart, out_v_chart, braking_point_chart = cached_chart(
+                        'braking', lambda: run_object.braking_charts(turns_json, laps=lap_numbers), lapA_selector, lapB_selector)
                 
                 columns = st.columns(2)
                 with columns[0]:
@@ -120,24 +176,35 @@ with run_panel:
                         st.write('No turns data available, please build the turns data for this run first.')
                     else:
                         st.write('The following chart shows the circuit turns. These turns have been manually defined with microsectors, hovering the mouse over the chart you can see the turn number and the microsector number.')
-                        circuit = CircuitChart(seed=int(run_selector.split(':')[1]), random_orientation=False)
                         st.altair_chart(
-                            circuit.turns_chart(turns_json=turns_json)
+                            cached_chart('turns', lambda: circuit.turns_chart(turns_json=turns_json))
                         )
                         st.markdown('In order to change each turn microsectors modify the `turns.json` file in the run folder.')
 
 
         with harshness_panel:
             if lapA_selector == '<select>':
-                throttle_harshness_chart = RUN_OBJECTS_DICT[run_selector].throttle_harshness_chart(scheme="tableau20")
-                steering_harshness_chart = RUN_OBJECTS_DICT[run_selector].steering_harshness_chart(scheme="tableau20")
+                throttle_harshness_chart = cached_chart('throttle_harshness', lambda: run_object.throttle_harshness_chart(scheme="tableau20"))
+                steering_harshness_chart = cached_chart('steering_harshness', lambda: run_object.steering_harshness_chart(scheme="tableau20"))
             else:
                 lap_numbers = [lapA_selector, lapB_selector] if lapB_selector != '<select>' else [lapA_selector]
-                throttle_harshness_chart = RUN_OBJECTS_DICT[run_selector].throttle_harshness_chart(laps=lap_numbers)
-                steering_harshness_chart = RUN_OBJECTS_DICT[run_selector].steering_harshness_chart(laps=lap_numbers)
+                throttle_harshness_chart = cached_chart('throttle_harshness', lambda: run_object.throttle_harshness_chart(laps=lap_numbers), lapA_selector, lapB_selector)
+                steering_harshness_chart = cached_chart('steering_harshness', lambda: run_object.steering_harshness_chart(laps=lap_numbers), lapA_selector, lapB_selector)
 
             st.altair_chart(alt.vconcat(throttle_harshness_chart.properties(height=200, width=220), steering_harshness_chart.properties(height=200, width=220)), use_container_width=True)
 
+        reference_selector = st.selectbox(
+            'Reference lap',
+            options = ['<fastest>'] + sorted(set(lap.driver for lap in run_object.laps)),
+            format_func = lambda x: 'Fastest lap' if x == '<fastest>' else f"{x}'s best lap",
+            index=0
+        )
+        reference = None if reference_selector == '<fastest>' else reference_selector
+        st.altair_chart(
+            cached_chart('laps_delta_heatmap', lambda: run_object.laps_delta_heatmap_chart(circuit, reference=reference), reference=reference),
+            use_container_width=True
+        )
+
     with drivers_tab:
         if lapA_selector != '<select>':
             st.warning('Drivers\' Run overview is not available when laps are selected.')
@@ -147,7 +214,7 @@ with run_panel:
                 st.error('No turns data available, please build the turns data for this run first.')
             else:
                 with radars_panel:
-                    mean_v_chart, out_v_chart, braking_point_chart = RUN_OBJECTS_DICT[run_selector].braking_charts(turns_json, drivers=True)
+                    mean_v_chart, out_v_chart, braking_point_chart = cached_chart('braking', lambda: run_object.braking_charts(turns_json, drivers=True), drivers=True)
                     
                     columns = st.columns(2)
                     with columns[0]:
@@ -163,219 +230,274 @@ with run_panel:
                             st.write('No turns data available, please build the turns data for this run first.')
                         else:
                             st.write('The following chart shows the circuit turns. These turns have been manually defined with microsectors, hovering the mouse over the chart you can see the turn number and the microsector number.')
-                            circuit = CircuitChart(seed=int(run_selector.split(':')[1]), random_orientation=False)
                             st.altair_chart(
-                                circuit.turns_chart(turns_json=turns_json)
+                                cached_chart('turns', lambda: circuit.turns_chart(turns_json=turns_json))
                             )
                             st.markdown('In order to change each turn microsectors modify the `turns.json` file in the run folder.')
 
 
             with harshness_panel:
-                throttle_harshness_chart = RUN_OBJECTS_DICT[run_selector].throttle_harshness_chart(drivers=True)
-                steering_harshness_chart = RUN_OBJECTS_DICT[run_selector].steering_harshness_chart(drivers=True)
+                throttle_harshness_chart = cached_chart('throttle_harshness', lambda: run_object.throttle_harshness_chart(drivers=True), drivers=True)
+                steering_harshness_chart = cached_chart('steering_harshness', lambda: run_object.steering_harshness_chart(drivers=True), drivers=True)
 
                 st.altair_chart(throttle_harshness_chart.properties(height=300), use_container_width=True)
                 st.altair_chart(steering_harshness_chart.properties(height=300), use_container_width=True)
 
-# ---------- LAP PANEL ----------
-if lapA_selector != '<select>':
-    laps_data_frame = laps_df(RUN_OBJECTS_DICT[run_selector].laps, RUN_OBJECTS_DICT[run_selector].info, lapA_selector)
-else:
-    laps_data_frame = laps_df(RUN_OBJECTS_DICT[run_selector].laps, RUN_OBJECTS_DICT[run_selector].info)
+                with st.expander('Input spectra', expanded=False):
+                    st.write('Mean power spectral density of the inputs of each driver. More power at high frequencies means more small, fast corrections.')
+                    st.altair_chart(cached_chart('steering_spectrum', lambda: run_object.spectrum_chart('Steering'), drivers=True).properties(height=200), use_container_width=True)
+                    st.altair_chart(cached_chart('throttle_spectrum', lambda: run_object.spectrum_chart('Throttle'), drivers=True).properties(height=200), use_container_width=True)
 
-with lap_panel:
-    st.divider()
-    st.header('Lap overview')
-    circuit = CircuitChart(seed=int(run_selector.split(':')[1]), random_orientation=False)
-    sectors, microsectors = st.tabs(['Sectors', 'Microsectors'])
-    
-    with sectors:
-        if lapA_selector == '<select>':
-            st.altair_chart(
-                circuit.track_chart(),
-            )
-        else:
-            sector = st.radio(
-                'Select sector',
-                options = ['All sectors'] + RUN_OBJECTS_DICT[run_selector].df['sector'].unique().tolist(),
-                index = 0,
-                format_func = lambda x: f"Sector {x}" if x != 'All sectors' else x,
-                horizontal = True
-            )
-
-            if sector == 'All sectors':
-                track, delta_comparison = st.columns(2)
-                with delta_comparison:
-                    if lapB_selector != '<select>':
-                        st.altair_chart(
-                            RUN_OBJECTS_DICT[run_selector].laps_delta_comparison_chart(
-                                circuit, lapA_selector, lapB_selector),
-                            use_container_width=True
-                        )
-                
-                with track:
-                    if lapB_selector == '<select>':
-                        racing_line_df = RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].racing_line_df(curve_name='lapA', sector=(1,30))
-                        sectors_delta = compute_sectors_deltas(
-                            info=RUN_OBJECTS_DICT[run_selector].info,
-                            filename=RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].filename,
-                            lap=lapA_selector - RUN_OBJECTS_DICT[run_selector].lap_map[lapA_selector]
-                        )
-                        st.altair_chart(
-                            circuit.chart(middle_curve_df=racing_line_df, info=sectors_delta),
-                            use_container_width=True
-                        )
-                    else:
-                        sectors_comparison = compute_sectors_comparison(
-                            info=RUN_OBJECTS_DICT[run_selector].info,
-                            filenameA=RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].filename,
-                            global_lapA=lapA_selector,
-                            lapA=lapA_selector - RUN_OBJECTS_DICT[run_selector].lap_map[lapA_selector],
-                            filenameB=RUN_OBJECTS_DICT[run_selector].laps[lapB_selector].filename,
-                            global_lapB=lapB_selector,
-                            lapB=lapB_selector - RUN_OBJECTS_DICT[run_selector].lap_map[lapB_selector]
-                            )
-                        st.altair_chart(
-                            circuit.colored_sectors_chart(sectors_comparison, laps=[lapA_selector, lapB_selector]),
-                            use_container_width=True
-                        )
+with run_panel:
+    run_overview(run_selector, lapA_selector, lapB_selector)
 
-            else:
-                sector_idx = sector - 1
-                
+# ---------- LAP PANEL ----------
+@fragment
+def lap_overview_sectors(run_selector: str, lapA_selector: int | str, lapB_selector: int | str) -> None:
+    run_object = run_registry().get(run_selector)
+    circuit = circuit_chart(int(run_selector.split(':')[1]))
+    cached_chart = run_charts(run_selector)
+
+    if lapA_selector == '<select>':
+        st.altair_chart(
+            cached_chart('track', lambda: circuit.track_chart()),
+        )
+    else:
+        sector = st.radio(
+            'Select sector',
+            options = ['All sectors'] + run_object.df['sector'].unique().tolist(),
+            index = 0,
+            format_func = lambda x: f"Sector {x}" if x != 'All sectors' else x,
+            horizontal = True
+        )
+
+        if sector == 'All sectors':
+            track, delta_comparison = st.columns(2)
+            with delta_comparison:
                 if lapB_selector != '<select>':
-                    sector_racing_line, sector_gg_diagram, delta_comparison = st.columns(3)
-                    with delta_comparison:
-                        st.altair_chart(
-                            RUN_OBJECTS_DICT[run_selector].laps_delta_comparison_chart(
-                                circuit, lapA_selector, lapB_selector, sector=sector),
-                            use_container_width=True
-                        )
+                    st.altair_chart(
+                        cached_chart('laps_delta_comparison', lambda: run_object.laps_delta_comparison_chart(
+                            circuit, lapA_selector, lapB_selector), lapA_selector, lapB_selector),
+                        use_container_width=True
+                    )
                 else:
-                    sector_racing_line, sector_gg_diagram = st.columns(2)
-
-                with sector_racing_line:
-                    if lapA_selector == '<select>':
+                    ideal_driver = st.radio(
+                        'Theoretical best lap of',
+                        options = ['<all>', run_object.laps[lapA_selector].driver],
+                        format_func = lambda x: 'All drivers' if x == '<all>' else x,
+                        horizontal = True
+                    )
+                    ideal_driver = None if ideal_driver == '<all>' else ideal_driver
+                    ideal_lap = run_object.ideal_lap(ideal_driver)
+                    if ideal_lap.lap is None:
+                        st.warning('There are no microsector times to build the theoretical best lap.')
+                    else:
+                        st.caption(f'Best microsectors of laps {", ".join(map(str, sorted(set(ideal_lap.microsector_laps.tolist()) - {-1})))}, in orange.')
                         st.altair_chart(
-                            circuit.chart(sector=sector_idx),
+                            cached_chart('ideal_lap_racing_lines', lambda: circuit.chart(middle_curve_df=pd.concat([
+                                run_object.laps[lapA_selector].racing_line_df(curve_name='lapA'),
+                                ideal_lap.lap.racing_line_df(curve_name='lapB')
+                            ])), lapA_selector, ideal_driver=ideal_driver),
                             use_container_width=True
                         )
-                    elif lapB_selector == '<select>':
-                        racing_line_df = RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].racing_line_df(curve_name='lapA', sector=sector)
-                        sectors_delta = compute_sectors_deltas(
-                            info=RUN_OBJECTS_DICT[run_selector].info,
-                            filename=RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].filename,
-                            lap=lapA_selector - RUN_OBJECTS_DICT[run_selector].lap_map[lapA_selector]
-                        )
                         st.altair_chart(
-                            circuit.chart(middle_curve_df=racing_line_df, sector=sector_idx, info=[sectors_delta[sector_idx]]),
+                            cached_chart('ideal_lap', lambda: run_object.ideal_lap_chart(circuit, lapA_selector, driver=ideal_driver), lapA_selector, ideal_driver=ideal_driver),
                             use_container_width=True
                         )
-                    else:
-                        racing_line_df = RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].racing_line_df(curve_name='lapA', sector=sector)
-                        racing_line_df = pd.concat([racing_line_df, RUN_OBJECTS_DICT[run_selector].laps[lapB_selector].racing_line_df(curve_name='lapB', sector=sector)])
-                        st.altair_chart(
-                            circuit.chart(middle_curve_df=racing_line_df, sector=sector_idx),
-                            use_container_width=True
+
+            with track:
+                if lapB_selector == '<select>':
+                    sectors_delta = compute_sectors_deltas(
+                        info=run_object.info,
+                        filename=run_object.laps[lapA_selector].filename,
+                        lap=lapA_selector - run_object.lap_map[lapA_selector]
+                    )
+                    st.altair_chart(
+                        cached_chart('racing_line', lambda: circuit.chart(
+                            middle_curve_df=run_object.laps[lapA_selector].racing_line_df(curve_name='lapA', sector=(1,30)),
+                            info=sectors_delta), lapA_selector, selection='sectors'),
+                        use_container_width=True
+                    )
+                else:
+                    sectors_comparison = compute_sectors_comparison(
+                        info=run_object.info,
+                        filenameA=run_object.laps[lapA_selector].filename,
+                        global_lapA=lapA_selector,
+                        lapA=lapA_selector - run_object.lap_map[lapA_selector],
+                        filenameB=run_object.laps[lapB_selector].filename,
+                        global_lapB=lapB_selector,
+                        lapB=lapB_selector - run_object.lap_map[lapB_selector]
                         )
-                
-                with sector_gg_diagram:
-                    if lapA_selector != '<select>':
-                        gg_diagram = RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].gg_diagram(sector=sector)
-                        if lapB_selector != '<select>':
-                            gg_diagram += RUN_OBJECTS_DICT[run_selector].laps[lapB_selector].gg_diagram(sector=sector)
-                        st.altair_chart(gg_diagram, use_container_width=True)
+                    st.altair_chart(
+                        cached_chart('colored_sectors', lambda: circuit.colored_sectors_chart(sectors_comparison, laps=[lapA_selector, lapB_selector]), lapA_selector, lapB_selector, selection='sectors'),
+                        use_container_width=True
+                    )
 
-    with microsectors:
-        if lapA_selector == '<select>':
-            st.altair_chart(
-                circuit.track_chart(microsectors=True),
-            )
         else:
-            microsector = st.select_slider(
-                'Select microsector',
-                options=RUN_OBJECTS_DICT[run_selector].df['microsector'].unique().tolist(),
-                value=(1, 30),
-                format_func = lambda x: f"Microsector {x}",
-            )
-            if microsector == (1, 30):
-                microsector = 'All microsectors'
-
-            if microsector == 'All microsectors':
-                track, delta_comparison = st.columns(2)
-                with delta_comparison:
-                    if lapB_selector != '<select>':
-                        st.altair_chart(
-                            RUN_OBJECTS_DICT[run_selector].laps_delta_comparison_chart(
-                                circuit, lapA_selector, lapB_selector, sector=tuple()),
-                            use_container_width=True
-                        )
-                
-                with track:
-                    if lapB_selector == '<select>':
-                        racing_line_df = RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].racing_line_df(curve_name='lapA', sector=(1,30))
-                        microsectors_delta = compute_sectors_deltas(
-                            info=RUN_OBJECTS_DICT[run_selector].info,
-                            filename=RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].filename,
-                            lap=lapA_selector - RUN_OBJECTS_DICT[run_selector].lap_map[lapA_selector],
-                            microsectors=True
-                            )
-                        st.altair_chart(
-                            circuit.chart(middle_curve_df=racing_line_df, info=microsectors_delta),
-                            use_container_width=True
-                        )
-                    else:
-                        microsectors_comparison = compute_sectors_comparison(
-                            info=RUN_OBJECTS_DICT[run_selector].info,
-                            filenameA=RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].filename,
-                            global_lapA=lapA_selector,
-                            lapA=lapA_selector - RUN_OBJECTS_DICT[run_selector].lap_map[lapA_selector],
-                            filenameB=RUN_OBJECTS_DICT[run_selector].laps[lapB_selector].filename,
-                            global_lapB=lapB_selector,
-                            lapB=lapB_selector - RUN_OBJECTS_DICT[run_selector].lap_map[lapB_selector],
-                            microsectors=True
-                            )
-                        st.altair_chart(
-                            circuit.colored_sectors_chart(microsectors_comparison, microsectors=True, laps=[lapA_selector, lapB_selector]),
-                            use_container_width=True
-                        )
+            sector_idx = sector - 1
 
+            if lapB_selector != '<select>':
+                sector_racing_line, sector_gg_diagram, delta_comparison = st.columns(3)
+                with delta_comparison:
+                    st.altair_chart(
+                        cached_chart('laps_delta_comparison', lambda: run_object.laps_delta_comparison_chart(
+                            circuit, lapA_selector, lapB_selector, sector=sector), lapA_selector, lapB_selector, selection=sector),
+                        use_container_width=True
+                    )
             else:
-                microsector_idx = (microsector[0] - 1, microsector[1] - 1)
-                
+                sector_racing_line, sector_gg_diagram = st.columns(2)
+
+            with sector_racing_line:
+                if lapA_selector == '<select>':
+                    st.altair_chart(
+                        cached_chart('circuit', lambda: circuit.chart(sector=sector_idx), selection=sector),
+                        use_container_width=True
+                    )
+                elif lapB_selector == '<select>':
+                    sectors_delta = compute_sectors_deltas(
+                        info=run_object.info,
+                        filename=run_object.laps[lapA_selector].filename,
+                        lap=lapA_selector - run_object.lap_map[lapA_selector]
+                    )
+                    st.altair_chart(
+                        cached_chart('racing_line', lambda: circuit.chart(
+                            middle_curve_df=run_object.laps[lapA_selector].racing_line_df(curve_name='lapA', sector=sector),
+                            sector=sector_idx, info=[sectors_delta[sector_idx]]), lapA_selector, selection=sector),
+                        use_container_width=True
+                    )
+                else:
+                    st.altair_chart(
+                        cached_chart('racing_line', lambda: circuit.chart(middle_curve_df=pd.concat([
+                            run_object.laps[lapA_selector].racing_line_df(curve_name='lapA', sector=sector),
+                            run_object.laps[lapB_selector].racing_line_df(curve_name='lapB', sector=sector)
+                        ]), sector=sector_idx), lapA_selector, lapB_selector, selection=sector),
+                        use_container_width=True
+                    )
+
+            with sector_gg_diagram:
+                if lapA_selector != '<select>':
+                    def gg_diagram():
+                        chart = run_object.laps[lapA_selector].gg_diagram(sector=sector)
+                        if lapB_selector != '<select>':
+                            chart += run_object.laps[lapB_selector].gg_diagram(sector=sector)
+                        return chart
+                    st.altair_chart(cached_chart('gg_diagram', gg_diagram, lapA_selector, lapB_selector, selection=sector), use_container_width=True)
+
+@fragment
+def lap_overview_microsectors(run_selector: str, lapA_selector: int | str, lapB_selector: int | str) -> None:
+    run_object = run_registry().get(run_selector)
+    circuit = circuit_chart(int(run_selector.split(':')[1]))
+    cached_chart = run_charts(run_selector)
+
+    if lapA_selector == '<select>':
+        st.altair_chart(
+            cached_chart('track', lambda: circuit.track_chart(microsectors=True), microsectors=True),
+        )
+    else:
+        microsector = st.select_slider(
+            'Select microsector',
+            options=run_object.df['microsector'].unique().tolist(),
+            value=(1, 30),
+            format_func = lambda x: f"Microsector {x}",
+        )
+        if microsector == (1, 30):
+            microsector = 'All microsectors'
+
+        if microsector == 'All microsectors':
+            track, delta_comparison = st.columns(2)
+            with delta_comparison:
                 if lapB_selector != '<select>':
-                    microsector_racing_line, microsector_gg_diagram, delta_comparison = st.columns(3)
-                    with delta_comparison:
-                        st.altair_chart(
-                            RUN_OBJECTS_DICT[run_selector].laps_delta_comparison_chart(
-                                circuit, lapA_selector, lapB_selector, sector=microsector),
-                            use_container_width=True
+                    st.altair_chart(
+                        cached_chart('laps_delta_comparison', lambda: run_object.laps_delta_comparison_chart(
+                            circuit, lapA_selector, lapB_selector, sector=tuple()), lapA_selector, lapB_selector, selection=tuple()),
+                        use_container_width=True
+                    )
+
+            with track:
+                if lapB_selector == '<select>':
+                    microsectors_delta = compute_sectors_deltas(
+                        info=run_object.info,
+                        filename=run_object.laps[lapA_selector].filename,
+                        lap=lapA_selector - run_object.lap_map[lapA_selector],
+                        microsectors=True
                         )
+                    st.altair_chart(
+                        cached_chart('racing_line', lambda: circuit.chart(
+                            middle_curve_df=run_object.laps[lapA_selector].racing_line_df(curve_name='lapA', sector=(1,30)),
+                            info=microsectors_delta), lapA_selector, selection='microsectors'),
+                        use_container_width=True
+                    )
                 else:
-                    microsector_racing_line, microsector_gg_diagram = st.columns(2)
-
-                with microsector_racing_line:
-                    if lapA_selector == '<select>':
-                        st.altair_chart(
-                            circuit.chart(sector=microsector_idx),
-                            use_container_width=True
+                    microsectors_comparison = compute_sectors_comparison(
+                        info=run_object.info,
+                        filenameA=run_object.laps[lapA_selector].filename,
+                        global_lapA=lapA_selector,
+                        lapA=lapA_selector - run_object.lap_map[lapA_selector],
+                        filenameB=run_object.laps[lapB_selector].filename,
+                        global_lapB=lapB_selector,
+                        lapB=lapB_selector - run_object.lap_map[lapB_selector],
+                        microsectors=True
                         )
-                    else:
-                        racing_line_df = RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].racing_line_df(curve_name='lapA', sector=microsector)
+                    st.altair_chart(
+                        cached_chart('colored_sectors', lambda: circuit.colored_sectors_chart(microsectors_comparison, microsectors=True, laps=[lapA_selector, lapB_selector]), lapA_selector, lapB_selector, selection='microsectors'),
+                        use_container_width=True
+                    )
+
+        else:
+            microsector_idx = (microsector[0] - 1, microsector[1] - 1)
+
+            if lapB_selector != '<select>':
+                microsector_racing_line, microsector_gg_diagram, delta_comparison = st.columns(3)
+                with delta_comparison:
+                    st.altair_chart(
+                        cached_chart('laps_delta_comparison', lambda: run_object.laps_delta_comparison_chart(
+                            circuit, lapA_selector, lapB_selector, sector=microsector), lapA_selector, lapB_selector, selection=microsector),
+                        use_container_width=True
+                    )
+            else:
+                microsector_racing_line, microsector_gg_diagram = st.columns(2)
+
+            with microsector_racing_line:
+                if lapA_selector == '<select>':
+                    st.altair_chart(
+                        cached_chart('circuit', lambda: circuit.chart(sector=microsector_idx), selection=microsector),
+                        use_container_width=True
+                    )
+                else:
+                    def racing_line_chart():
+                        racing_line_df = run_object.laps[lapA_selector].racing_line_df(curve_name='lapA', sector=microsector)
                         if lapB_selector != '<select>':
-                            racing_line_df = pd.concat([racing_line_df, RUN_OBJECTS_DICT[run_selector].laps[lapB_selector].racing_line_df(curve_name='lapB', sector=microsector)])
-                        st.altair_chart(
-                            circuit.chart(middle_curve_df=racing_line_df, sector=microsector_idx),
-                            use_container_width=True
-                        )
-                
-                with microsector_gg_diagram:
-                    if lapA_selector != '<select>':
-                        gg_diagram = RUN_OBJECTS_DICT[run_selector].laps[lapA_selector].gg_diagram(sector=microsector)
+                            racing_line_df = pd.concat([racing_line_df, run_object.laps[lapB_selector].racing_line_df(curve_name='lapB', sector=microsector)])
+                        return circuit.chart(middle_curve_df=racing_line_df, sector=microsector_idx)
+                    st.altair_chart(
+                        cached_chart('racing_line', racing_line_chart, lapA_selector, lapB_selector, selection=microsector),
+                        use_container_width=True
+                    )
+
+            with microsector_gg_diagram:
+                if lapA_selector != '<select>':
+                    def gg_diagram():
+                        chart = run_object.laps[lapA_selector].gg_diagram(sector=microsector)
                         if lapB_selector != '<select>':
-                            gg_diagram += RUN_OBJECTS_DICT[run_selector].laps[lapB_selector].gg_diagram(sector=microsector)
-                        st.altair_chart(gg_diagram, use_container_width=True)
+                            chart += run_object.laps[lapB_selector].gg_diagram(sector=microsector)
+                        return chart
+                    st.altair_chart(cached_chart('gg_diagram', gg_diagram, lapA_selector, lapB_selector, selection=microsector), use_container_width=True)
 
+with lap_panel:
+    st.divider()
+    st.header('Lap overview')
+    sectors, microsectors = st.tabs(['Sectors', 'Microsectors'])
+
+    with sectors:
+        lap_overview_sectors(run_selector, lapA_selector, lapB_selector)
+
+    with microsectors:
+        lap_overview_microsectors(run_selector, lapA_selector, lapB_selector)
+
+# Shown last, so the counters include the charts of this rerun
+with st.sidebar:
+    with st.expander('Chart cache', expanded=False):
+        st.json(chart_cache().stats())
 
-# st.dataframe(RUN_OBJECTS_DICT[run_selector].df)
-# st.dataframe(RUN_OBJECTS_DICT[run_selector].describe())
\ No newline at end of file
+# st.dataframe(run_object.df)
+# st.dataframe(run_object.describe())
\ No newline at end of file
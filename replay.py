@@ -0,0 +1,43 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+
+def replay(source: str, destination: str, speed: float = 1.0, interval: float = 0.1) -> None:
+    """Writes the rows of a telemetry csv into destination as they would have been logged by the car.
+
+    The time of each row is the cumulative sum of the delta column. Rows are written in batches every
+    interval seconds, speed times faster than real time.
+    """
+    df = pd.read_csv(source)
+    times = df['delta'].cumsum().values
+
+    with open(destination, 'w') as f:
+        df.head(0).to_csv(f, index=False)
+        f.flush()
+
+        start = time.monotonic()
+        written = 0
+        while written < len(df):
+            time.sleep(interval)
+            elapsed = (time.monotonic() - start) * speed
+            until = int(np.searchsorted(times, elapsed, side='right'))
+            if until > written:
+                df.iloc[written:until].to_csv(f, header=False, index=False)
+                f.flush()
+                written = until
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Replay a telemetry csv at real-time speed, to test the live mode without the car.')
+    parser.add_argument('source', help='Telemetry csv to replay.')
+    parser.add_argument('destination', help='File where the telemetry is written.')
+    parser.add_argument('-s', '--speed', dest='speed', default=1.0, help='Replay speed, 1 is real time.', type=float)
+    parser.add_argument('-i', '--interval', dest='interval', default=0.1, help='Seconds between writes.', type=float)
+    args = parser.parse_args()
+
+    replay(args.source, args.destination, speed=args.speed, interval=args.interval)
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,269 @@
+import os
+import json
+import glob
+import hashlib
+import argparse
+from os import listdir
+from os.path import dirname, abspath, join, isfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import altair as alt
+import vl_convert as vlc
+
+from Modules import Run, compute_sectors_deltas, laps_df
+from Modules.circuit import CircuitChart, shared_circuit, tilke_version
+from Modules.registry import RunRegistry
+from Modules.utils import source_signature, file_digest
+
+ROOT_DIR = dirname(abspath(__file__))
+DATA_DIR = join(ROOT_DIR, 'data')
+REPORT_DIR = join(ROOT_DIR, 'report')
+REPORT_VERSION = 1
+MANIFEST = 'manifest.json'
+FORMATS = ('svg', 'png', 'html')
+# Vega-Lite version of the specs written by the installed Altair, e.g. '4.17'
+VL_VERSION = alt.SCHEMA_VERSION.lstrip('v').rsplit('.', 1)[0]
+
+# Charts of every circuit, and charts of every driver of a circuit. Charts in TURNS_CHARTS need turns.json.
+RUN_CHARTS = ['laps', 'braking', 'turns', 'throttle_harshness', 'steering_harshness', 'laps_delta_heatmap']
+DRIVER_CHARTS = ['racing_line', 'laps_delta_heatmap', 'ideal_lap']
+TURNS_CHARTS = {'braking', 'turns'}
+
+
+# Runs loaded by a worker process, kept for its next tasks of the same circuit
+_RUNS = RunRegistry(lambda key: load_run(*key), max_entries=2)
+
+def load_run(data_dir: str, run: str) -> Run:
+    with open(join(data_dir, 'info.json'), 'r') as f:
+        info = json.load(f)
+    return Run.from_directory(join(data_dir, run), info=info[run], workers=1)
+
+def load_turns(data_dir: str, run: str) -> list[dict] | None:
+    turns_path = join(data_dir, run, 'turns.json')
+    if not isfile(turns_path):
+        return None
+    with open(turns_path, 'r') as f:
+        return json.load(f)
+
+def circuit_seed(run: str) -> int:
+    return int(run.split(':')[1])
+
+def slug(name: str) -> str:
+    return ''.join(c if c.isalnum() or c in '-_.' else '-' for c in name)
+
+def code_digest() -> str:
+    """
+    Digest of the code that builds the charts (the Modules package, this script and tilke), so a change to it
+    renders the report again.
+    """
+    sha = hashlib.sha256(tilke_version().encode())
+    for path in sorted(glob.glob(join(ROOT_DIR, 'Modules', '**', '*.py'), recursive=True) + [abspath(__file__)]):
+        sha.update(file_digest(path).encode())
+    return sha.hexdigest()
+
+def input_hash(data_dir: str, run: str, chart: str, driver: str | None, formats: list[str], scale: float, code: str, info: dict) -> str:
+    """
+    Hash of everything a chart is built from: the telemetry files and turns.json of the circuit (by signature,
+    see source_signature), its info, the chart, the driver, the output formats and the code.
+    """
+    run_dir = join(data_dir, run)
+    sources = {
+        filename: source_signature(join(run_dir, filename))
+        for filename in sorted(listdir(run_dir)) if filename.endswith('.csv') or filename == 'turns.json'
+    }
+    key = {
+        'version': REPORT_VERSION, 'code': code, 'sources': sources, 'info': info[run],
+        'chart': chart, 'driver': driver, 'formats': sorted(formats), 'scale': scale,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def report_tasks(data_dir: str, runs: list[str], info: dict) -> list[tuple]:
+    """
+    A (run, chart, driver) task per chart of the report, driver being None for the charts of the whole circuit.
+    The drivers of a circuit are those of its telemetry files, read from its info.
+    """
+    tasks = []
+    for run in runs:
+        run_dir = join(data_dir, run)
+        has_turns = isfile(join(run_dir, 'turns.json'))
+        tasks += [(run, chart, None) for chart in RUN_CHARTS if has_turns or chart not in TURNS_CHARTS]
+        drivers = sorted({info[run][filename]['driver'] for filename in listdir(run_dir) if filename in info[run] and filename.endswith('.csv')})
+        tasks += [(run, chart, driver) for driver in drivers for chart in DRIVER_CHARTS]
+    return tasks
+
+def build_charts(run: Run, circuit: CircuitChart, turns_json: list[dict] | None, chart: str, driver: str | None) -> dict:
+    """
+    Charts of a task, by the suffix of their file name. The laps table is returned as a pandas Styler.
+    """
+    if chart == 'laps':
+        return {'': laps_df(run.laps, run.info)}
+    if chart == 'braking':
+        mean_v_chart, out_v_chart, braking_point_chart = run.braking_charts(turns_json, drivers=True)
+        return {'-mean_velocity': mean_v_chart, '-exit_velocity': out_v_chart, '-braking_point': braking_point_chart}
+    if chart == 'turns':
+        return {'': circuit.turns_chart(turns_json=turns_json)}
+    if chart == 'throttle_harshness':
+        return {'': run.throttle_harshness_chart(drivers=True)}
+    if chart == 'steering_harshness':
+        return {'': run.steering_harshness_chart(drivers=True)}
+    if chart == 'laps_delta_heatmap':
+        return {'': run.laps_delta_heatmap_chart(circuit, reference=driver)}
+
+    best_lap = run.laps[run.reference_lap(driver)]
+    if chart == 'racing_line':
+        sectors_delta = compute_sectors_deltas(
+            info=run.info,
+            filename=best_lap.filename,
+            lap=best_lap.number - run.lap_map[best_lap.number]
+        )
+        return {'': circuit.chart(middle_curve_df=best_lap.racing_line_df(curve_name='lapA', sector=(1, 30)), info=sectors_delta)}
+    if chart == 'ideal_lap':
+        # A driver without microsector times has no theoretical best lap, and no chart of it
+        if run.ideal_lap(driver).lap is None:
+            return {}
+        return {'': run.ideal_lap_chart(circuit, best_lap.number, driver=driver)}
+    raise ValueError(f'Unknown chart {chart}')
+
+def save_chart(chart: alt.TopLevelMixin, path: str, formats: list[str], scale: float = 1.0) -> list[str]:
+    """
+    Renders a chart to path.<format> for each format, with vl-convert for svg and png.
+    """
+    paths = []
+    spec = json.dumps(chart.to_dict())
+    for fmt in formats:
+        out = f'{path}.{fmt}'
+        if fmt == 'svg':
+            with open(out, 'w') as f:
+                f.write(vlc.vegalite_to_svg(spec, vl_version=VL_VERSION))
+        elif fmt == 'png':
+            with open(out, 'wb') as f:
+                f.write(vlc.vegalite_to_png(spec, vl_version=VL_VERSION, scale=scale))
+        elif fmt == 'html':
+            chart.save(out, format='html')
+        else:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        paths.append(out)
+    return paths
+
+def render_task(data_dir: str, output_dir: str, run: str, chart: str, driver: str | None, formats: list[str], scale: float) -> list[str]:
+    """
+    Builds and renders the charts of a task, in a worker process.
+
+    output:
+        the paths of the written files
+    """
+    alt.data_transformers.disable_max_rows()
+    run_object = _RUNS.get((data_dir, run))
+    circuit = shared_circuit(circuit_seed(run))
+    turns_json = load_turns(data_dir, run)
+
+    run_dir = join(output_dir, slug(run))
+    os.makedirs(run_dir, exist_ok=True)
+    stem = join(run_dir, chart if driver is None else f'{chart}-{slug(driver)}')
+
+    paths = []
+    for suffix, built in build_charts(run_object, circuit, turns_json, chart, driver).items():
+        if isinstance(built, alt.TopLevelMixin):
+            paths += save_chart(built, stem + suffix, formats, scale)
+        else:
+            built.data.to_csv(f'{stem}{suffix}.csv', index=False)
+            built.to_html(f'{stem}{suffix}.html')
+            paths += [f'{stem}{suffix}.csv', f'{stem}{suffix}.html']
+    return paths
+
+def warm_circuit(seed: int) -> None:
+    """Generates the geometry of a circuit, if it is not cached yet, before its charts are rendered."""
+    CircuitChart.load(seed, random_orientation=False)
+
+def read_manifest(output_dir: str) -> dict:
+    try:
+        with open(join(output_dir, MANIFEST), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(output_dir: str, manifest: dict) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_path = join(output_dir, f'{MANIFEST}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, join(output_dir, MANIFEST))
+
+def generate_report(data_dir: str = DATA_DIR, output_dir: str = REPORT_DIR, runs: list[str] | None = None, formats: list[str] = ['svg'],
+                    scale: float = 1.0, workers: int | None = None, force: bool = False) -> dict:
+    """
+    Renders the report of every circuit and driver to output_dir, a folder per circuit.
+
+    Every chart is an independent task in a pool of `workers` processes (one per cpu if None). A task is
+    skipped when its outputs exist and the hash of its inputs (see input_hash) is the one recorded in the
+    manifest of output_dir when they were rendered, unless force is True.
+
+    output:
+        the number of 'rendered', 'skipped' and 'failed' tasks
+    """
+    invalid = set(formats) - set(FORMATS)
+    if invalid:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    with open(join(data_dir, 'info.json'), 'r') as f:
+        info = json.load(f)
+    runs = list(info.keys()) if runs is None else runs
+
+    code = code_digest()
+    manifest = read_manifest(output_dir)
+    counts = {'rendered': 0, 'skipped': 0, 'failed': 0}
+    pending = {}
+    for task in report_tasks(data_dir, runs, info):
+        task_id = '/'.join(part for part in (slug(task[0]), task[1], task[2] and slug(task[2])) if part)
+        task_hash = input_hash(data_dir, *task, formats, scale, code, info)
+        entry = manifest.get(task_id)
+        if not force and entry is not None and entry['hash'] == task_hash and all(isfile(path) for path in entry['paths']):
+            counts['skipped'] += 1
+        else:
+            pending[task_id] = (task, task_hash)
+
+    if not pending:
+        return counts
+
+    workers = min((os.cpu_count() or 1) if workers is None else workers, len(pending))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Circuits are generated once, in parallel, before their charts need them
+        list(executor.map(warm_circuit, sorted({circuit_seed(task[0]) for task, _ in pending.values()})))
+
+        futures = {
+            executor.submit(render_task, data_dir, output_dir, *task, formats, scale): task_id
+            for task_id, (task, _) in pending.items()
+        }
+        for future in as_completed(futures):
+            task_id = futures[future]
+            try:
+                paths = future.result()
+            except Exception as e:
+                counts['failed'] += 1
+                print(f'{task_id}: failed, {type(e).__name__}: {e}')
+                continue
+            counts['rendered'] += 1
+            manifest[task_id] = {'hash': pending[task_id][1], 'paths': paths}
+            write_manifest(output_dir, manifest)
+            print(f'{task_id}: {len(paths)} files')
+
+    return counts
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Render the charts of every circuit and driver to static files, without the app.')
+    parser.add_argument('-d', '--data', dest='data_dir', default=DATA_DIR, help='Folder with info.json and a subfolder per circuit.')
+    parser.add_argument('-o', '--output', dest='output_dir', default=REPORT_DIR, help='Folder where the report is written.')
+    parser.add_argument('-r', '--runs', dest='runs', nargs='+', default=None, help='Circuits to render, all of them by default.')
+    parser.add_argument('-f', '--formats', dest='formats', nargs='+', default=['svg'], choices=FORMATS, help='Formats of the charts.')
+    parser.add_argument('-s', '--scale', dest='scale', default=1.0, help='Scale of the png images.', type=float)
+    parser.add_argument('-w', '--workers', dest='workers', default=None, help='Number of processes, one per cpu by default.', type=int)
+    parser.add_argument('--force', dest='force', action='store_true', help='Render every chart, even if its inputs did not change.')
+    args = parser.parse_args()
+
+    counts = generate_report(args.data_dir, args.output_dir, args.runs, args.formats, args.scale, args.workers, args.force)
+    print(f"{counts['rendered']} rendered, {counts['skipped']} skipped, {counts['failed']} failed")
+    if counts['failed']:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    __main__()
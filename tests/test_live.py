@@ -0,0 +1,73 @@
+import json
+from os.path import dirname, join
+
+import numpy as np
+import pandas as pd
+
+from Modules.live import TelemetryTail
+
+CSV = join(dirname(dirname(__file__)), 'data', 'TILK-E:27', '27_Run1.csv')
+
+
+def session(short_lap: int = 50) -> pd.DataFrame:
+    """A session of three laps from the sample data, the second one (e.g. a pit stop) shorter than the smoothing window."""
+    lap = pd.read_csv(CSV)
+    return pd.concat([
+        lap.assign(laps=0),
+        lap.iloc[:short_lap].assign(laps=1),
+        lap.assign(laps=2),
+    ], ignore_index=True)
+
+
+def test_tail_survives_a_lap_shorter_than_the_smoothing_window(tmp_path):
+    df = session()
+    path = tmp_path / 'live.csv'
+    tail = TelemetryTail(str(path))
+
+    df.to_csv(path, index=False)
+    closed = tail.poll()
+    last = tail.finish()
+
+    assert [len(lap.df) for lap in closed + [last]] == [len(df[df['laps'] == i]) for i in range(3)]
+    short = tail.run.laps[1]
+    # The short lap is not smoothed, so it has no harshness
+    assert short.steering.harshness == 0
+    assert short.throttle.harshness == 0
+    assert tail.run.laps[0].steering.harshness > 0
+
+
+def test_closed_laps_read_the_run_telemetry(tmp_path):
+    df = session()
+    path = tmp_path / 'live.csv'
+    tail = TelemetryTail(str(path))
+    df.to_csv(path, index=False)
+    tail.poll()
+    tail.finish()
+
+    run = tail.run
+    assert len(run.df) == len(df) == run.lap_offsets[-1]
+    for lap, start, end in zip(run.laps, run.lap_offsets[:-1], run.lap_offsets[1:]):
+        assert np.array_equal(lap.df['Steering'].values, run.df['Steering'].values[start:end])
+        assert lap.df.index[0] == start
+
+
+def test_tail_extends_turn_metrics_without_appending_closed_laps(tmp_path):
+    with open(join(dirname(CSV), 'turns.json'), 'r') as f:
+        turns_json = json.load(f)
+    lap = pd.read_csv(CSV)
+    path = tmp_path / 'live.csv'
+    tail = TelemetryTail(str(path), turns_json=turns_json)
+
+    for number in range(4):
+        lap.assign(laps=number).to_csv(path, mode='a', header=number == 0, index=False)
+        tail.poll()
+        # Every closed lap is still waiting to be appended to the run telemetry
+        assert len(tail.run._closed_frames) == len(tail.run.laps) == number
+    tail.finish()
+
+    run = tail.run
+    table = run.turn_metrics(turns_json)
+    assert len(run._closed_frames) == len(run.laps) == 4
+    assert sorted(set(table.index.get_level_values('lap'))) == [0, 1, 2, 3]
+    run._turn_metrics = None
+    pd.testing.assert_frame_equal(table, run.turn_metrics(turns_json))
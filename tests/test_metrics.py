@@ -0,0 +1,23 @@
+from os.path import dirname, join
+
+import numpy as np
+import pandas as pd
+
+from Modules import Run
+from Modules.spectral import band_power
+
+CSV = join(dirname(dirname(__file__)), 'data', 'TILK-E:27', '27_Run1.csv')
+
+
+def test_spectral_metrics_use_the_sample_rate_of_the_run():
+    lap = pd.read_csv(CSV)
+    # The second lap is sampled at a lower rate, so on its own it would be resampled at another rate
+    df = pd.concat([lap.assign(laps=0), lap.assign(laps=1, delta=lap['delta'] * 1.6), lap.assign(laps=2)], ignore_index=True)
+    metric = 'steering_high_frequency_power'
+
+    run = Run(df, filename='session.csv')
+    run.metrics([metric], laps=[1])
+    values = run.metrics([metric])[metric].values
+
+    spectrum = Run(df, filename='session.csv').spectrum('Steering')
+    assert np.allclose(values, band_power(spectrum.freqs, spectrum.psd, 2.0, None), rtol=1e-9, atol=0)
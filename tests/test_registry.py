@@ -0,0 +1,20 @@
+import pytest
+
+from Modules.registry import RunRegistry
+
+
+def test_a_failed_load_releases_its_key():
+    calls = []
+
+    def loader(key):
+        calls.append(key)
+        raise FileNotFoundError(key)
+
+    registry = RunRegistry(loader)
+    for _ in range(2):
+        with pytest.raises(FileNotFoundError):
+            registry.get('missing')
+
+    assert calls == ['missing', 'missing']
+    assert 'missing' not in registry
+    assert not registry._loading_locks